@@ -0,0 +1,279 @@
+"""Long-lived analysis daemon for the Node server.
+
+`server/server.js` starts this once and talks to it with newline-delimited JSON
+on stdin/stdout, so check-ins no longer pay for a fresh interpreter and the
+TensorFlow/FER, NLTK and pandas imports on every request.
+
+Requests carry an `id` that is echoed on every line written for them:
+
+    {"id": "r1", "op": "analyze", "path": "/abs/upload.mp4"}
+    {"id": "r1", "event": {"stage": "transcribe", "status": "started"}}
+    {"id": "r1", "ok": true, "result": {"text": ..., "emotions": [...], ...}}
+
+Ops are `analyze` (therapyAI.main), `reply` (therapyAI.analyze_reply, no FER),
+`ping` (answered by a worker) and `health` (answered by the daemon). An
+`analyze` request carrying `upload` (and optionally `user_id`) also stores the
+clip's emotion aggregates in the `emotion_sessions` table of EMOTION_DB. Work runs
+on a small pool of worker processes that load the models before taking
+requests. A worker that dies, or exceeds a request's `timeout`, is replaced,
+and its request fails with an error line instead of hanging.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+
+def _worker_main(conn):
+    # keep stray prints from TF and friends off the protocol stream
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    # each worker is already its own process, so run FER in-process instead of a nested pool
+    os.environ['FER_PROCESSES'] = '0'
+    import therapyAI
+    from emotion_timeline import TimelineStore, record_session_safe
+    from model_registry import registry
+    from result_cache import file_sha256
+    registry.warm_up()
+    db = os.environ.get('EMOTION_DB')
+    timelines = TimelineStore(db, therapyAI.EMOTION_TIMELINE_DIR) if db else None
+    conn.send({'ready': os.getpid(), 'models': registry.status()})
+    while True:
+        try:
+            req = conn.recv()
+        except EOFError:
+            return
+        rid = req.get('id')
+        op = req.get('op')
+
+        def progress(stage, status, **info):
+            conn.send({'id': rid, 'event': dict(stage=stage, status=status, **info)})
+
+        try:
+            if op == 'analyze':
+                content_hash = req.get('content_hash')
+                if timelines is not None and req.get('upload') and not content_hash:
+                    content_hash = file_sha256(req['path'])
+                result = therapyAI.main(req['path'], progress=progress, content_hash=content_hash)
+                if timelines is not None and req.get('upload'):
+                    record_session_safe(timelines, content_hash, upload=req['upload'], user_id=req.get('user_id'))
+            elif op == 'reply':
+                result = therapyAI.analyze_reply(req['path'], progress=progress, content_hash=req.get('content_hash'))
+            elif op == 'ping':
+                result = {'pid': os.getpid()}
+            else:
+                raise ValueError(f"unknown op: {op}")
+            conn.send({'id': rid, 'ok': True, 'result': result})
+        except Exception as e:
+            conn.send({'id': rid, 'ok': False, 'error': str(e), 'trace': traceback.format_exc()})
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+class Worker:
+    def __init__(self, index, ctx, ready_timeout):
+        self.index = index
+        self.ctx = ctx
+        self.ready_timeout = ready_timeout
+        self.proc = None
+        self.conn = None
+        self.busy = False
+        # held while the worker serves a request or restarts, so the monitor and
+        # the serving slot never drive the same pipe at once
+        self.lock = threading.Lock()
+        self.served = 0
+        self.restarts = -1
+        self.started = None
+        self.ready = False
+
+    def start(self):
+        parent, child = self.ctx.Pipe()
+        self.proc = self.ctx.Process(target=_worker_main, args=(child,), name=f"analysis-worker-{self.index}", daemon=True)
+        self.proc.start()
+        child.close()
+        self.conn = parent
+        self.restarts += 1
+        self.started = time.time()
+        self.ready = False
+        # wait for the model warm-up so the first request doesn't pay for it
+        if not self.conn.poll(self.ready_timeout):
+            # don't leave a half-started worker whose late handshake could pass for a reply;
+            # the monitor sees the dead process and tries again
+            self.stop()
+            raise WorkerCrashed(f"worker {self.index} not ready after {self.ready_timeout}s")
+        msg = self.conn.recv()
+        self.ready = True
+        print(f"analysis worker {self.index} ready (pid {msg.get('ready')})", file=sys.stderr)
+
+    def stop(self):
+        if self.proc is not None and self.proc.is_alive():
+            self.proc.kill()
+            self.proc.join(5)
+        if self.conn is not None:
+            self.conn.close()
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def alive(self):
+        return self.proc is not None and self.proc.is_alive()
+
+    def call(self, req, on_event, timeout=None):
+        """Send one request and relay its events until the final reply."""
+        if not self.alive():
+            self.restart()
+        self.conn.send(req)
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            if not self.conn.poll(1.0):
+                if not self.alive():
+                    raise WorkerCrashed(f"worker {self.index} exited with code {self.proc.exitcode}")
+                if deadline and time.monotonic() > deadline:
+                    raise WorkerCrashed(f"worker {self.index} timed out after {timeout}s")
+                continue
+            try:
+                msg = self.conn.recv()
+            except (EOFError, OSError):
+                self.proc.join(1)
+                raise WorkerCrashed(f"worker {self.index} exited with code {self.proc.exitcode}")
+            if 'ready' in msg or msg.get('id') != req.get('id'):
+                # a late handshake, or the tail of a request that timed out earlier
+                continue
+            if 'event' in msg:
+                on_event(msg)
+                continue
+            return msg
+
+    def status(self):
+        return {
+            'index': self.index,
+            'pid': self.proc.pid if self.proc else None,
+            'alive': self.alive(),
+            'ready': self.ready,
+            'busy': self.busy,
+            'served': self.served,
+            'restarts': max(self.restarts, 0),
+            'uptime': round(time.time() - self.started, 1) if self.started else None,
+        }
+
+
+class Daemon:
+    def __init__(self, workers=2, ready_timeout=300, out=None):
+        self.out = out or sys.stdout
+        self._out_lock = threading.Lock()
+        self.tasks = queue.Queue()
+        self.started = time.time()
+        ctx = multiprocessing.get_context('spawn')
+        self.workers = [Worker(i, ctx, ready_timeout) for i in range(workers)]
+
+    def emit(self, msg):
+        line = json.dumps(msg)
+        with self._out_lock:
+            self.out.write(line + '\n')
+            self.out.flush()
+
+    def start(self):
+        for w in self.workers:
+            threading.Thread(target=self._serve, args=(w,), name=f"slot-{w.index}", daemon=True).start()
+        threading.Thread(target=self._monitor, name='monitor', daemon=True).start()
+
+    def _serve(self, worker):
+        with worker.lock:
+            try:
+                worker.start()
+            except Exception as e:
+                print(f"analysis worker {worker.index} failed to start: {e}", file=sys.stderr)
+        while True:
+            req = self.tasks.get()
+            rid = req.get('id')
+            with worker.lock:
+                worker.busy = True
+                try:
+                    resp = worker.call(req, self.emit, timeout=req.get('timeout'))
+                    worker.served += 1
+                except Exception as e:
+                    print(f"request {rid} failed: {e}; restarting worker {worker.index}", file=sys.stderr)
+                    resp = {'id': rid, 'ok': False, 'error': str(e)}
+                    try:
+                        worker.restart()
+                    except Exception as e2:
+                        print(f"restart of worker {worker.index} failed: {e2}", file=sys.stderr)
+                finally:
+                    worker.busy = False
+            self.emit(resp)
+
+    def _monitor(self):
+        # health check: replace idle workers that died between requests or never finished starting
+        while True:
+            time.sleep(5)
+            for w in self.workers:
+                # a slot that holds the lock is serving (or restarting) the worker itself
+                if not w.lock.acquire(blocking=False):
+                    continue
+                try:
+                    if w.proc is not None and not w.alive():
+                        print(f"analysis worker {w.index} died (exit {w.proc.exitcode}); restarting", file=sys.stderr)
+                        w.busy = True
+                        try:
+                            w.restart()
+                        except Exception as e:
+                            print(f"restart of worker {w.index} failed: {e}", file=sys.stderr)
+                        finally:
+                            w.busy = False
+                finally:
+                    w.lock.release()
+
+    def health(self):
+        return {
+            'pid': os.getpid(),
+            'uptime': round(time.time() - self.started, 1),
+            'queued': self.tasks.qsize(),
+            'workers': [w.status() for w in self.workers],
+            'ready': any(w.ready and w.alive() for w in self.workers),
+        }
+
+    def handle_line(self, line):
+        try:
+            req = json.loads(line)
+        except ValueError as e:
+            self.emit({'id': None, 'ok': False, 'error': f"bad request: {e}"})
+            return
+        if req.get('op') == 'health':
+            self.emit({'id': req.get('id'), 'ok': True, 'result': self.health()})
+            return
+        self.tasks.put(req)
+
+    def run(self, stream):
+        self.start()
+        self.emit({'id': None, 'event': {'stage': 'daemon', 'status': 'started', 'pid': os.getpid()}})
+        for line in stream:
+            line = line.strip()
+            if line:
+                self.handle_line(line)
+        # stdin closed: the Node server went away
+        for w in self.workers:
+            w.stop()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='therapyAI analysis daemon (NDJSON over stdio)')
+    ap.add_argument('--workers', type=int, default=int(os.environ.get('ANALYSIS_WORKERS', 2)))
+    ap.add_argument('--ready-timeout', type=float, default=300)
+    args = ap.parse_args(argv)
+    # own the real stdout for the protocol; anything else printing to fd 1 lands on stderr
+    out = os.fdopen(os.dup(1), 'w', encoding='utf-8')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    Daemon(workers=args.workers, ready_timeout=args.ready_timeout, out=out).run(sys.stdin)
+
+
+if __name__ == '__main__':
+    main()
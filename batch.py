@@ -0,0 +1,344 @@
+"""Batch re-scoring of recorded check-ins.
+
+    python -m therapyAI batch 'output/*.mp4' -o output/batch_results.jsonl
+    python -m therapyAI batch output/ --workers 4 --chat
+
+Facial-emotion analysis runs on a pool of worker processes, and hashing and
+transcription run on an I/O thread pool. Transcripts are scored for sentiment
+in batches as they arrive. Each file is written to the output as one JSON line
+as soon as it is finished. A later run skips every file that already has a
+successful record, so an interrupted batch can simply be started again. A
+failed file (including one where only a stage such as FER failed) is retried
+on later runs until it has failed `--max-attempts` times. At the end of a run
+the output is rewritten to hold only the latest record per file.
+Transcript and emotion results go through the shared per-stage result cache,
+the same one `therapyAI.main()` uses.
+"""
+import argparse
+import concurrent.futures as cf
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import therapyAI
+from result_cache import file_sha256
+
+VIDEO_EXTENSIONS = ('.mp4', '.webm', '.mov', '.mkv', '.avi')
+MAX_ATTEMPTS = 3
+
+
+def discover(target):
+    """Video files under a directory, or matching a glob pattern, sorted."""
+    if os.path.isdir(target):
+        paths = [os.path.join(root, name) for root, _, names in os.walk(target) for name in names]
+    else:
+        paths = glob.glob(target, recursive=True)
+    return sorted(os.path.abspath(p) for p in paths
+                  if os.path.isfile(p) and p.lower().endswith(VIDEO_EXTENSIONS))
+
+
+def failed(rec):
+    """Whether a record is a failure: a top-level `error`, or stage `errors`
+    (e.g. FER failed and `emotions` fell back to [])."""
+    return 'error' in rec or bool(rec.get('errors'))
+
+
+def latest_records(output):
+    """The last record per file in `output`, in the order files first appear."""
+    records = {}
+    if not os.path.exists(output):
+        return records
+    with open(output, encoding='utf-8') as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # partial last line from an interrupted run
+            if rec.get('file'):
+                records[rec['file']] = rec
+    return records
+
+
+def completed(output, max_attempts=MAX_ATTEMPTS):
+    """Files that need no further run: their latest record in `output` is
+    successful, or they have already failed `max_attempts` times."""
+    return {path for path, rec in latest_records(output).items()
+            if not failed(rec) or rec.get('attempts', 1) >= max_attempts}
+
+
+def compact(output):
+    """Rewrite `output` keeping only the latest record per file."""
+    records = latest_records(output)
+    tmp = f"{output}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        for rec in records.values():
+            f.write(json.dumps(rec) + '\n')
+    os.replace(tmp, output)
+
+
+def _fmt_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def _transcribe(path, content_hash):
+    """I/O pool job: transcribe a file (text and word timestamps) through the result cache."""
+    cache = therapyAI.cache
+    if cache is not None:
+        transcript = cache.get(content_hash, 'transcribe', therapyAI.TRANSCRIBE_VERSION)
+        if transcript is not None:
+            return transcript
+    transcript = therapyAI.transcribe_timed(path)
+    if cache is not None:
+        cache.put(content_hash, 'transcribe', therapyAI.TRANSCRIBE_VERSION, transcript)
+    return transcript
+
+
+class _Item:
+    def __init__(self, path, attempts=1):
+        self.path = path
+        self.attempts = attempts
+        self.started = time.monotonic()
+        self.content_hash = None
+        self.transcript = None
+        self.text = None
+        self.mismatches = None
+        self.sentiment = None
+        self.emotions = None
+        self.response = None
+        self.errors = {}
+        self.error = None
+        self.fer_attempts = 0
+
+    def record(self, chat):
+        rec = {'file': self.path, 'content_hash': self.content_hash, 'attempts': self.attempts}
+        if self.error:
+            rec['error'] = self.error
+        else:
+            rec.update(text=self.text, sentiment=self.sentiment, emotions=self.emotions,
+                       mismatches=self.mismatches or [])
+            if chat:
+                rec['response'] = self.response
+        if self.errors:
+            rec['errors'] = self.errors
+        rec['elapsed_ms'] = round((time.monotonic() - self.started) * 1000)
+        return rec
+
+
+class BatchRunner:
+    def __init__(self, output, workers=None, io_threads=8, sentiment_batch=16, sentiment_wait=2.0,
+                 chat=False, max_attempts=MAX_ATTEMPTS, log=sys.stderr):
+        """`workers` FER processes (default: half the CPUs) and `io_threads`
+        threads for hashing/transcription. Transcripts are scored for
+        sentiment `sentiment_batch` at a time, or after waiting
+        `sentiment_wait` seconds for a batch to fill. `chat` also asks the
+        chatbot for a response per file. A file that keeps failing is given
+        up on after `max_attempts` runs."""
+        self.output = output
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.io_threads = io_threads
+        self.sentiment_batch = sentiment_batch
+        self.sentiment_wait = sentiment_wait
+        self.chat = chat
+        self.max_attempts = max_attempts
+        self.log = log
+
+    def _start_fer_pool(self):
+        # spawn for the same reason as therapyAI's own FER pool; each worker loads FER once up front
+        return cf.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                      initializer=therapyAI._init_fer_worker)
+
+    def run(self, paths):
+        records = latest_records(self.output)
+        done = completed(self.output, self.max_attempts)
+        todo = [p for p in paths if p not in done]
+        skipped = len(paths) - len(todo)
+        # files whose latest record failed `max_attempts` times are not retried, but still count as failed
+        gave_up = sum(1 for p in paths if p in done and failed(records[p]))
+        print(f"batch: {len(paths)} files, {skipped} already done ({gave_up} given up after "
+              f"{self.max_attempts} failed attempts), {len(todo)} to analyse "
+              f"({self.workers} FER workers, {self.io_threads} I/O threads)", file=self.log)
+        if not todo:
+            return {'files': len(paths), 'skipped': skipped, 'analysed': 0, 'failed': 0, 'gave_up': gave_up}
+
+        io_pool = cf.ThreadPoolExecutor(self.io_threads, thread_name_prefix='batch-io')
+        fer_pool = self._start_fer_pool()
+        futures = {}    # future -> (kind, item, pool)
+        remaining = {}  # path -> set of results still outstanding
+        scoring = []    # items with a transcript waiting for batched sentiment
+        last_flush = time.monotonic()
+        started = time.monotonic()
+        finished = failures = 0
+        out = open(self.output, 'a', encoding='utf-8')
+
+        def submit_fer(item):
+            item.fer_attempts += 1
+            # with the hash, the worker also writes the clip's emotion timeline
+            future = fer_pool.submit(therapyAI.analyze_video_emotions, item.path, item.content_hash)
+            futures[future] = ('emotions', item, fer_pool)
+
+        def finish(item):
+            nonlocal finished, failures
+            rec = item.record(self.chat)
+            out.write(json.dumps(rec) + '\n')
+            out.flush()
+            finished += 1
+            failures += failed(rec)
+            elapsed = time.monotonic() - started
+            rate = finished / elapsed if elapsed else 0
+            eta = (len(todo) - finished) / rate if rate else 0
+            problem = item.error or '; '.join(f"{k}: {v}" for k, v in item.errors.items())
+            print(f"[{finished}/{len(todo)}] {rate * 60:.1f} files/min, ETA {_fmt_duration(eta)}  "
+                  f"{os.path.basename(item.path)}{' FAILED: ' + problem if problem else ''}", file=self.log)
+
+        def align(item):
+            # words against the face once both are in; the FER worker has written the timeline by then
+            if item.error or item.mismatches is not None:
+                return
+            try:
+                item.mismatches = therapyAI.align_transcript(item.transcript, item.emotions, item.content_hash)
+            except Exception as e:
+                item.mismatches = []
+                item.errors['alignment'] = f"{type(e).__name__}: {e}"
+
+        def resolved(item, part):
+            left = remaining[item.path]
+            left.discard(part)
+            if not left or left == {'chatbot'}:
+                align(item)
+            if not left:
+                del remaining[item.path]
+                finish(item)
+            elif left == {'chatbot'}:
+                submit_chat(item)
+
+        def fail(item, e):
+            # without a hash or transcript there is nothing to score; the record is a failure
+            item.error = f"{type(e).__name__}: {e}"
+            for part in ('transcribe', 'sentiment', 'emotions', 'chatbot'):
+                if item.path in remaining:
+                    resolved(item, part)
+
+        def submit_chat(item):
+            if item.error:
+                resolved(item, 'chatbot')
+                return
+            futures[io_pool.submit(therapyAI.chatbot_response, item.emotions, item.sentiment, item.text,
+                                   mismatches=item.mismatches)] = ('chatbot', item, None)
+
+        def flush_sentiment():
+            nonlocal scoring, last_flush
+            batch, scoring = scoring, []
+            last_flush = time.monotonic()
+            if not batch:
+                return
+            try:
+                labels = therapyAI.determine_sentiments([item.text for item in batch])
+            except Exception as e:
+                labels = ['neutral'] * len(batch)
+                for item in batch:
+                    item.errors['sentiment'] = str(e)
+            for item, label in zip(batch, labels):
+                item.sentiment = label
+                resolved(item, 'sentiment')
+
+        try:
+            for path in todo:
+                previous = records.get(path)
+                item = _Item(path, attempts=previous.get('attempts', 1) + 1 if previous else 1)
+                remaining[path] = {'transcribe', 'sentiment', 'emotions'} | ({'chatbot'} if self.chat else set())
+                futures[io_pool.submit(file_sha256, path)] = ('hash', item, None)
+
+            while futures or scoring:
+                ready, _ = cf.wait(list(futures), timeout=0.5, return_when=cf.FIRST_COMPLETED)
+                for fut in ready:
+                    kind, item, pool = futures.pop(fut)
+                    if item.path not in remaining:
+                        continue  # the file already failed
+                    try:
+                        value = fut.result()
+                    except BrokenProcessPool as e:
+                        # a worker died; replace the pool once and retry this file on the new one
+                        if pool is fer_pool:
+                            fer_pool.shutdown(wait=False)
+                            fer_pool = self._start_fer_pool()
+                        if item.fer_attempts < 2:
+                            submit_fer(item)
+                            continue
+                        item.emotions = []
+                        item.errors['emotions'] = f"{type(e).__name__}: {e}"
+                        resolved(item, 'emotions')
+                        continue
+                    except Exception as e:
+                        if kind in ('hash', 'transcribe'):
+                            fail(item, e)
+                            continue
+                        value = [] if kind == 'emotions' else None
+                        item.errors[kind] = f"{type(e).__name__}: {e}"
+                    if kind == 'hash':
+                        # transcription (network) and FER (CPU) proceed side by side
+                        item.content_hash = value
+                        futures[io_pool.submit(_transcribe, item.path, value)] = ('transcribe', item, None)
+                        cached = None
+                        if therapyAI.cache is not None:
+                            cached = therapyAI.cache.get(value, 'emotions', therapyAI.EMOTIONS_VERSION)
+                        if cached is not None:
+                            item.emotions = cached
+                            resolved(item, 'emotions')
+                        else:
+                            submit_fer(item)
+                    elif kind == 'transcribe':
+                        item.transcript = value
+                        item.text = value['text']
+                        scoring.append(item)
+                        resolved(item, 'transcribe')
+                    elif kind == 'emotions':
+                        item.emotions = value
+                        if therapyAI.cache is not None and 'emotions' not in item.errors:
+                            therapyAI.cache.put(item.content_hash, 'emotions', therapyAI.EMOTIONS_VERSION, value)
+                        resolved(item, 'emotions')
+                    else:
+                        item.response = value
+                        resolved(item, 'chatbot')
+                transcribing = any(kind in ('hash', 'transcribe') for kind, _, _ in futures.values())
+                if scoring and (len(scoring) >= self.sentiment_batch or not transcribing
+                                or time.monotonic() - last_flush >= self.sentiment_wait):
+                    flush_sentiment()
+        finally:
+            out.close()
+            io_pool.shutdown(wait=False)
+            fer_pool.shutdown(wait=False)
+            # retried files appended a second record; keep one per file
+            compact(self.output)
+
+        elapsed = time.monotonic() - started
+        print(f"batch: {finished} files in {_fmt_duration(elapsed)} "
+              f"({finished / elapsed * 60 if elapsed else 0:.1f} files/min), {failures} failed", file=self.log)
+        return {'files': len(paths), 'skipped': skipped, 'analysed': finished, 'failed': failures,
+                'gave_up': gave_up, 'seconds': round(elapsed, 1)}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog='python -m therapyAI batch', description='Analyse a directory or glob of recordings.')
+    ap.add_argument('target', help='directory (searched recursively) or glob pattern of video files')
+    ap.add_argument('-o', '--output', default='batch_results.jsonl', help='JSONL file to append results to')
+    ap.add_argument('--workers', type=int, default=None, help='FER worker processes (default: half the CPUs)')
+    ap.add_argument('--io-threads', type=int, default=8, help='threads for hashing and transcription')
+    ap.add_argument('--sentiment-batch', type=int, default=16, help='transcripts scored per sentiment batch')
+    ap.add_argument('--chat', action='store_true', help='also generate a chatbot response per file')
+    ap.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS,
+                    help='runs a failing file gets before it is no longer retried')
+    args = ap.parse_args(argv)
+
+    paths = discover(args.target)
+    if not paths:
+        print(f"batch: no video files found for {args.target!r}", file=sys.stderr)
+        return 1
+    runner = BatchRunner(args.output, workers=args.workers, io_threads=args.io_threads,
+                         sentiment_batch=args.sentiment_batch, chat=args.chat, max_attempts=args.max_attempts)
+    stats = runner.run(paths)
+    return 1 if stats['failed'] or stats['gave_up'] else 0
@@ -0,0 +1,322 @@
+"""Offline benchmark for the analysis pipeline and flask_api.
+
+AssemblyAI and Ollama are replaced by the local stand-ins in mock_services.py,
+so runs are repeatable and need no network. The clips come from
+`make_fixtures`: synthetic videos with a drawn face and, when ffmpeg is
+available, a tone as the audio track. The benchmark measures:
+
+- per-stage latency of `transcribe_audio`, `determine_sentiment`,
+  `analyze_video_emotions` and `chatbot_response`
+- end-to-end latency and throughput of `/record` (upload until the job is
+  done) and `/chat` under N concurrent clients
+
+Results are written as JSON. With `--baseline`, p50/p95 latency and
+throughput are compared against a stored report, and the exit status is 1 if
+any of them regressed by more than `--tolerance`.
+
+    python benchmark.py --save-baseline        # record benchmark_baseline.json
+    python benchmark.py --clients 8            # compare against it
+"""
+import argparse
+import concurrent.futures as cf
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+from mock_services import MockAssemblyAI, MockOllama
+
+ROOT = Path(__file__).resolve().parent
+REPORT_VERSION = 1
+# metrics compared against the baseline, and whether bigger is better
+COMPARED = {'p50_ms': False, 'p95_ms': False, 'rps': True}
+
+
+def make_fixtures(directory, count=3, seconds=4.0, fps=15, size=(320, 240)):
+    """Write `count` synthetic check-in clips to `directory` (existing ones are
+    reused) and return their paths. Each shows a drawn face that drifts and
+    changes expression; with ffmpeg on PATH a tone is muxed in as audio."""
+    import cv2
+    import numpy as np
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    ffmpeg = shutil.which('ffmpeg')
+    w, h = size
+    paths = []
+    for i in range(count):
+        path = directory / f"fixture_{i}_{int(seconds)}s.mp4"
+        paths.append(str(path))
+        if path.exists():
+            continue
+        silent = path.with_suffix('.silent.mp4')
+        writer = cv2.VideoWriter(str(silent), cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+        frames = int(seconds * fps)
+        for n in range(frames):
+            t = n / max(frames - 1, 1)
+            img = np.full((h, w, 3), (200 - 30 * i, 190, 180), np.uint8)
+            cx, cy = int(w / 2 + 20 * np.sin(2 * np.pi * t)), int(h / 2 + 5 * i)
+            fw, fh = w // 5, h // 3
+            cv2.ellipse(img, (cx, cy), (fw, fh), 0, 0, 360, (150, 180, 225), -1)
+            for dx in (-fw // 2, fw // 2):
+                cv2.circle(img, (cx + dx, cy - fh // 4), max(fw // 8, 2), (40, 40, 40), -1)
+            # mouth goes from a frown to a smile over the clip
+            curve = int((t - 0.5) * fh // 2)
+            cv2.ellipse(img, (cx, cy + fh // 2 - curve), (fw // 2, abs(curve) + 1), 0,
+                        0 if curve >= 0 else 180, 180 if curve >= 0 else 360, (60, 60, 160), 3)
+            writer.write(img)
+        writer.release()
+        if ffmpeg:
+            subprocess.run([
+                ffmpeg, '-y', '-loglevel', 'error', '-i', str(silent),
+                '-f', 'lavfi', '-i', f"sine=frequency={220 + 110 * i}:duration={seconds}",
+                '-shortest', '-c:v', 'copy', '-c:a', 'aac', str(path)
+            ], check=True)
+            silent.unlink()
+        else:
+            silent.rename(path)
+    return paths
+
+
+def _summary(samples_ms, errors=0, wall=None):
+    s = sorted(samples_ms)
+    out = {'n': len(s), 'errors': errors}
+    if s:
+        pick = lambda q: s[min(len(s) - 1, int(round(q * (len(s) - 1))))]
+        out.update(mean_ms=round(sum(s) / len(s), 2), p50_ms=round(pick(0.5), 2), p95_ms=round(pick(0.95), 2),
+                   min_ms=round(s[0], 2), max_ms=round(s[-1], 2))
+    if wall:
+        out['wall_s'] = round(wall, 3)
+        out['rps'] = round(len(s) / wall, 3)
+    return out
+
+
+def _timed(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    value = fn(*args, **kwargs)
+    return value, (time.perf_counter() - t0) * 1000
+
+
+def bench_stages(therapyAI, fixtures, repeats=3, sentiment_repeats=50):
+    """Per-stage latency, calling each stage function directly."""
+    samples = {name: [] for name in ('transcribe_audio', 'determine_sentiment',
+                                     'analyze_video_emotions', 'chatbot_response')}
+    errors = dict.fromkeys(samples, 0)
+
+    def attempt(name, fn, *args):
+        try:
+            value, ms = _timed(fn, *args)
+        except Exception as e:
+            print(f"  {name} failed: {e}", file=sys.stderr)
+            errors[name] += 1
+            return None
+        samples[name].append(ms)
+        return value
+
+    for _ in range(repeats):
+        for path in fixtures:
+            text = attempt('transcribe_audio', therapyAI.transcribe_audio, path) or ''
+            sentiment = 'neutral'
+            for _ in range(sentiment_repeats):
+                sentiment = attempt('determine_sentiment', therapyAI.determine_sentiment, text) or sentiment
+            emotions = attempt('analyze_video_emotions', therapyAI.analyze_video_emotions, path) or []
+            attempt('chatbot_response', therapyAI.chatbot_response, emotions, sentiment, text)
+    return {f"stage.{name}": _summary(samples[name], errors[name]) for name in samples}
+
+
+def _serve(app):
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-flask', daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def _record_once(base, path, timeout):
+    http = requests.Session()
+    t0 = time.perf_counter()
+    while True:
+        with open(path, 'rb') as f:
+            r = http.post(base + '/record', files={'file': (os.path.basename(path), f, 'video/mp4')})
+        if r.status_code != 429:
+            break
+        time.sleep(float(r.headers.get('Retry-After', 1)))  # queue full: back off like a real client
+    r.raise_for_status()
+    status_url = base + r.json()['status_url']
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        snap = http.get(status_url).json()
+        if snap['status'] == 'done':
+            return (time.perf_counter() - t0) * 1000
+        if snap['status'] == 'failed':
+            raise RuntimeError(f"job failed: {snap.get('error')}")
+        time.sleep(0.05)
+    raise TimeoutError(f"job not done after {timeout}s")
+
+
+def _chat_once(base, session, text):
+    t0 = time.perf_counter()
+    r = requests.post(base + '/chat', data={'session': session, 'text': text})
+    r.raise_for_status()
+    return (time.perf_counter() - t0) * 1000
+
+
+def _load(clients, per_client, call):
+    """`clients` concurrent clients, each making `per_client` sequential calls `call(client, i)`."""
+    samples, errors = [], 0
+    lock = threading.Lock()
+
+    def client(c):
+        nonlocal errors
+        for i in range(per_client):
+            try:
+                ms = call(c, i)
+            except Exception as e:
+                print(f"  request failed: {e}", file=sys.stderr)
+                with lock:
+                    errors += 1
+                continue
+            with lock:
+                samples.append(ms)
+
+    t0 = time.perf_counter()
+    with cf.ThreadPoolExecutor(clients) as pool:
+        list(pool.map(client, range(clients)))
+    return _summary(samples, errors, wall=time.perf_counter() - t0)
+
+
+def bench_endpoints(flask_api, fixtures, clients=4, per_client=3, timeout=300):
+    """End-to-end latency and throughput of /record and /chat under `clients` concurrent clients."""
+    server, base = _serve(flask_api.app)
+    before = set(os.listdir(flask_api.UPLOAD_DIR))
+    try:
+        record = _load(clients, per_client, lambda c, i: _record_once(base, fixtures[(c + i) % len(fixtures)], timeout))
+        chat = _load(clients, per_client,
+                     lambda c, i: _chat_once(base, f"bench-{os.getpid()}-{c}", f"Benchmark message {i} from client {c}."))
+    finally:
+        server.shutdown()
+        # uploads made by the benchmark are not worth keeping
+        for name in set(os.listdir(flask_api.UPLOAD_DIR)) - before:
+            (flask_api.UPLOAD_DIR / name).unlink(missing_ok=True)
+    record['clients'] = chat['clients'] = clients
+    return {'endpoint.record': record, 'endpoint.chat': chat}
+
+
+def compare(report, baseline, tolerance=0.25):
+    """Metrics in `report` worse than `baseline` by more than `tolerance`
+    (a fraction), as a list of (metric, key, baseline, current)."""
+    regressions = []
+    for name, base in baseline.get('metrics', {}).items():
+        cur = report['metrics'].get(name)
+        if not cur:
+            continue
+        for key, higher_is_better in COMPARED.items():
+            if key not in base or key not in cur or not base[key]:
+                continue
+            change = (cur[key] - base[key]) / base[key]
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append((name, key, base[key], cur[key]))
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Offline benchmark for therapyAI and flask_api')
+    ap.add_argument('--fixtures', default=str(ROOT / 'benchmark_fixtures'), help='directory for synthetic clips')
+    ap.add_argument('--count', type=int, default=3, help='number of fixture clips')
+    ap.add_argument('--seconds', type=float, default=4.0, help='length of each fixture clip')
+    ap.add_argument('--repeats', type=int, default=3, help='passes over the fixtures for stage timings')
+    ap.add_argument('--clients', type=int, default=4, help='concurrent clients for the endpoint benchmark')
+    ap.add_argument('--requests', type=int, default=3, help='requests per client and endpoint')
+    ap.add_argument('--skip-endpoints', action='store_true', help='only time the pipeline stages')
+    ap.add_argument('--asr-seconds', type=float, default=1.0, help='mock transcription processing time')
+    ap.add_argument('--latency', type=float, default=0.02, help='added latency per mock HTTP request (s)')
+    ap.add_argument('--tokens-per-second', type=float, default=40.0, help='mock Ollama token rate')
+    ap.add_argument('--first-token-seconds', type=float, default=0.2, help='mock Ollama time to first token')
+    ap.add_argument('-o', '--output', default=str(ROOT / 'benchmark_report.json'))
+    ap.add_argument('--baseline', default=str(ROOT / 'benchmark_baseline.json'))
+    ap.add_argument('--save-baseline', action='store_true', help='write this run as the new baseline')
+    ap.add_argument('--tolerance', type=float, default=0.25, help='allowed regression as a fraction')
+    args = ap.parse_args(argv)
+
+    fixtures = make_fixtures(args.fixtures, count=args.count, seconds=args.seconds)
+    config = {k: v for k, v in vars(args).items() if k not in ('output', 'baseline', 'save_baseline', 'fixtures')}
+
+    with MockAssemblyAI(processing_seconds=args.asr_seconds, latency=args.latency) as asr, \
+            MockOllama(tokens_per_second=args.tokens_per_second, first_token_seconds=args.first_token_seconds,
+                       latency=args.latency) as llm:
+        tmp = tempfile.mkdtemp(prefix='bench-')
+        # read at import time by therapyAI, the ollama client and flask_api, so set them first
+        os.environ.update({
+            'ASSEMBLYAI_BASE_URL': asr.url,
+            'ASSEMBLYAI_API_KEY': 'benchmark',
+            'OLLAMA_HOST': llm.url,
+            'RESULT_CACHE': '0',  # every run must do the work it is timing
+            'DATA_DB': os.path.join(tmp, 'data.sqlite3'),
+            'WARMUP_MODELS': '0',
+            'UPLOAD_RETENTION': '0',
+            'EMOTION_TIMELINE_DIR': os.path.join(tmp, 'timelines'),
+        })
+        import therapyAI
+        from model_registry import registry
+
+        # model loading is a one-off cost; report it on its own instead of in the first sample
+        # (FER too: the stage timings below run it in this process even when flask_api uses a worker pool)
+        _, warmup_ms = _timed(lambda: (registry.warm_up(), registry.get('fer')))
+        metrics = {'warmup': {'ms': round(warmup_ms, 1), 'models': registry.status()}}
+        print(f"benchmarking stages over {len(fixtures)} clips x {args.repeats}", file=sys.stderr)
+        metrics.update(bench_stages(therapyAI, fixtures, repeats=args.repeats))
+        if not args.skip_endpoints:
+            import flask_api
+            print(f"benchmarking /record and /chat with {args.clients} clients x {args.requests}", file=sys.stderr)
+            metrics.update(bench_endpoints(flask_api, fixtures, clients=args.clients, per_client=args.requests))
+        therapyAI.pipeline.shutdown()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        'version': REPORT_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': _git_commit(),
+        'host': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'config': config,
+        'metrics': metrics,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2), encoding='utf-8')
+    print(f"report written to {args.output}", file=sys.stderr)
+    for name, m in metrics.items():
+        if 'p50_ms' in m:
+            extra = f", {m['rps']} req/s" if 'rps' in m else ''
+            print(f"  {name:32s} p50 {m['p50_ms']:9.1f} ms  p95 {m['p95_ms']:9.1f} ms  n={m['n']} errors={m['errors']}{extra}")
+
+    if args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print(f"baseline saved to {args.baseline}", file=sys.stderr)
+        return 0
+    if not os.path.exists(args.baseline):
+        print("no baseline to compare against (run with --save-baseline)", file=sys.stderr)
+        return 0
+    baseline = json.loads(Path(args.baseline).read_text(encoding='utf-8'))
+    regressions = compare(report, baseline, args.tolerance)
+    for name, key, old, new in regressions:
+        print(f"REGRESSION {name} {key}: {old} -> {new}")
+    if not regressions:
+        print(f"no regressions beyond {args.tolerance:.0%} against baseline {baseline.get('commit')}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
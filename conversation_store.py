@@ -0,0 +1,135 @@
+"""SQLite-backed chat history for flask_api.
+
+Conversations live in the `conversations`/`messages` tables of the app database
+(`server/data.sqlite3`, schema in `server/schema.sql`), so they survive
+restarts and are shared by every worker process. Messages are only ever
+inserted, in WAL mode, so readers never block the writer. Emotion/sentiment
+analysis is stored in its own columns rather than encoded in message text. An
+in-process LRU keeps recently active sessions in memory; each read only asks
+SQLite for rows newer than the last one cached, so another worker's writes are
+still picked up.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+class _Session:
+    def __init__(self):
+        self.messages = []
+        self.last_id = 0
+        self.emotions = None
+        self.sentiment = 'neutral'
+
+    def add(self, row):
+        msg_id, role, content, kind, emotions, sentiment, cancelled, ts = row
+        msg = {'role': role, 'content': content, 'ts': ts}
+        if cancelled:
+            msg['cancelled'] = True
+        self.messages.append(msg)
+        self.last_id = max(self.last_id, msg_id)
+        if kind == 'analysis':
+            self.emotions = json.loads(emotions) if emotions else None
+            self.sentiment = sentiment or 'neutral'
+
+
+class ConversationStore:
+    def __init__(self, path, schema_path=None, cache_size=256):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.cache_size = cache_size
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        if schema_path:
+            conn.executescript(Path(schema_path).read_text(encoding='utf-8'))
+
+    def _conn(self):
+        # one connection per thread; sqlite3 connections must not be shared across threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=10, isolation_level=None)
+            conn.execute('PRAGMA foreign_keys = ON')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _session(self, session_id):
+        """Cached session brought up to date with any rows written since."""
+        with self._cache_lock:
+            sess = self._cache.get(session_id)
+            if sess is None:
+                sess = _Session()
+                self._cache[session_id] = sess
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(session_id)
+        rows = self._conn().execute(
+            'SELECT id, role, content, kind, emotions, sentiment, cancelled, ts FROM messages '
+            'WHERE session_id = ? AND id > ? ORDER BY id',
+            (session_id, sess.last_id)).fetchall()
+        if rows:
+            with self._cache_lock:
+                for row in rows:
+                    if row[0] > sess.last_id:
+                        sess.add(row)
+        return sess
+
+    def history(self, session_id):
+        """Messages for `session_id` as [{role, content, ts}], oldest first."""
+        return list(self._session(session_id).messages)
+
+    def last_analysis(self, session_id):
+        """(emotions, sentiment) from the session's latest analysis message."""
+        sess = self._session(session_id)
+        return sess.emotions, sess.sentiment
+
+    def append(self, session_id, role, content, analysis=None, cancelled=False, user_id=None, ts=None):
+        """Append one message. `analysis` ({'emotions': [...], 'sentiment': str})
+        marks it as an analysis record whose values `last_analysis` returns."""
+        ts = int(time.time()) if ts is None else ts
+        kind, emotions, sentiment = 'message', None, None
+        if analysis is not None:
+            kind = 'analysis'
+            emotions = json.dumps(analysis.get('emotions') or [])
+            sentiment = analysis.get('sentiment')
+        conn = self._conn()
+        with self._write_lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('INSERT OR IGNORE INTO conversations (session_id, user_id) VALUES (?, ?)',
+                             (session_id, user_id))
+                cur = conn.execute(
+                    'INSERT INTO messages (session_id, role, content, kind, emotions, sentiment, cancelled, ts) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (session_id, role, content, kind, emotions, sentiment, int(cancelled), ts))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        # fold the new row (and anything another worker wrote before it) into the cache
+        self._session(session_id)
+        return cur.lastrowid
+
+    def get_summary(self, session_id):
+        """(summary, covered) for the session's rolling summary, or None."""
+        row = self._conn().execute(
+            'SELECT summary, covered FROM conversation_summaries WHERE session_id = ?', (session_id,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def save_summary(self, session_id, summary, covered):
+        conn = self._conn()
+        with self._write_lock:
+            conn.execute('INSERT OR IGNORE INTO conversations (session_id) VALUES (?)', (session_id,))
+            conn.execute(
+                'INSERT INTO conversation_summaries (session_id, summary, covered) VALUES (?, ?, ?) '
+                'ON CONFLICT(session_id) DO UPDATE SET summary = excluded.summary, covered = excluded.covered, '
+                "updated_at = datetime('now')",
+                (session_id, summary, covered))
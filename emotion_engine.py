@@ -0,0 +1,216 @@
+"""Streaming facial-emotion analysis built around the FER classifier.
+
+`fer.classes.Video.analyze` runs MTCNN on every sampled full frame and keeps a
+row per frame in memory. `EmotionEngine` instead decodes frames one at a time,
+searches for the face only inside a margin around the last known box (falling
+back to a full-frame search when the face is lost), classifies face crops in
+batches and keeps running per-emotion sums, so memory stays flat however long
+the clip is. In adaptive mode it samples less often while the emotion mix is
+stable and stops once the top-2 ranking has converged. With `timeline=True`
+it also keeps each face's timestamp and probabilities (see emotion_timeline).
+
+Face crops go through exactly the preprocessing of `FER.detect_emotions`:
+the box is squared and widened by the detector's offsets, then cut from the
+grayscale frame padded by `fer.fer.PADDING`. Batches go to the detector's
+`_classify_emotions`, so `fer` is pinned in requirements.txt.
+"""
+import sys
+
+import cv2
+import numpy as np
+
+# label order of FER's emotion model output
+EMOTIONS = ('angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral')
+
+
+class EmotionSummary:
+    def __init__(self, timeline=False):
+        self.sums = np.zeros(len(EMOTIONS), dtype=np.float64)
+        self.count = 0
+        self.frames_read = 0
+        self.frames_sampled = 0
+        self.full_detections = 0
+        self.tracked_detections = 0
+        self.stopped_early = False
+        self._times = [] if timeline else None
+        self._probs = [] if timeline else None
+
+    def add(self, probs, times=None):
+        self.sums += probs.sum(axis=0)
+        self.count += len(probs)
+        if self._times is not None and times is not None and len(times) == len(probs):
+            self._times.extend(times)
+            self._probs.append(probs.astype(np.float32))
+
+    def timeline(self):
+        """(times in seconds, probabilities shaped (faces, len(EMOTIONS))) of every
+        classified face, or None when the summary was not keeping a timeline."""
+        if self._times is None:
+            return None
+        probs = np.concatenate(self._probs) if self._probs else np.zeros((0, len(EMOTIONS)), dtype=np.float32)
+        return np.asarray(self._times, dtype=np.float32), probs
+
+    def means(self):
+        if not self.count:
+            return {}
+        return {label: round(float(v), 4) for label, v in zip(EMOTIONS, self.sums / self.count)}
+
+    def top(self, n=2):
+        if not self.count:
+            return []
+        order = np.argsort(-self.sums, kind='stable')
+        return [EMOTIONS[i] for i in order[:n]]
+
+    def as_dict(self):
+        return {
+            'emotions': self.top(2),
+            'means': self.means(),
+            'faces': self.count,
+            'frames_read': self.frames_read,
+            'frames_sampled': self.frames_sampled,
+            'full_detections': self.full_detections,
+            'tracked_detections': self.tracked_detections,
+            'stopped_early': self.stopped_early,
+        }
+
+
+class EmotionEngine:
+    def __init__(self, detector, frequency=15, batch_size=8, adaptive=False, max_frequency=120,
+                 min_faces=8, converge_batches=3, tolerance=0.02, track_margin=0.3, face_size=(64, 64)):
+        """`detector` is a `fer.FER` instance. Every `frequency`-th frame is
+        analysed; with `adaptive` the stride doubles (up to `max_frequency`)
+        after each batch whose mean distribution moved less than `tolerance`
+        (L1) without changing the top-2 ranking, resets on any change, and the
+        run stops once the ranking has held for `converge_batches` batches and
+        at least `min_faces` faces were classified."""
+        self.detector = detector
+        self.frequency = max(1, int(frequency))
+        self.batch_size = max(1, int(batch_size))
+        self.adaptive = adaptive
+        self.max_frequency = max(self.frequency, int(max_frequency))
+        self.min_faces = min_faces
+        self.converge_batches = converge_batches
+        self.tolerance = tolerance
+        self.track_margin = track_margin
+        self.face_size = tuple(getattr(detector, '_FER__emotion_target_size', face_size))
+        self.offsets = tuple(getattr(detector, '_FER__offsets', (10, 10)))
+        from fer.fer import PADDING  # already imported: `detector` is a FER
+        self.padding = PADDING
+
+    def analyze(self, video_path, timeline=False):
+        summary = EmotionSummary(timeline)
+        cap = cv2.VideoCapture(str(video_path))
+        if not cap.isOpened():
+            raise IOError(f"cannot open video: {video_path}")
+        fps = cap.get(cv2.CAP_PROP_FPS) or 0
+        box = None
+        batch = []
+        times = []
+        stride = self.frequency
+        next_frame = 0
+        stable_batches = 0
+        prev_means = None
+        prev_top = None
+        try:
+            while True:
+                # grab() advances without decoding to BGR; only sampled frames are retrieved
+                if not cap.grab():
+                    break
+                idx = summary.frames_read
+                summary.frames_read += 1
+                if idx < next_frame:
+                    continue
+                ok, frame = cap.retrieve()
+                if not ok:
+                    break
+                next_frame = idx + stride
+                summary.frames_sampled += 1
+
+                box = self._locate(frame, box, summary)
+                if box is None:
+                    continue
+                crop = self._face_crop(frame, box)
+                if crop is not None:
+                    batch.append(crop)
+                    if timeline:
+                        times.append(self._frame_time(cap, idx, fps))
+                if len(batch) < self.batch_size:
+                    continue
+
+                summary.add(self._classify(batch), times)
+                batch = []
+                times = []
+                if not self.adaptive:
+                    continue
+                means = summary.sums / summary.count
+                top = summary.top(2)
+                steady = prev_top == top and prev_means is not None and \
+                    float(np.abs(means - prev_means).sum()) < self.tolerance
+                stable_batches = stable_batches + 1 if steady else 0
+                stride = min(stride * 2, self.max_frequency) if steady else self.frequency
+                prev_means, prev_top = means, top
+                if stable_batches >= self.converge_batches and summary.count >= self.min_faces:
+                    summary.stopped_early = True
+                    break
+            if batch:
+                summary.add(self._classify(batch), times)
+        finally:
+            cap.release()
+        return summary
+
+    @staticmethod
+    def _frame_time(cap, idx, fps):
+        # container timestamps survive variable frame rates (MediaRecorder webm); fall back to
+        # idx / fps, assuming 30 fps when the container doesn't say
+        msec = cap.get(cv2.CAP_PROP_POS_MSEC)
+        if msec > 0 or idx == 0:
+            return msec / 1000.0
+        return idx / (fps if fps > 0 else 30.0)
+
+    def _locate(self, frame, box, summary):
+        """Find the face near the previous `box`, or in the whole frame when
+        there is no box yet or the face has left the tracked region."""
+        if box is not None:
+            h, w = frame.shape[:2]
+            x, y, bw, bh = box
+            mx, my = int(bw * self.track_margin), int(bh * self.track_margin)
+            x0, y0 = max(0, x - mx), max(0, y - my)
+            x1, y1 = min(w, x + bw + mx), min(h, y + bh + my)
+            found = self._largest(self.detector.find_faces(frame[y0:y1, x0:x1], bgr=True))
+            if found is not None:
+                summary.tracked_detections += 1
+                fx, fy, fw, fh = found
+                return (fx + x0, fy + y0, fw, fh)
+        summary.full_detections += 1
+        return self._largest(self.detector.find_faces(frame, bgr=True))
+
+    @staticmethod
+    def _largest(faces):
+        if faces is None or len(faces) == 0:
+            return None
+        x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+        return (int(x), int(y), int(w), int(h))
+
+    def _face_crop(self, frame, box):
+        # FER.detect_emotions step for step: pad the gray frame, square the box, add the
+        # offsets (x1/y1 may go negative before the padding shift), crop, resize, scale to [-1, 1]
+        gray = self.detector.pad(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        x, y, w, h = self.detector.tosquare(box)
+        ox, oy = self.offsets
+        x1, x2 = max(0, x - ox + self.padding), x + w + ox + self.padding
+        y1, y2 = max(0, y - oy + self.padding), y + h + oy + self.padding
+        face = gray[y1:y2, x1:x2]
+        if face.size == 0:
+            return None
+        face = cv2.resize(face, self.face_size).astype(np.float32) / 255.0
+        return (face - 0.5) * 2.0
+
+    def _classify(self, faces):
+        # (batch, h, w), the shape detect_emotions hands the classifier
+        batch = np.stack(faces)
+        try:
+            probs = self.detector._classify_emotions(batch)
+        except Exception as e:
+            print(f"batched emotion classification failed: {e}", file=sys.stderr)
+            return np.zeros((0, len(EMOTIONS)))
+        return np.asarray(probs, dtype=np.float64).reshape(len(faces), len(EMOTIONS))
@@ -0,0 +1,205 @@
+"""Per-frame emotion timelines and per-session aggregates.
+
+`EmotionEngine` can keep the probabilities of every classified face. They
+are written as one small `.npy` file per clip, named by the clip's content
+hash, so a re-submitted clip (a cache hit) points to the timeline that was
+already written. Each row is a timestamp (float32 seconds) followed by the
+seven emotion probabilities (float16), which is 18 bytes per face. Files are
+opened memory-mapped, so reading one costs only the pages actually touched.
+
+For every analysed session, `TimelineStore` computes the aggregates once:
+- per-emotion means and 10/50/90th percentiles
+- the share of frames each emotion dominates
+- the runs of consecutive frames with the same dominant emotion
+
+These are stored in the `emotion_sessions` table next to `uploads`. The means
+get their own columns, so a cross-session trend is a single indexed query
+that never touches a timeline file.
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from emotion_engine import EMOTIONS
+
+TIMELINE_DTYPE = np.dtype([('t', '<f4'), ('p', '<f2', (len(EMOTIONS),))])
+QUANTILES = (0.1, 0.5, 0.9)
+
+# mirrors schema.sql so a database the Node server hasn't initialised still works
+_SESSIONS_DDL = '''CREATE TABLE IF NOT EXISTS emotion_sessions (
+  id           INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id      INTEGER,
+  upload       TEXT UNIQUE,
+  content_hash TEXT NOT NULL,
+  recorded_at  INTEGER NOT NULL,
+  duration     REAL NOT NULL,
+  faces        INTEGER NOT NULL,
+  dominant     TEXT,
+''' + ''.join(f"  mean_{e} REAL NOT NULL,\n" for e in EMOTIONS) + '''  stats        TEXT NOT NULL,
+  FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+)'''
+_SESSIONS_INDEX = 'CREATE INDEX IF NOT EXISTS idx_emotion_sessions_user ON emotion_sessions(user_id, recorded_at)'
+
+
+def timeline_path(timeline_dir, content_hash):
+    return Path(timeline_dir) / f"{content_hash}.npy"
+
+
+def save_timeline(timeline_dir, content_hash, times, probs):
+    """Write the timeline for `content_hash` (times in seconds, probs shaped
+    (n, len(EMOTIONS))). The file is written under a temporary name and then
+    renamed, so readers never see a partial timeline."""
+    rows = np.empty(len(times), dtype=TIMELINE_DTYPE)
+    rows['t'] = times
+    rows['p'] = probs
+    dest = timeline_path(timeline_dir, content_hash)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(f"{dest.stem}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, 'wb') as f:
+        np.save(f, rows)
+    os.replace(tmp, dest)
+    return dest
+
+
+def load_timeline(timeline_dir, content_hash):
+    """The memory-mapped timeline for `content_hash`, or None if there is none."""
+    path = timeline_path(timeline_dir, content_hash)
+    if not path.exists():
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+def summarize(timeline):
+    """Session aggregates for a timeline (see the module docstring)."""
+    n = len(timeline)
+    if not n:
+        return None
+    t = np.asarray(timeline['t'], dtype=np.float64)
+    p = np.asarray(timeline['p'], dtype=np.float32)
+    means = p.mean(axis=0)
+    quantiles = np.quantile(p, QUANTILES, axis=0)
+    dominant = p.argmax(axis=1)
+
+    # a run lasts until the next run starts; the last one for one more typical sample gap
+    step = float(np.median(np.diff(t))) if n > 1 else 0.0
+    bounds = np.append(t, t[-1] + step)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(dominant)) + 1))
+    ends = np.append(starts[1:], n)
+    lengths = bounds[ends] - bounds[starts]
+    longest = {}
+    for s, seconds in zip(starts, lengths):
+        label = EMOTIONS[dominant[s]]
+        longest[label] = max(longest.get(label, 0.0), round(float(seconds), 2))
+
+    share = np.bincount(dominant, minlength=len(EMOTIONS)) / n
+    return {
+        'faces': n,
+        'duration': round(float(bounds[-1]), 2),
+        'dominant': EMOTIONS[int(means.argmax())],
+        'means': {e: round(float(v), 4) for e, v in zip(EMOTIONS, means)},
+        'quantiles': {f"p{int(q * 100)}": {e: round(float(v), 4) for e, v in zip(EMOTIONS, row)}
+                      for q, row in zip(QUANTILES, quantiles)},
+        'share': {e: round(float(v), 4) for e, v in zip(EMOTIONS, share)},
+        'longest_run': longest,
+        # [emotion, start, end] in seconds
+        'runs': [[EMOTIONS[dominant[s]], round(float(bounds[s]), 2), round(float(bounds[e]), 2)]
+                 for s, e in zip(starts, ends)],
+    }
+
+
+class TimelineStore:
+    def __init__(self, db_path, timeline_dir):
+        self.db_path = str(db_path)
+        self.timeline_dir = Path(timeline_dir)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(_SESSIONS_DDL)
+        conn.execute(_SESSIONS_INDEX)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def load(self, content_hash):
+        return load_timeline(self.timeline_dir, content_hash)
+
+    def record_session(self, content_hash, upload=None, user_id=None, recorded_at=None):
+        """Aggregate the timeline of `content_hash` and store it as a session of
+        `user_id` for `upload` (the stored file name). Re-recording the same
+        upload replaces its row. Returns the aggregates, or None when the clip
+        has no timeline (no face found, or analysed before timelines existed)."""
+        timeline = self.load(content_hash)
+        if timeline is None:
+            return None
+        stats = summarize(timeline)
+        if stats is None:
+            return None
+        cols = ['user_id', 'upload', 'content_hash', 'recorded_at', 'duration', 'faces', 'dominant'] + \
+            [f"mean_{e}" for e in EMOTIONS] + ['stats']
+        detail = {k: stats[k] for k in ('quantiles', 'share', 'longest_run', 'runs')}
+        values = [user_id, upload, content_hash, int(recorded_at or time.time()), stats['duration'],
+                  stats['faces'], stats['dominant']] + [stats['means'][e] for e in EMOTIONS] + [json.dumps(detail)]
+        updates = ', '.join(f"{c} = excluded.{c}" for c in cols if c != 'upload')
+        self._conn().execute(
+            f"INSERT INTO emotion_sessions ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))}) "
+            f"ON CONFLICT(upload) DO UPDATE SET {updates}", values)
+        return stats
+
+    def session(self, upload):
+        """Stored aggregates (including runs and quantiles) for one upload."""
+        row = self._conn().execute(
+            f"SELECT id, user_id, upload, recorded_at, duration, faces, dominant, "
+            f"{', '.join(f'mean_{e}' for e in EMOTIONS)}, stats FROM emotion_sessions WHERE upload = ?",
+            (upload,)).fetchone()
+        if row is None:
+            return None
+        out = self._row(row[:-1])
+        out.update(json.loads(row[-1]))
+        return out
+
+    @staticmethod
+    def _row(row):
+        keys = ('id', 'user_id', 'upload', 'recorded_at', 'duration', 'faces', 'dominant')
+        out = dict(zip(keys, row))
+        out['means'] = dict(zip(EMOTIONS, row[len(keys):]))
+        return out
+
+    def trend(self, user_id, sessions=10):
+        """The last `sessions` sessions of `user_id`, oldest first, with the mean
+        of each emotion across them and its least-squares slope per session."""
+        rows = self._conn().execute(
+            f"SELECT id, user_id, upload, recorded_at, duration, faces, dominant, "
+            f"{', '.join(f'mean_{e}' for e in EMOTIONS)} FROM emotion_sessions "
+            f"WHERE user_id = ? ORDER BY recorded_at DESC, id DESC LIMIT ?", (user_id, sessions)).fetchall()
+        rows.reverse()
+        out = {'user_id': user_id, 'sessions': [self._row(r) for r in rows], 'means': {}, 'slope': {}}
+        if not rows:
+            return out
+        values = np.array([r[7:] for r in rows], dtype=np.float64)
+        x = np.arange(len(rows)) - (len(rows) - 1) / 2
+        denom = float((x * x).sum())
+        for i, e in enumerate(EMOTIONS):
+            out['means'][e] = round(float(values[:, i].mean()), 4)
+            out['slope'][e] = round(float(x @ values[:, i]) / denom, 4) if denom else 0.0
+        return out
+
+
+def record_session_safe(store, content_hash, **kw):
+    """`record_session` for callers that must not fail the analysis over it."""
+    if store is None or not content_hash:
+        return None
+    try:
+        return store.record_session(content_hash, **kw)
+    except Exception as e:
+        print(f"recording emotion session failed: {e}", file=sys.stderr)
+        return None
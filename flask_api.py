@@ -4,7 +4,8 @@ import sys
 import time
 import json
 from pathlib import Path
-from flask import Flask, request, jsonify, send_from_directory
+import jwt
+from flask import Flask, Response, g, request, jsonify, send_from_directory, stream_with_context
 from werkzeug.utils import secure_filename
 
 ROOT = Path(__file__).resolve().parent
@@ -12,147 +13,406 @@ UPLOAD_DIR = ROOT / 'server' / 'uploads'
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 import traceback
+import importlib
+import threading
+
+import therapyAI
+import metrics
+from jobs import JobQueue, QueueFull
+from model_registry import registry
+from result_cache import hash_and_save
+from conversation_store import ConversationStore
+from upload_store import UploadStore, UploadError, RetentionManager
+from emotion_timeline import TimelineStore, record_session_safe
 
 app = Flask(__name__, static_folder=str(ROOT), static_url_path='')
 
 # Show traceback in JSON responses when debugging (default ON). Set SHOW_TRACE=0 to disable.
 SHOW_TRACE = os.environ.get('SHOW_TRACE', '1') != '0'
+# Load the FER/VADER models in the background at startup (default ON). Set WARMUP_MODELS=0 to load lazily.
+WARMUP_MODELS = os.environ.get('WARMUP_MODELS', '1') != '0'
+# Allow POST /admin/reload outside debug mode. Set ALLOW_RELOAD=1 to enable.
+ALLOW_RELOAD = os.environ.get('ALLOW_RELOAD', '0') == '1'
+# Background analysis pool for /record: number of worker threads and how many uploads may wait for one.
+RECORD_WORKERS = int(os.environ.get('RECORD_WORKERS', 2))
+RECORD_QUEUE_DEPTH = int(os.environ.get('RECORD_QUEUE_DEPTH', 8))
+# Seconds between SSE keep-alive comments while a job is idle.
+SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT', 15))
+# Secret the Node server signs its login tokens with; user-scoped routes accept the same bearer tokens.
+JWT_SECRET = os.environ.get('JWT_SECRET', 'dev-secret-change-me')
+# Attach a per-request `timings` breakdown to every JSON response (default OFF); a single
+# request can ask for it with ?timings=1 or an `X-Timings: 1` header.
+RESPONSE_TIMINGS = os.environ.get('RESPONSE_TIMINGS', '0') == '1'
 
+# therapyAI is looked up at call time so /admin/reload picks up the new module
+def _run_record(path, progress, timings=False, session=None, **kw):
+    # the job runs on a worker thread, outside the request that queued it, so it gets its own trace
+    with metrics.trace() as trace:
+        result = therapyAI.main(path, progress=progress, **kw)
+        if session is not None:
+            # aggregate the clip's emotion timeline once, for the cross-session trend queries
+            with metrics.span('emotions.session'):
+                record_session_safe(timelines, kw.get('content_hash'), **session)
+    if timings and trace is not None:
+        result['timings'] = trace.as_dict()
+    return result
 
-@app.route('/record', methods=['POST'])
-def record():
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file part'}), 400
-    f = request.files['file']
-    if f.filename == '':
-        return jsonify({'error': 'No selected file'}), 400
+
+record_jobs = JobQueue(_run_record, workers=RECORD_WORKERS, max_depth=RECORD_QUEUE_DEPTH, name='record')
+metrics.Gauge('therapyai_record_queue_depth', 'Uploads waiting for a /record worker.', fn=record_jobs.depth)
+
+
+def _want_timings():
+    return RESPONSE_TIMINGS or request.args.get('timings') == '1' or request.headers.get('X-Timings') == '1'
+
+
+@app.before_request
+def _start_request_trace():
+    if metrics.ENABLED:
+        g.metrics_started = time.perf_counter()
+        g.trace, g.trace_token = metrics.start_trace()
+
+
+@app.after_request
+def _finish_request_trace(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.HTTP_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method,
+                                 status=response.status_code)
+    trace = g.get('trace')
+    if trace is not None and _want_timings() and response.is_json and not response.is_streamed:
+        data = response.get_json(silent=True)
+        if isinstance(data, dict):
+            data['timings'] = trace.as_dict()
+            response.set_data(json.dumps(data))
+    return response
+
+
+@app.teardown_request
+def _end_request_trace(exc):
+    metrics.end_trace(g.pop('trace_token', None))
+
+
+def start_warmup():
+    t = threading.Thread(target=registry.warm_up, name='model-warmup', daemon=True)
+    t.start()
+    return t
+
+
+def start_background():
+    """Model warm-up and the retention sweeper, started once per serving process.
+    Importing this module starts neither; the entry points below do."""
+    if WARMUP_MODELS:
+        start_warmup()
+    if UPLOAD_RETENTION:
+        retention.start()
+
+
+def serve():
+    """WSGI factory (`gunicorn 'flask_api:serve()'`): the app with its background services running."""
+    start_background()
+    return app
+
+
+def _save_upload(f, user_id=None):
+    """Save a single-request (multipart) upload and record it; returns (path, sha256)."""
     name = secure_filename(f.filename)
     stamp = int(time.time() * 1000)
     stored = f"{stamp}-{name}"
     dest = UPLOAD_DIR / stored
-    f.save(dest)
-    app.logger.info(f"Saved upload: {dest}")
+    # hash while writing so the result cache can key the clip without re-reading it
+    with metrics.span('upload.save'):
+        digest = hash_and_save(f.stream, dest)
+    uploads.register(stored, f.filename, dest.stat().st_size, digest, user_id=user_id)
+    app.logger.info(f"Saved upload: {dest} sha256={digest}")
+    return dest, digest
+
+
+def _upload_param():
+    return request.form.get('upload') or request.args.get('upload')
+
+
+def _upload_error(e):
+    return jsonify({'error': str(e), **e.info}), e.status
+
 
-    # Run local analysis by calling therapyAI.main(filepath)
+def _token_user():
+    """User id from a valid `Authorization: Bearer` token (signed by the Node
+    server), else None. Never taken from a client-supplied field."""
+    hdr = request.headers.get('Authorization', '')
+    if not hdr.startswith('Bearer '):
+        return None
     try:
-        import importlib
-        therapyAI = importlib.import_module('therapyAI')
-        importlib.reload(therapyAI)
-        res = therapyAI.main(str(dest))
-        return jsonify(res)
-    except Exception as e:
-        app.logger.exception('analysis failed')
-        resp = {'error': 'analysis failed', 'detail': str(e)}
-        if SHOW_TRACE:
-            resp['trace'] = traceback.format_exc()
-        return jsonify(resp), 500
+        user_id = jwt.decode(hdr[7:], JWT_SECRET, algorithms=['HS256']).get('id')
+    except jwt.InvalidTokenError:
+        return None
+    return user_id if isinstance(user_id, int) else None
 
 
-# Simple in-memory conversation store: { session_id: [ {role, content, ts} ] }
-conversations = {}
+@app.route('/record', methods=['POST'])
+def record():
+    """Analyse a video: either a multipart `file`, or `upload=<id>` naming a completed
+    chunked upload (see /upload), which is analysed in place. With a bearer token
+    the upload and its emotion aggregates are filed under that user (see /emotions/trend)."""
+    user_id = _token_user()
+    upload_id = _upload_param()
+    if upload_id:
+        try:
+            path, digest = uploads.completed(upload_id, user_id=user_id)
+        except UploadError as e:
+            return _upload_error(e)
+        dest = Path(path)
+    else:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file part'}), 400
+        f = request.files['file']
+        if f.filename == '':
+            return jsonify({'error': 'No selected file'}), 400
+        dest, digest = _save_upload(f, user_id)
 
+    # Queue the analysis and return immediately; clients poll /jobs/<id> or stream /jobs/<id>/events
+    try:
+        job = record_jobs.submit(str(dest), content_hash=digest, timings=_want_timings(),
+                                 session={'upload': dest.name, 'user_id': user_id})
+    except QueueFull as e:
+        app.logger.warning(f"rejecting upload {dest}: {e}")
+        if not upload_id:
+            # a chunked upload stays on disk so the client can retry without re-sending it
+            dest.unlink(missing_ok=True)
+            uploads.mark_deleted(dest.name)
+        resp = jsonify({'error': 'server busy', 'detail': str(e)})
+        resp.headers['Retry-After'] = '5'
+        return resp, 429
+    return jsonify({
+        'job': job.id,
+        'status': job.status,
+        'status_url': f"/jobs/{job.id}",
+        'events_url': f"/jobs/{job.id}/events",
+    }), 202
 
-@app.route('/chat', methods=['GET','POST'])
-def chat_endpoint():
-    """Accepts: form fields: session (optional), text (optional), file (optional)
-    If a file is provided, run full analysis (therapyAI.main) on it to extract text/emotions/sentiment.
-    The user's message will be the provided text or the transcribed audio from the uploaded file.
-    Returns the assistant reply and the full conversation history for the session.
-    """
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = record_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'unknown job'}), 404
+    snap = job.snapshot()
+    if job.status == 'failed' and not SHOW_TRACE:
+        snap['error'].pop('trace', None)
+    return jsonify(snap)
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-sent events: one `progress` event per stage update, ending with the
+    job's `done` or `failed` event. Honours Last-Event-ID so clients can resume."""
+    job = record_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'unknown job'}), 404
+    try:
+        after = int(request.headers.get('Last-Event-ID') or request.args.get('after') or 0)
+    except ValueError:
+        after = 0
+
+    def stream():
+        seen = after
+        while True:
+            events = job.wait_events(seen, timeout=SSE_HEARTBEAT)
+            if not events:
+                if job.done:
+                    return
+                yield ': keep-alive\n\n'
+                continue
+            for ev in events:
+                seen = ev['seq']
+                yield f"id: {ev['seq']}\nevent: progress\ndata: {json.dumps(ev)}\n\n"
+            if job.done and seen >= len(job.events):
+                return
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Chat history lives in the app database next to users/uploads; recently active
+# sessions are cached in memory (CONVERSATION_CACHE sessions per process).
+DATA_DB = os.environ.get('DATA_DB', str(ROOT / 'server' / 'data.sqlite3'))
+conversations = ConversationStore(DATA_DB, schema_path=ROOT / 'server' / 'schema.sql',
+                                  cache_size=int(os.environ.get('CONVERSATION_CACHE', 256)))
+
+# Chunked uploads are written into UPLOAD_DIR and recorded, with single-request uploads, in `uploads`.
+# MAX_UPLOAD_MB caps one upload.
+MB = 1024 * 1024
+uploads = UploadStore(DATA_DB, UPLOAD_DIR, max_bytes=int(float(os.environ.get('MAX_UPLOAD_MB', 1024)) * MB))
+# Per-session emotion aggregates (emotion_sessions) over the timelines therapyAI writes
+timelines = TimelineStore(DATA_DB, therapyAI.EMOTION_TIMELINE_DIR)
+# Background disk retention for uploads (default ON, UPLOAD_RETENTION=0 disables): files older than
+# UPLOAD_MAX_AGE_DAYS go first, then the oldest until the swept directories fit in UPLOAD_QUOTA_MB.
+# output/ holds committed sample recordings, so it is only swept with UPLOAD_SWEEP_OUTPUT=1.
+UPLOAD_RETENTION = os.environ.get('UPLOAD_RETENTION', '1') != '0'
+UPLOAD_SWEEP_OUTPUT = os.environ.get('UPLOAD_SWEEP_OUTPUT', '0') == '1'
+retention = RetentionManager(
+    uploads, [UPLOAD_DIR] + ([ROOT / 'output'] if UPLOAD_SWEEP_OUTPUT else []),
+    max_age=float(os.environ.get('UPLOAD_MAX_AGE_DAYS', 30)) * 86400,
+    max_bytes=int(float(os.environ.get('UPLOAD_QUOTA_MB', 2048)) * MB),
+    stale_upload=float(os.environ.get('UPLOAD_STALE_HOURS', 24)) * 3600,
+    interval=float(os.environ.get('UPLOAD_SWEEP_SECONDS', 600)),
+    # never delete a clip that is still waiting for (or in) analysis
+    protect=lambda: [job.args[0] for job in record_jobs.active()],
+)
+
+
+@app.route('/upload', methods=['POST'])
+def upload_create():
+    """Start a chunked upload. JSON or form fields: filename, size (optional, bytes).
+    Returns the upload id, the current offset (0) and the URL to PUT chunks to."""
+    data = request.get_json(silent=True) or request.form
+    filename = data.get('filename')
+    if not filename:
+        return jsonify({'error': 'filename required'}), 400
+    try:
+        size = int(data['size']) if data.get('size') not in (None, '') else None
+        status = uploads.create(filename, size)
+    except ValueError:
+        return jsonify({'error': 'size must be an integer'}), 400
+    except UploadError as e:
+        return _upload_error(e)
+    status['url'] = f"/upload/{status['id']}"
+    return jsonify(status), 201
+
+
+@app.route('/upload/<upload_id>', methods=['GET', 'PUT'])
+def upload_chunk(upload_id):
+    """GET reports the offset to resume from. PUT appends the raw request body at the
+    offset given in the `Upload-Offset` header (409 with the right offset if it differs)."""
+    try:
+        if request.method == 'GET':
+            return jsonify(uploads.status(upload_id))
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            return jsonify({'error': 'Upload-Offset header required'}), 400
+        with metrics.span('upload.chunk'):
+            return jsonify(uploads.write(upload_id, offset, request.stream))
+    except UploadError as e:
+        return _upload_error(e)
+
+
+@app.route('/upload/<upload_id>/complete', methods=['POST'])
+def upload_complete(upload_id):
+    """Finish a chunked upload (optionally verifying a client-computed `sha256`).
+    The upload id can then be passed as `upload` to /record, /chat or /chat/stream.
+    With a bearer token the upload is filed under that user."""
+    data = request.get_json(silent=True) or request.form
+    try:
+        done = uploads.complete(upload_id, sha256=data.get('sha256'), user_id=_token_user())
+    except UploadError as e:
+        return _upload_error(e)
+    return jsonify({'id': done['id'], 'sha256': done['sha256'], 'size': done['size'],
+                    'url': f"/uploads/{done['stored_as']}"})
+
+
+def _start_turn():
+    """Shared front half of /chat and /chat/stream: resolve the session, analyse an
+    uploaded reply (if any) and record the user's message.
+    Returns (turn, None) on success or (None, error_response)."""
     session_id = request.form.get('session') or request.args.get('session')
     if not session_id:
         # create a lightweight session id
         session_id = str(int(time.time() * 1000))
 
-    # ensure session exists
-    conversations.setdefault(session_id, [])
-
-    # GET returns the current history for the session (if any)
-    if request.method == 'GET':
-        return jsonify({'session': session_id, 'history': conversations.get(session_id, [])})
-
     user_text = request.form.get('text')
-    saved_file = None
+    analysis = None
 
-    # if file uploaded, save and analyze to derive text + emotions
-    if 'file' in request.files:
+    # if a file was uploaded (in this request, or earlier as a chunked upload), analyze it to derive text
+    saved = None
+    upload_id = _upload_param()
+    if upload_id:
+        try:
+            saved = uploads.completed(upload_id)
+        except UploadError as e:
+            return None, _upload_error(e)
+    elif 'file' in request.files:
         f = request.files['file']
         if f and f.filename:
-            name = secure_filename(f.filename)
-            stamp = int(time.time() * 1000)
-            stored = f"{stamp}-{name}"
-            dest = UPLOAD_DIR / stored
-            f.save(dest)
-            app.logger.info(f"Saved chat upload: {dest}")
-            saved_file = str(dest)
-            try:
-                import importlib
-                therapyAI = importlib.import_module('therapyAI')
-                importlib.reload(therapyAI)
-                # For chat-uploaded videos (user reply), only transcribe the audio and determine sentiment.
-                # Skip facial emotion analysis to avoid making judgments based on the user's face for chat replies.
-                transcript_text = None
-                try:
-                    transcript_text = therapyAI.transcribe_audio(saved_file)
-                except Exception as e:
-                    # bubble transcription error up
-                    raise
-
-                sentiment = therapyAI.determine_sentiment(transcript_text or "")
-                analysis = {'text': transcript_text, 'sentiment': sentiment, 'emotions': []}
-
-                # if no explicit text provided, use transcription
-                if not user_text and isinstance(analysis.get('text'), str):
-                    user_text = analysis.get('text')
-
-                # store the analysis metadata as a system message for context (no facial emotions)
-                meta_msg = {
-                    'role': 'system',
-                    'content': f"[Video analysis] emotions={analysis.get('emotions')} sentiment={analysis.get('sentiment')}"
-                }
-                conversations[session_id].append({ 'role': meta_msg['role'], 'content': meta_msg['content'], 'ts': int(time.time()) })
-            except Exception as e:
-                app.logger.exception('chat analysis failed')
-                if SHOW_TRACE:
-                    return jsonify({'error': 'analysis failed', 'detail': str(e), 'trace': traceback.format_exc()}), 500
-                return jsonify({'error': 'analysis failed', 'detail': str(e)}), 500
+            saved = _save_upload(f)
+    if saved:
+        saved_file, digest = str(saved[0]), saved[1]
+        try:
+            # For chat-uploaded videos (user reply), only transcribe the audio and determine sentiment.
+            # Skip facial emotion analysis to avoid making judgments based on the user's face for chat replies.
+            # Both stages are served from the result cache when this clip was seen before.
+            analysis = therapyAI.analyze_reply(saved_file, content_hash=digest)
+
+            # if no explicit text provided, use transcription
+            if not user_text and isinstance(analysis.get('text'), str):
+                user_text = analysis.get('text')
+
+            # store the analysis as a system message for context (no facial emotions); the values
+            # go in structured columns, the text is only for display and the model prompt
+            conversations.append(
+                session_id, 'system',
+                f"[Video analysis] emotions={analysis.get('emotions')} sentiment={analysis.get('sentiment')}",
+                analysis={'emotions': analysis.get('emotions'), 'sentiment': analysis.get('sentiment')})
+        except Exception as e:
+            app.logger.exception('chat analysis failed')
+            if SHOW_TRACE:
+                return None, (jsonify({'error': 'analysis failed', 'detail': str(e), 'trace': traceback.format_exc()}), 500)
+            return None, (jsonify({'error': 'analysis failed', 'detail': str(e)}), 500)
 
     # require some text to produce a reply
     if not user_text:
-        return jsonify({'error': 'no text or file provided'}), 400
+        return None, (jsonify({'error': 'no text or file provided'}), 400)
+
+    # Build history for chatbot (exclude ts); the new user message is passed separately
+    history = [{'role': m['role'], 'content': m['content']} for m in conversations.history(session_id) if m.get('role') in ('user','assistant','system')]
 
     # append user message to history
-    conversations[session_id].append({'role': 'user', 'content': user_text, 'ts': int(time.time())})
+    conversations.append(session_id, 'user', user_text)
+
+    # last-known emotions/sentiment for the session
+    emotions, sentiment = conversations.last_analysis(session_id)
+    turn = {
+        'session': session_id,
+        'text': user_text,
+        'history': history,
+        'emotions': emotions,
+        'sentiment': sentiment,
+        'analysis': analysis,
+    }
+    return turn, None
+
+
+@app.route('/chat', methods=['GET','POST'])
+def chat_endpoint():
+    """Accepts: form fields: session (optional), text (optional), file (optional)
+    If a file is provided, transcribe it and score its sentiment (no facial emotion analysis).
+    The user's message will be the provided text or the transcribed audio from the uploaded file.
+    Returns the assistant reply and the full conversation history for the session.
+    """
+    # GET returns the current history for the session (if any)
+    if request.method == 'GET':
+        session_id = request.args.get('session') or str(int(time.time() * 1000))
+        return jsonify({'session': session_id, 'history': conversations.history(session_id)})
 
-    # Build history for chatbot (exclude ts)
-    history = [{'role': m['role'], 'content': m['content']} for m in conversations[session_id] if m.get('role') in ('user','assistant','system')]
+    turn, error = _start_turn()
+    if error:
+        return error
+    session_id = turn['session']
 
     try:
-        import importlib
-        therapyAI = importlib.import_module('therapyAI')
-        importlib.reload(therapyAI)
-        # use last-known emotions/sentiment if available by scanning system meta messages
-        emotions = None
-        sentiment = 'neutral'
-        # simple parsing of last system meta
-        for m in reversed(conversations[session_id]):
-            if m['role'] == 'system' and m['content'].startswith('[Video analysis]'):
-                # parse basic key=val pairs
-                parts = m['content'].replace('[Video analysis]','').strip().split()
-                for p in parts:
-                    if p.startswith('emotions='):
-                        try:
-                            emotions = eval(p.split('=',1)[1])
-                        except Exception:
-                            emotions = None
-                    if p.startswith('sentiment='):
-                        sentiment = p.split('=',1)[1]
-                break
-
-        reply = therapyAI.chatbot_response(emotions, sentiment, user_text, history=history)
+        # rolling prompt summaries are persisted alongside the history
+        reply = therapyAI.chatbot_response(turn['emotions'], turn['sentiment'], turn['text'],
+                                           history=turn['history'], session_id=session_id,
+                                           summary_store=conversations)
         # store assistant reply
-        conversations[session_id].append({'role': 'assistant', 'content': reply, 'ts': int(time.time())})
-        return jsonify({'session': session_id, 'reply': reply, 'history': conversations[session_id]})
+        conversations.append(session_id, 'assistant', reply)
+        resp = {'session': session_id, 'reply': reply, 'history': conversations.history(session_id)}
+        if turn['analysis'] is not None:
+            # per-stage cache hit/miss for the uploaded reply
+            resp['cache'] = turn['analysis'].get('cache')
+        return jsonify(resp)
     except Exception as e:
         app.logger.exception('chat failed')
         resp = {'error': 'chat failed', 'detail': str(e)}
@@ -161,6 +421,135 @@ def chat_endpoint():
         return jsonify(resp), 500
 
 
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream_endpoint():
+    """Same inputs as POST /chat, but the reply is streamed as server-sent events:
+    a `token` event per generated piece, then one `done` event carrying the full
+    reply, the session history and time-to-first-token / tokens-per-second.
+    The assistant message is stored once the stream finishes or the client disconnects."""
+    turn, error = _start_turn()
+    if error:
+        return error
+    session_id = turn['session']
+    stream = therapyAI.chatbot_stream(turn['emotions'], turn['sentiment'], turn['text'],
+                                      history=turn['history'], session_id=session_id, summary_store=conversations)
+
+    def generate():
+        try:
+            yield _sse('start', {'session': session_id, 'cache': (turn['analysis'] or {}).get('cache')})
+            for piece in stream:
+                yield _sse('token', {'t': piece})
+            stats = stream.stats()
+            if stream.error:
+                reply = stream.text or f"(chatbot error: {stream.error})"
+            else:
+                reply = stream.text
+            _store_reply(reply, stats)
+            app.logger.info(f"chat stream {session_id}: ttft={stats['ttft_ms']}ms tokens={stats['tokens']} tok/s={stats['tokens_per_sec']}")
+            yield _sse('done', {'session': session_id, 'reply': reply, 'history': conversations.history(session_id), **stats})
+        finally:
+            # client went away mid-reply: keep what was generated so far
+            if not stream.done and stream.error is None:
+                stream.close()
+                _store_reply(stream.text, stream.stats(), cancelled=True)
+
+    stored = []
+
+    def _store_reply(reply, stats, cancelled=False):
+        if stored or not reply:
+            return
+        stored.append(True)
+        if cancelled:
+            app.logger.info(f"chat stream {session_id} cancelled after {stats['tokens']} tokens")
+        conversations.append(session_id, 'assistant', reply, cancelled=cancelled)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/webhooks/assemblyai', methods=['POST'])
+def assemblyai_webhook():
+    """AssemblyAI completion callback (set TRANSCRIBE_WEBHOOK_URL to this route's public URL).
+    Wakes the request waiting on the transcript so it skips the rest of its poll backoff."""
+    data = request.get_json(silent=True) or {}
+    transcript_id = data.get('transcript_id')
+    if not transcript_id:
+        return jsonify({'error': 'missing transcript_id'}), 400
+    woke = therapyAI.transcriber.notify(transcript_id, secret=request.headers.get('X-Webhook-Secret'))
+    return jsonify({'ok': woke})
+
+
+@app.route('/emotions/trend')
+def emotion_trend():
+    """Emotion trend of the signed-in user (bearer token) over their last `sessions`
+    (default 10) recordings: per-session means and dominant emotion, plus the overall
+    mean and per-session slope of each emotion. Answered from the precomputed
+    aggregates in emotion_sessions."""
+    user_id = _token_user()
+    if user_id is None:
+        return jsonify({'error': 'valid bearer token required'}), 401
+    try:
+        sessions = int(request.args.get('sessions', 10))
+    except ValueError:
+        return jsonify({'error': 'sessions must be an integer'}), 400
+    return jsonify(timelines.trend(user_id, max(1, min(sessions, 500))))
+
+
+@app.route('/emotions/sessions/<path:upload>')
+def emotion_session(upload):
+    """Stored aggregates of one of the signed-in user's recordings (by stored file
+    name), including the per-emotion quantiles and the dominant-emotion runs."""
+    user_id = _token_user()
+    if user_id is None:
+        return jsonify({'error': 'valid bearer token required'}), 401
+    session = timelines.session(upload)
+    # someone else's (or an anonymous) session answers like a missing one
+    if session is None or session['user_id'] != user_id:
+        return jsonify({'error': 'unknown session'}), 404
+    return jsonify(session)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint: stage/span latency histograms, FER frame, transcription
+    poll and chatbot token counters, cache hits and HTTP handler latency."""
+    if not metrics.ENABLED:
+        return jsonify({'error': 'metrics disabled (METRICS=0)'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/ready')
+def ready():
+    """Readiness probe: 200 once the analysis models are loaded, 503 before."""
+    ok = registry.is_ready()
+    return jsonify({'ready': ok, 'models': registry.status()}), (200 if ok else 503)
+
+
+def _retire_pipelines(pipes, poll=1.0):
+    """Shut down the pipelines of a replaced therapyAI module once their runs have finished."""
+    while any(p.active() for p in pipes):
+        time.sleep(poll)
+    for p in pipes:
+        p.shutdown(wait=True)
+
+
+@app.route('/admin/reload', methods=['POST'])
+def reload_models():
+    """Development hook: re-import therapyAI and rebuild the cached models."""
+    if not (app.debug or ALLOW_RELOAD):
+        return jsonify({'error': 'reload disabled'}), 403
+    # the reload builds fresh pipelines (and pool); runs already in flight keep using the old ones
+    retired = [therapyAI.pipeline, therapyAI.reply_pipeline]
+    importlib.reload(therapyAI)
+    threading.Thread(target=_retire_pipelines, args=(retired,), name='pipeline-retire', daemon=True).start()
+    ok = registry.reload()
+    return jsonify({'ready': ok, 'models': registry.status()}), (200 if ok else 503)
+
+
 # Serve uploaded files
 @app.route('/uploads/<path:fname>')
 def uploaded_file(fname):
@@ -179,4 +568,7 @@ def catch_all(path):
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
+    # with debug=True the werkzeug reloader parent only watches files; start work in the serving child
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background()
     app.run(host='0.0.0.0', port=port, debug=True)
@@ -0,0 +1,152 @@
+"""Bounded background job queue for long-running analysis requests.
+
+`POST /record` used to hold a Flask request thread for the whole pipeline. The
+upload is now handed to a `JobQueue`, which runs it on a fixed pool of worker
+threads and records per-stage progress events that clients can poll or stream.
+"""
+import queue
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+
+class QueueFull(Exception):
+    """Raised by `JobQueue.submit` when the backlog is at its configured depth."""
+
+
+class Job:
+    TERMINAL = ('done', 'failed')
+
+    def __init__(self, args, kwargs):
+        self.id = uuid.uuid4().hex
+        self.args = args
+        self.kwargs = kwargs
+        self.status = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.events = []
+        self._cond = threading.Condition()
+
+    def emit(self, stage, status, **info):
+        """Progress callback handed to the job function: record one event and
+        wake any stream waiting on this job."""
+        with self._cond:
+            event = {'seq': len(self.events) + 1, 'ts': time.time(), 'stage': stage, 'status': status}
+            event.update(info)
+            self.events.append(event)
+            self._cond.notify_all()
+        return event
+
+    def set_status(self, status, **info):
+        # status change and its event are published together so streams never
+        # see a finished job without its final event
+        with self._cond:
+            self.status = status
+            if status == 'running':
+                self.started = time.time()
+            if status in self.TERMINAL:
+                self.finished = time.time()
+            return self.emit('job', status, **info)
+
+    @property
+    def done(self):
+        return self.status in self.TERMINAL
+
+    def wait_events(self, after=0, timeout=None):
+        """Return events with seq > `after`, blocking up to `timeout` seconds
+        when there are none yet and the job is still running."""
+        with self._cond:
+            if len(self.events) <= after and not self.done:
+                self._cond.wait(timeout)
+            return self.events[after:]
+
+    def snapshot(self):
+        with self._cond:
+            out = {
+                'job': self.id,
+                'status': self.status,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+                'events': list(self.events),
+            }
+            if self.status == 'done':
+                out['result'] = self.result
+            if self.status == 'failed':
+                out['error'] = dict(self.error)
+            return out
+
+
+class JobQueue:
+    def __init__(self, fn, workers=2, max_depth=8, ttl=3600, name='jobs'):
+        """Run `fn(*args, progress=job.emit, **kwargs)` for each submitted job on
+        `workers` threads. At most `max_depth` jobs may wait for a worker; more
+        submissions raise `QueueFull`. Finished jobs are kept for `ttl` seconds."""
+        self.fn = fn
+        self.max_depth = max_depth
+        self.ttl = ttl
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, *args, **kwargs):
+        job = Job(args, kwargs)
+        self._prune()
+        # register and announce before enqueueing so a fast worker can't overtake the 'queued' event
+        with self._lock:
+            self._jobs[job.id] = job
+        job.set_status('queued', position=self._queue.qsize() + 1)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+            raise QueueFull(f"job queue is full ({self.max_depth} waiting)")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def active(self):
+        """Jobs that are queued or running."""
+        with self._lock:
+            return [j for j in self._jobs.values() if j.status not in Job.TERMINAL]
+
+    def stats(self):
+        with self._lock:
+            running = sum(1 for j in self._jobs.values() if j.status == 'running')
+        return {'queued': self.depth(), 'running': running, 'workers': len(self._threads), 'max_depth': self.max_depth}
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished < cutoff]:
+                del self._jobs[job_id]
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job.set_status('running')
+            try:
+                job.result = self.fn(*job.args, progress=job.emit, **job.kwargs)
+                job.set_status('done', result=job.result)
+            except Exception as e:
+                print(f"job {job.id} failed: {e}", file=sys.stderr)
+                job.error = {'error': 'analysis failed', 'detail': str(e), 'trace': traceback.format_exc()}
+                job.set_status('failed', error=str(e))
+            finally:
+                self._queue.task_done()
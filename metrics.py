@@ -0,0 +1,268 @@
+"""Counters, histograms and request traces for the analysis server.
+
+Code times a piece of work with `span(name)`. Each span is observed in the
+`therapyai_span_seconds` histogram. When a `trace()` is active in the current
+context (a Flask request or a /record job), the span is also appended to that
+trace, which can then be returned as a per-request timing breakdown. Pipeline
+stages run inside a copy of the caller's context, so their spans land in the
+same trace. `render()` produces the Prometheus text format served at `/metrics`.
+
+With METRICS=0 every entry point returns at once and `span()` hands back a
+shared no-op object, so the instrumentation costs a single attribute check.
+"""
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+ENABLED = os.environ.get('METRICS', '1') != '0'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_metrics = []
+
+
+def _fmt_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _fmt_value(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_one(key, value))
+        return lines
+
+    def _render_one(self, key, value):
+        return [f"{self.name}{_fmt_labels(self.labels, key)} {_fmt_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn=None):
+        """A gauge read at scrape time from `fn()`."""
+        super().__init__(name, help)
+        self.fn = fn
+
+    def render(self):
+        if self.fn is None:
+            return []
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {_fmt_value(value)}"]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = entry[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def _render_one(self, key, entry):
+        counts, total, count = entry
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, ('le', _fmt_value(float(bound))))} {cumulative}")
+        lines.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, ('le', '+Inf'))} {count}")
+        lines.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {_fmt_value(total)}")
+        lines.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {count}")
+        return lines
+
+
+SPAN_SECONDS = Histogram('therapyai_span_seconds', 'Duration of instrumented work (pipeline stages, model calls).',
+                         ('span', 'outcome'))
+CACHE_LOOKUPS = Counter('therapyai_cache_lookups_total', 'Result cache lookups per stage.', ('stage', 'result'))
+TRANSCRIBE_POLLS = Histogram('therapyai_transcribe_polls', 'Status polls per transcription.',
+                             buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55))
+UPLOAD_BYTES = Histogram('therapyai_transcribe_upload_bytes', 'Bytes uploaded per transcription.',
+                         buckets=(64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6))
+FER_FRAMES = Counter('therapyai_fer_frames_total', 'Video frames decoded (read) and analysed (sampled) by FER.', ('kind',))
+FER_FACES = Counter('therapyai_fer_faces_total', 'Faces classified by FER.')
+CHAT_TOKENS = Counter('therapyai_chat_tokens_total', 'Chatbot prompt and completion tokens.', ('kind', 'mode'))
+CHAT_TTFT = Histogram('therapyai_chat_ttft_seconds', 'Time to first streamed chatbot token.')
+HTTP_SECONDS = Histogram('therapyai_http_request_seconds', 'Flask handler duration.', ('endpoint', 'method', 'status'))
+
+
+class Trace:
+    """Spans recorded while this trace was current, for a per-request breakdown."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self.attrs = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, attrs=None, error=False):
+        span = {'name': name, 'ms': round(seconds * 1000, 1)}
+        if attrs:
+            span.update(attrs)
+        if error:
+            span['error'] = True
+        with self._lock:
+            self.spans.append(span)
+
+    def annotate(self, name, **attrs):
+        with self._lock:
+            self.attrs.setdefault(name, {}).update(attrs)
+
+    def as_dict(self):
+        with self._lock:
+            spans = [dict(s, **self.attrs.get(s['name'], {})) for s in self.spans]
+        return {'total_ms': round((time.perf_counter() - self.started) * 1000, 1), 'spans': spans}
+
+
+_current = contextvars.ContextVar('therapyai_trace', default=None)
+
+
+def start_trace():
+    """Make a new trace current; returns (trace, token) for `end_trace`."""
+    if not ENABLED:
+        return None, None
+    t = Trace()
+    return t, _current.set(t)
+
+
+def end_trace(token):
+    if token is not None:
+        _current.reset(token)
+
+
+@contextmanager
+def trace():
+    t, token = start_trace()
+    try:
+        yield t
+    finally:
+        end_trace(token)
+
+
+def record(name, seconds, error=False, observe=True, **attrs):
+    """Record a finished span measured elsewhere (e.g. a pipeline stage).
+    `observe=False` adds it to the current trace only, keeping the histogram
+    free of e.g. zero-length cache hits."""
+    if not ENABLED:
+        return
+    if observe:
+        SPAN_SECONDS.observe(seconds, span=name, outcome='error' if error else 'ok')
+    t = _current.get()
+    if t is not None:
+        t.add(name, seconds, attrs, error)
+
+
+def annotate(name, **attrs):
+    """Attach attributes (frames, polls, tokens, ...) to span `name` of the current trace."""
+    if not ENABLED:
+        return
+    t = _current.get()
+    if t is not None:
+        t.annotate(name, **attrs)
+
+
+class _Span:
+    __slots__ = ('name', 'attrs', 'started')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record(self.name, time.perf_counter() - self.started, error=exc_type is not None, **self.attrs)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **attrs):
+    """Context manager timing the enclosed block as span `name`; `.set(**attrs)`
+    adds attributes to it."""
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name, attrs)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for m in list(_metrics):
+        lines.extend(m.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,279 @@
+"""Local stand-ins for the external services the pipeline talks to.
+
+`MockAssemblyAI` implements the `/v2/upload` and `/v2/transcript` endpoints
+closely enough for `transcription.TranscriptionClient` to run against it
+offline: transcripts stay 'processing' for a configurable time, completed ones
+include word timestamps, and webhooks are delivered when requested.
+
+`MockOllama` answers `/api/chat` like a local Ollama server, either in one
+response or streamed as NDJSON at a configurable token rate.
+
+    python mock_services.py assemblyai --port 8701
+    python mock_services.py ollama --port 8702
+    ASSEMBLYAI_BASE_URL=http://127.0.0.1:8701 OLLAMA_HOST=http://127.0.0.1:8702 python flask_api.py
+"""
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+DEFAULT_TEXT = "I have been feeling a bit overwhelmed at work lately but talking about it helps."
+DEFAULT_REPLY = (
+    "It sounds like work has been weighing on you, and it's good that talking about it helps. "
+    "What part of the week feels the heaviest? One small step could be to write down the tasks "
+    "that worry you most and pick just one to tackle first tomorrow."
+)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        if self.server.service.verbose:
+            super().log_message(fmt, *args)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            return self.rfile.read(length)
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            parts = []
+            while True:
+                size = int(self.rfile.readline().strip() or b'0', 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(parts)
+        return b''
+
+    def _json(self, status, obj):
+        data = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_chunked(self, status, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def _end_chunked(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def do_POST(self):
+        self.server.service.handle(self, 'POST')
+
+    def do_GET(self):
+        self.server.service.handle(self, 'GET')
+
+
+class MockService:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, verbose=False):
+        """`latency` seconds are added to every request before it is answered."""
+        self.latency = latency
+        self.verbose = verbose
+        self.requests = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.service = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def count(self, route):
+        with self._lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+
+    def handle(self, h, method):
+        if self.latency:
+            time.sleep(self.latency)
+        route = self.route(h, method)
+        if route is None:
+            h._json(404, {'error': f"no route for {method} {h.path}"})
+
+
+class MockAssemblyAI(MockService):
+    def __init__(self, processing_seconds=1.0, text=DEFAULT_TEXT, words_per_second=2.5, fail=False, **kwargs):
+        """Transcripts complete `processing_seconds` after creation with `text`,
+        whose words are spaced `words_per_second` apart. `fail` makes every
+        transcript end in status 'error'."""
+        super().__init__(**kwargs)
+        self.processing_seconds = processing_seconds
+        self.text = text
+        self.words_per_second = words_per_second
+        self.fail = fail
+        self.uploads = {}
+        self.transcripts = {}
+
+    def route(self, h, method):
+        path = h.path.split('?', 1)[0]
+        if method == 'POST' and path == '/v2/upload':
+            self.count('upload')
+            data = h._body()
+            upload_id = uuid.uuid4().hex
+            self.uploads[upload_id] = len(data)
+            h._json(200, {'upload_url': f"{self.url}/files/{upload_id}"})
+            return True
+        if method == 'POST' and path == '/v2/transcript':
+            self.count('create')
+            req = json.loads(h._body() or b'{}')
+            tid = uuid.uuid4().hex
+            self.transcripts[tid] = {'created': time.monotonic(), 'request': req}
+            if req.get('webhook_url'):
+                t = threading.Timer(self.processing_seconds, self._deliver_webhook, args=(tid, req))
+                t.daemon = True
+                t.start()
+            h._json(200, {'id': tid, 'status': 'queued'})
+            return True
+        if method == 'GET' and path.startswith('/v2/transcript/'):
+            self.count('poll')
+            tid = path.rsplit('/', 1)[1]
+            if tid not in self.transcripts:
+                h._json(404, {'error': 'transcript not found'})
+                return True
+            h._json(200, self.transcript(tid))
+            return True
+        return None
+
+    def transcript(self, tid):
+        done = time.monotonic() - self.transcripts[tid]['created'] >= self.processing_seconds
+        if not done:
+            return {'id': tid, 'status': 'processing', 'text': None}
+        if self.fail:
+            return {'id': tid, 'status': 'error', 'text': None, 'error': 'mock transcription failure'}
+        step = int(1000 / self.words_per_second)
+        words = [{'text': w, 'start': i * step, 'end': i * step + int(step * 0.8), 'confidence': 0.95}
+                 for i, w in enumerate(self.text.split())]
+        return {'id': tid, 'status': 'completed', 'text': self.text, 'words': words,
+                'audio_duration': len(words) * step / 1000}
+
+    def _deliver_webhook(self, tid, req):
+        headers = {}
+        if req.get('webhook_auth_header_name'):
+            headers[req['webhook_auth_header_name']] = req.get('webhook_auth_header_value', '')
+        try:
+            requests.post(req['webhook_url'], json={'transcript_id': tid, 'status': 'completed'},
+                          headers=headers, timeout=5)
+        except Exception:
+            pass
+
+
+class MockOllama(MockService):
+    def __init__(self, reply=DEFAULT_REPLY, tokens_per_second=40.0, first_token_seconds=0.2, **kwargs):
+        """`/api/chat` answers with `reply`, split into word-sized tokens. The
+        first token arrives after `first_token_seconds` (prompt processing), then
+        tokens follow at `tokens_per_second`; non-streaming requests wait for the
+        whole reply."""
+        super().__init__(**kwargs)
+        self.reply = reply
+        self.tokens_per_second = tokens_per_second
+        self.first_token_seconds = first_token_seconds
+
+    def tokens(self):
+        return re.findall(r'\S+\s*', self.reply)
+
+    def _message(self, model, content, done, **extra):
+        msg = {'model': model, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               'message': {'role': 'assistant', 'content': content}, 'done': done}
+        msg.update(extra)
+        return msg
+
+    def route(self, h, method):
+        path = h.path.split('?', 1)[0]
+        if method == 'GET' and path == '/api/version':
+            h._json(200, {'version': '0.0.0-mock'})
+            return True
+        if method != 'POST' or path != '/api/chat':
+            return None
+        self.count('chat')
+        req = json.loads(h._body() or b'{}')
+        model = req.get('model', 'mock')
+        tokens = self.tokens()
+        prompt_tokens = sum(len(m.get('content') or '') for m in req.get('messages', [])) // 4
+        started = time.monotonic()
+        time.sleep(self.first_token_seconds)
+        interval = 1.0 / self.tokens_per_second if self.tokens_per_second else 0
+        stats = {'done_reason': 'stop', 'prompt_eval_count': prompt_tokens, 'eval_count': len(tokens)}
+        if not req.get('stream', True):
+            time.sleep(interval * len(tokens))
+            stats['total_duration'] = int((time.monotonic() - started) * 1e9)
+            h._json(200, self._message(model, ''.join(tokens), True, **stats))
+            return True
+        h._start_chunked(200, 'application/x-ndjson')
+        try:
+            for tok in tokens:
+                h._chunk(json.dumps(self._message(model, tok, False)).encode('utf-8') + b'\n')
+                time.sleep(interval)
+            stats['total_duration'] = int((time.monotonic() - started) * 1e9)
+            h._chunk(json.dumps(self._message(model, '', True, **stats)).encode('utf-8') + b'\n')
+            h._end_chunked()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client cancelled the stream
+        return True
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = ap.add_subparsers(dest='service', required=True)
+    asr = sub.add_parser('assemblyai', help='mock AssemblyAI upload/transcript API')
+    asr.add_argument('--processing-seconds', type=float, default=1.0)
+    asr.add_argument('--text', default=DEFAULT_TEXT)
+    llm = sub.add_parser('ollama', help='mock Ollama chat API')
+    llm.add_argument('--reply', default=DEFAULT_REPLY)
+    llm.add_argument('--tokens-per-second', type=float, default=40.0)
+    llm.add_argument('--first-token-seconds', type=float, default=0.2)
+    for p, port in ((asr, 8701), (llm, 8702)):
+        p.add_argument('--host', default='127.0.0.1')
+        p.add_argument('--port', type=int, default=port)
+        p.add_argument('--latency', type=float, default=0.0)
+    args = ap.parse_args(argv)
+    common = dict(host=args.host, port=args.port, latency=args.latency, verbose=True)
+    if args.service == 'assemblyai':
+        service = MockAssemblyAI(processing_seconds=args.processing_seconds, text=args.text, **common)
+    else:
+        service = MockOllama(reply=args.reply, tokens_per_second=args.tokens_per_second,
+                             first_token_seconds=args.first_token_seconds, **common)
+    print(f"mock {args.service} listening on {service.url}")
+    try:
+        service.server.serve_forever()
+    except KeyboardInterrupt:
+        service.stop()
+
+
+if __name__ == '__main__':
+    main()
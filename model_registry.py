@@ -0,0 +1,157 @@
+"""Process-wide registry for the analysis models used by therapyAI.
+
+Building the FER/MTCNN networks and the VADER lexicon costs more than running
+them, so each model is constructed once per process and shared by every request
+thread. The registry lives outside therapyAI so reloading that module during
+development does not throw the loaded models away.
+"""
+import sys
+import threading
+import time
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaders = {}
+        self._models = {}
+        self._errors = {}
+        self._load_seconds = {}
+        self._infer_locks = {}
+        self._closers = {}
+        self._eager = {}
+
+    def register(self, name, loader, thread_safe=True, eager=True, close=None):
+        """Register a zero-argument `loader` that builds the model `name`.
+        Models that are not safe to call from several threads at once get an
+        inference lock, available through `lock(name)`. Only `eager` models are
+        loaded by `warm_up()` and counted by `is_ready()`; `close`, if given, is
+        called with the old instance when the model is reloaded."""
+        with self._lock:
+            self._loaders[name] = loader
+            self._infer_locks[name] = None if thread_safe else threading.Lock()
+            self._eager[name] = eager
+            self._closers[name] = close
+
+    def set_eager(self, name, eager):
+        with self._lock:
+            self._eager[name] = eager
+
+    def _eager_names(self):
+        return [name for name in self._loaders if self._eager.get(name, True)]
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._lock:
+            # another thread may have finished loading while we waited
+            model = self._models.get(name)
+            if model is None:
+                model = self._load(name)
+            return model
+
+    def lock(self, name):
+        """Return the inference lock for `name`, or a no-op lock when the model
+        can be shared freely between threads."""
+        return self._infer_locks.get(name) or _NullLock()
+
+    def _load(self, name):
+        if name not in self._loaders:
+            raise KeyError(f"unknown model: {name}")
+        start = time.perf_counter()
+        try:
+            model = self._loaders[name]()
+        except Exception as e:
+            self._errors[name] = str(e)
+            raise
+        self._models[name] = model
+        self._errors.pop(name, None)
+        self._load_seconds[name] = round(time.perf_counter() - start, 3)
+        print(f"Loaded model '{name}' in {self._load_seconds[name]}s", file=sys.stderr)
+        return model
+
+    def warm_up(self, names=None):
+        """Load every eager model (or just `names`). Failures are recorded
+        for `status()` instead of raised so a missing optional model does not
+        stop the others from loading."""
+        for name in names or self._eager_names():
+            try:
+                self.get(name)
+            except Exception as e:
+                print(f"warm-up of model '{name}' failed: {e}", file=sys.stderr)
+        return self.is_ready(names)
+
+    def reload(self, names=None):
+        """Drop the cached instances so the next `get()` rebuilds them. Meant
+        for development; requests running during a reload keep the old model."""
+        names = names or self._eager_names()
+        with self._lock:
+            for name in names:
+                model = self._models.pop(name, None)
+                self._errors.pop(name, None)
+                self._load_seconds.pop(name, None)
+                if model is not None and self._closers.get(name):
+                    try:
+                        self._closers[name](model)
+                    except Exception as e:
+                        print(f"closing model '{name}' failed: {e}", file=sys.stderr)
+        return self.warm_up(names)
+
+    def is_ready(self, names=None):
+        return all(name in self._models for name in names or self._eager_names())
+
+    def status(self):
+        with self._lock:
+            return {
+                name: {
+                    'loaded': name in self._models,
+                    'eager': self._eager.get(name, True),
+                    'load_seconds': self._load_seconds.get(name),
+                    'error': self._errors.get(name),
+                }
+                for name in self._loaders
+            }
+
+
+class _NullLock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _load_fer():
+    from fer.fer import FER
+    return FER(mtcnn=True)
+
+
+def _load_vader():
+    from nltk.sentiment.vader import SentimentIntensityAnalyzer
+    return SentimentIntensityAnalyzer()
+
+
+def _load_vader_batch():
+    from sentiment_timeline import BatchVader
+    return BatchVader(registry.get('vader'))
+
+
+registry = ModelRegistry()
+# The Keras emotion model and MTCNN keep per-call state, so FER inference is
+# serialised; VADER only reads its lexicon and can be shared.
+registry.register('fer', _load_fer, thread_safe=False)
+registry.register('vader', _load_vader)
+registry.register('vader_batch', _load_vader_batch)
+
+
+def get_fer():
+    return registry.get('fer')
+
+
+def get_sentiment_analyzer():
+    return registry.get('vader')
+
+
+def get_batch_sentiment_scorer():
+    return registry.get('vader_batch')
@@ -0,0 +1,248 @@
+"""Dependency-driven executor for the therapyAI analysis stages.
+
+Each `Stage` names the inputs it needs, either initial pipeline inputs or the
+results of other stages. A stage starts as soon as all of them are available,
+so independent branches overlap and end-to-end latency tracks the slowest
+branch rather than the sum of all stages. Stages run on a thread pool by
+default; CPU-bound ones can be sent to a process pool instead.
+
+Every stage is recorded as a `stage.<name>` span in `metrics`, and thread-pool
+stages run in a copy of the caller's context, so spans they open join the
+caller's trace.
+"""
+import concurrent.futures as cf
+import contextvars
+import sys
+import threading
+import time
+
+import metrics
+
+
+class StageTimeout(Exception):
+    pass
+
+
+class Stage:
+    def __init__(self, name, fn, inputs=(), executor=None, timeout=None, required=True, default=None, on_error=None,
+                 cache_version=None, on_result=None):
+        """`fn` is called with the values of `inputs`, in order. `executor` is a
+        zero-argument callable returning the `concurrent.futures.Executor` to
+        run on (the pipeline's thread pool when None); process executors need a
+        picklable, module-level `fn`. A stage that fails or exceeds `timeout`
+        seconds (counted from when it starts running; a process stage counts
+        from when the pool hands it to a worker's call queue) aborts the run when `required`, otherwise its result becomes
+        `default` and dependents carry on. `on_error(exc)` is called on failure.
+        Stages with a `cache_version` are looked up in / stored to the run's
+        cache; bump the version whenever the stage's output would change.
+        `on_result(value)` runs in the pipeline's thread on a freshly computed
+        (not cached) result and returns the value to keep, e.g. to record
+        statistics a process-pool stage sent back alongside its result."""
+        self.name = name
+        self.fn = fn
+        self.inputs = tuple(inputs)
+        self.executor = executor
+        self.timeout = timeout
+        self.required = required
+        self.default = default
+        self.on_error = on_error
+        self.cache_version = cache_version
+        self.on_result = on_result
+
+
+class PipelineRun:
+    def __init__(self, values, errors, timings, cache):
+        self.values = values
+        self.errors = errors
+        self.timings = timings
+        self.cache = cache  # stage -> 'hit' | 'miss' for cacheable stages
+
+
+class Pipeline:
+    def __init__(self, stages, threads=8, executor=None):
+        """Stages without their own executor run on `executor` when given (so
+        several pipelines can share one pool), else on a new pool of `threads`."""
+        self.stages = list(stages)
+        names = [s.name for s in self.stages]
+        if len(set(names)) != len(names):
+            raise ValueError("stage names must be unique")
+        self._owns_threads = executor is None
+        self._threads = executor or cf.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='pipeline')
+        self._active = 0
+        self._active_lock = threading.Lock()
+
+    @property
+    def executor(self):
+        return self._threads
+
+    def run(self, inputs, progress=None, cache=None, cache_key=None):
+        """Run every stage and return a `PipelineRun`: stage results keyed by
+        stage name (alongside the initial `inputs`), error messages for stages
+        that failed or timed out, per-stage wall time in seconds and cache
+        hit/miss per cacheable stage. `progress(stage, status, **info)` receives
+        started/done/failed events. With a `cache` (see result_cache.ResultCache)
+        and a `cache_key` identifying the input content, stages that already
+        have a result for that key are skipped."""
+        with self._active_lock:
+            self._active += 1
+        try:
+            return self._run(inputs, progress, cache, cache_key)
+        finally:
+            with self._active_lock:
+                self._active -= 1
+
+    def active(self):
+        """Number of runs in progress; their later stages still need the executor."""
+        return self._active
+
+    def _run(self, inputs, progress, cache, cache_key):
+        values = dict(inputs)
+        errors = {}
+        timings = {}
+        cached = {}
+        use_cache = cache is not None and cache_key is not None
+        pending = list(self.stages)
+        running = {}  # future -> (stage, started, [time it began running])
+        stage_names = {s.name for s in self.stages}
+
+        def fail(stage, exc, started):
+            timings[stage.name] = round(time.perf_counter() - started, 3)
+            errors[stage.name] = str(exc) or type(exc).__name__
+            metrics.record(f"stage.{stage.name}", timings[stage.name], error=True)
+            _report(progress, stage.name, 'failed', error=errors[stage.name], seconds=timings[stage.name])
+            if stage.on_error is not None:
+                try:
+                    stage.on_error(exc)
+                except Exception as e:
+                    print(f"{stage.name} error hook failed: {e}", file=sys.stderr)
+            if stage.required:
+                for f in running:
+                    f.cancel()
+                raise exc
+            values[stage.name] = stage.default
+
+        clash = stage_names & set(inputs)
+        if clash:
+            raise ValueError(f"inputs shadow stage names: {sorted(clash)}")
+
+        while pending or running:
+            # cache hits and failed optional stages resolve instantly, which can
+            # unblock further stages, so keep scheduling until nothing changes
+            scheduled = True
+            while scheduled:
+                scheduled = False
+                for stage in list(pending):
+                    # a stage's result lands in `values` once it finishes (or falls back to its default)
+                    if any(k in stage_names and k not in values for k in stage.inputs):
+                        continue
+                    pending.remove(stage)
+                    scheduled = True
+                    started = time.perf_counter()
+                    if use_cache and stage.cache_version is not None:
+                        try:
+                            hit = cache.get(cache_key, stage.name, stage.cache_version, _MISS)
+                        except Exception as e:
+                            print(f"cache lookup for {stage.name} failed: {e}", file=sys.stderr)
+                            hit = _MISS
+                        cached[stage.name] = 'miss' if hit is _MISS else 'hit'
+                        metrics.CACHE_LOOKUPS.inc(stage=stage.name, result=cached[stage.name])
+                        if hit is not _MISS:
+                            values[stage.name] = hit
+                            timings[stage.name] = 0.0
+                            metrics.record(f"stage.{stage.name}", 0.0, observe=False, cached=True)
+                            _report(progress, stage.name, 'done', seconds=0.0, cached=True)
+                            continue
+                    _report(progress, stage.name, 'started')
+                    try:
+                        executor = stage.executor() if stage.executor is not None else self._threads
+                    except Exception as e:
+                        fail(stage, e, started)
+                        continue
+                    args = [values[k] for k in stage.inputs]
+                    began = []
+                    try:
+                        if isinstance(executor, cf.ProcessPoolExecutor):
+                            future = executor.submit(stage.fn, *args)
+                        else:
+                            future = executor.submit(contextvars.copy_context().run, _mark_start, began, stage.fn,
+                                                     *args)
+                    except Exception as e:
+                        fail(stage, e, started)
+                        continue
+                    running[future] = (stage, started, began)
+
+            if not running:
+                if pending:
+                    raise RuntimeError(f"unsatisfiable stage inputs: {[s.name for s in pending]}")
+                break
+
+            # a stage's timeout counts from when it starts running, not from time spent queued
+            # for a pool thread or FER process; process futures can only be watched for that
+            queued = False
+            deadlines = []
+            for future, (stage, _, began) in running.items():
+                if not stage.timeout:
+                    continue
+                if not began and future.running():
+                    began.append(time.perf_counter())
+                if began:
+                    deadlines.append(began[0] + stage.timeout)
+                else:
+                    queued = True
+            wait_for = max(0.0, min(deadlines) - time.perf_counter()) if deadlines else None
+            if queued:
+                wait_for = min(wait_for, QUEUED_POLL) if wait_for is not None else QUEUED_POLL
+            done, _ = cf.wait(list(running), timeout=wait_for, return_when=cf.FIRST_COMPLETED)
+
+            for future in done:
+                stage, started, _ = running.pop(future)
+                try:
+                    value = future.result()
+                    if stage.on_result is not None:
+                        value = stage.on_result(value)
+                    values[stage.name] = value
+                except Exception as e:
+                    fail(stage, e, started)
+                    continue
+                timings[stage.name] = round(time.perf_counter() - started, 3)
+                metrics.record(f"stage.{stage.name}", timings[stage.name])
+                if use_cache and stage.cache_version is not None:
+                    try:
+                        cache.put(cache_key, stage.name, stage.cache_version, values[stage.name])
+                    except Exception as e:
+                        print(f"caching {stage.name} failed: {e}", file=sys.stderr)
+                _report(progress, stage.name, 'done', seconds=timings[stage.name])
+
+            now = time.perf_counter()
+            for future, (stage, started, began) in list(running.items()):
+                if stage.timeout and began and now >= began[0] + stage.timeout:
+                    # the worker can't be interrupted; drop its result and move on
+                    running.pop(future)
+                    future.cancel()
+                    fail(stage, StageTimeout(f"{stage.name} timed out after {stage.timeout}s"), started)
+
+        return PipelineRun(values, errors, timings, cached)
+
+    def shutdown(self, wait=False):
+        if self._owns_threads:
+            self._threads.shutdown(wait=wait)
+
+
+_MISS = object()
+# how often a queued stage with a timeout is checked for having started
+QUEUED_POLL = 0.25
+
+
+def _mark_start(began, fn, *args):
+    began.append(time.perf_counter())
+    return fn(*args)
+
+
+def _report(progress, stage, status, **info):
+    if progress is None:
+        return
+    try:
+        progress(stage, status, **info)
+    except Exception as e:
+        # a broken listener must never fail the analysis itself
+        print(f"progress callback failed: {e}", file=sys.stderr)
@@ -0,0 +1,165 @@
+"""Token-budgeted, prefix-stable prompt construction for the chatbot.
+
+Messages are laid out so the front of the prompt changes as rarely as
+possible, which lets Ollama reuse its KV cache from the previous turn:
+
+    [fixed system prompt] [rolling summary] [recent history ...]
+    [this turn's emotion/sentiment context] [user message]
+
+When the prompt would exceed the token budget, the oldest turns are folded into
+a rolling summary. The summary is updated incrementally from the previous
+summary plus the newly folded turns, and enough turns are folded at once that
+the prefix then stays unchanged for several turns.
+"""
+import sys
+import threading
+from collections import OrderedDict
+
+SYSTEM_PROMPT = (
+    "You are a therapeutic, empathetic assistant. Before each user message you receive a context note "
+    "with the user's primary facial emotions from video analysis and the sentiment of their words. "
+    "Provide supportive advice and surface any inconsistencies between sentiment and facial emotion. "
+    "If a follow-up question is necessary to clarify risk or safety, ask gently; otherwise prefer "
+    "reflection and concrete coping suggestions."
+)
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a supportive conversation between a user and a therapeutic assistant. "
+    "Update the summary with the new turns. Keep the user's concerns, feelings, important facts and any "
+    "safety-relevant details; drop pleasantries. Reply with the updated summary only, at most 150 words."
+)
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for English text; close enough for budgeting
+    return len(text or '') // 4 + 1
+
+
+def _clock(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+def context_note(emotions, sentiment, mismatches=None):
+    """Per-turn context message; goes after the history so the prefix stays stable.
+    `mismatches` are the segments from sentiment_timeline where the words and
+    the face disagree."""
+    em = [e for e in (emotions or [])[:2] if e]
+    if len(em) > 1 and em[1] != 'neutral':
+        emotions_desc = f"primary facial emotions {em[0]} and {em[1]}"
+    else:
+        emotions_desc = f"primary facial emotion {em[0] if em else 'neutral'}"
+    content = f"Context for this message: {emotions_desc}; text sentiment {sentiment or 'neutral'}."
+    if mismatches:
+        moments = '; '.join(f"{_clock(m['start'])}-{_clock(m['end'])} \"{m['text'][:80]}\" "
+                            f"({m['kind']}, face {m['face']})" for m in mismatches)
+        content += f" Words and face disagree at: {moments}."
+    return {'role': 'system', 'content': content}
+
+
+class PromptBuilder:
+    def __init__(self, system_prompt=SYSTEM_PROMPT, budget=6000, summarizer=None, store=None,
+                 keep_recent=4, fold_target=0.6, estimate=estimate_tokens, cache_size=256):
+        """`budget` is the prompt token budget. `summarizer(previous_summary,
+        messages)` returns the updated summary text; without one, old turns are
+        simply dropped. `store` persists summaries per session through
+        `get_summary(session_id) -> (text, covered)` and `save_summary(session_id,
+        text, covered)`, where `covered` is how many history messages the summary
+        replaces; without a store, summaries are kept in an in-process LRU.
+        Folding keeps at least `keep_recent` messages verbatim and shrinks the
+        history to `fold_target` of the room left in the budget."""
+        self.system_prompt = system_prompt
+        self.budget = budget
+        self.summarizer = summarizer
+        self.store = store
+        self.keep_recent = keep_recent
+        self.fold_target = fold_target
+        self.estimate = estimate
+        self.cache_size = cache_size
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _msg_tokens(self, m):
+        return self.estimate(m['content']) + 4  # role/formatting overhead
+
+    def _get_summary(self, session_id, store):
+        if session_id is None:
+            return '', 0
+        if store is not None:
+            return store.get_summary(session_id) or ('', 0)
+        with self._lock:
+            if session_id in self._summaries:
+                self._summaries.move_to_end(session_id)
+            return self._summaries.get(session_id, ('', 0))
+
+    def _save_summary(self, session_id, text, covered, store):
+        if session_id is None:
+            return
+        if store is not None:
+            store.save_summary(session_id, text, covered)
+            return
+        with self._lock:
+            self._summaries[session_id] = (text, covered)
+            self._summaries.move_to_end(session_id)
+            while len(self._summaries) > self.cache_size:
+                self._summaries.popitem(last=False)
+
+    def build(self, history, text, emotions=None, sentiment=None, session_id=None, mismatches=None, store=None):
+        """Return the message list for one chat turn. `history` holds the
+        session's earlier messages ({role, content}), oldest first, without the
+        current user message. `store`, when given, replaces the builder's own
+        summary store for this call."""
+        store = store if store is not None else self.store
+        history = [{'role': m['role'], 'content': m['content']} for m in (history or [])
+                   if isinstance(m, dict) and 'role' in m and 'content' in m]
+        system = {'role': 'system', 'content': self.system_prompt}
+        context = context_note(emotions, sentiment, mismatches)
+        user = {'role': 'user', 'content': text}
+
+        summary, covered = self._get_summary(session_id, store)
+        if covered > len(history):
+            # history shrank under us (e.g. a different session store); start over
+            summary, covered = '', 0
+        recent = history[covered:]
+
+        fixed = sum(self._msg_tokens(m) for m in (system, context, user))
+        summary_cost = self._msg_tokens({'content': summary}) if summary else 0
+        sizes = [self._msg_tokens(m) for m in recent]
+        if fixed + summary_cost + sum(sizes) > self.budget:
+            # fold the oldest turns, leaving headroom so the next few turns fit without another fold
+            target = (self.budget - fixed - summary_cost) * self.fold_target
+            total = sum(sizes)
+            n = 0
+            while n < len(recent) - self.keep_recent and total > target:
+                total -= sizes[n]
+                n += 1
+            if n:
+                summary = self._fold(summary, recent[:n])
+                covered += n
+                recent = recent[n:]
+                sizes = sizes[n:]
+                self._save_summary(session_id, summary, covered, store)
+
+            # last resort for oversized messages: drop (don't summarise) until it fits
+            summary_cost = self._msg_tokens({'content': summary}) if summary else 0
+            while recent and fixed + summary_cost + sum(sizes) > self.budget:
+                recent.pop(0)
+                sizes.pop(0)
+
+        msgs = [system]
+        if summary:
+            msgs.append({'role': 'system', 'content': f"Summary of the earlier conversation: {summary}"})
+        msgs.extend(recent)
+        msgs.append(context)
+        msgs.append(user)
+        return msgs
+
+    def _fold(self, summary, messages):
+        if self.summarizer is None:
+            return summary
+        try:
+            return self.summarizer(summary, messages).strip() or summary
+        except Exception as e:
+            # keep the old summary; the folded turns are lost from the prompt but not from history
+            print(f"summary update failed: {e}", file=sys.stderr)
+            return summary
@@ -0,0 +1,139 @@
+"""Content-addressed cache for per-stage analysis results.
+
+Uploads are hashed while they are written to disk, and each stage's output
+(transcript, sentiment, emotions) is stored under (content hash, stage, stage
+version) in a small SQLite file. Re-submitting the same clip then skips every
+stage that already has a result. Entries are evicted least-recently-used once
+the stored values exceed the configured size. Several processes (Flask, the
+daemon and FER workers, the batch CLI) share the file, so the running size
+total lives in the database and is updated in the same transaction as the
+entry it accounts for.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+CHUNK_SIZE = 1 << 20
+
+
+def hash_and_save(stream, dest, chunk_size=CHUNK_SIZE):
+    """Copy `stream` to `dest` in chunks, hashing as it goes. Returns the
+    SHA-256 hex digest so the upload never has to be read back to be keyed."""
+    digest = hashlib.sha256()
+    with open(dest, 'wb') as out:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+
+def file_sha256(path, chunk_size=CHUNK_SIZE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+              content_hash TEXT NOT NULL,
+              stage        TEXT NOT NULL,
+              version      TEXT NOT NULL,
+              value        TEXT NOT NULL,
+              size_bytes   INTEGER NOT NULL,
+              created_at   REAL NOT NULL,
+              accessed_at  REAL NOT NULL,
+              PRIMARY KEY (content_hash, stage, version)
+            )""")
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_results_accessed ON results(accessed_at)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS cache_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        # cache files from before the stored total get it seeded once
+        self._conn.execute("INSERT OR IGNORE INTO cache_meta SELECT 'total_bytes', COALESCE(SUM(size_bytes), 0) "
+                           "FROM results")
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, content_hash, stage, version, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM results WHERE content_hash = ? AND stage = ? AND version = ?',
+                (content_hash, stage, version)).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._conn.execute(
+                'UPDATE results SET accessed_at = ? WHERE content_hash = ? AND stage = ? AND version = ?',
+                (time.time(), content_hash, stage, version))
+        return json.loads(row[0])
+
+    def put(self, content_hash, stage, version, value):
+        data = json.dumps(value)
+        size = len(data.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so no other process can move the total in between
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                old = self._conn.execute(
+                    'SELECT size_bytes FROM results WHERE content_hash = ? AND stage = ? AND version = ?',
+                    (content_hash, stage, version)).fetchone()
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (content_hash, stage, version, data, size, now, now))
+                total = self._add_total(size - (old[0] if old else 0))
+                if total > self.max_bytes:
+                    self._evict(total)
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def _add_total(self, delta):
+        self._conn.execute("UPDATE cache_meta SET value = value + ? WHERE key = 'total_bytes'", (delta,))
+        return self._total()
+
+    def _total(self):
+        return self._conn.execute("SELECT value FROM cache_meta WHERE key = 'total_bytes'").fetchone()[0]
+
+    def _evict(self, total):
+        # drop least-recently-used entries until we're back under 90% of the budget
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute(
+            'SELECT rowid, size_bytes FROM results ORDER BY accessed_at').fetchall()
+        doomed = []
+        freed = 0
+        for rowid, size in rows:
+            if total - freed <= target:
+                break
+            doomed.append((rowid,))
+            freed += size
+        self._conn.executemany('DELETE FROM results WHERE rowid = ?', doomed)
+        self._add_total(-freed)
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            total = self._total()
+        return {'entries': entries, 'bytes': total, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
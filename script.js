@@ -87,22 +87,107 @@ async function apiUpload(file){
   return data; 
 }
 
-async function apiAnalyze(file){
+// Chunked, resumable upload: each chunk is PUT at the server's offset, and a failed
+// chunk is retried from whatever offset the server reports it actually has.
+const UPLOAD_CHUNK = 4 * 1024 * 1024;
+
+async function apiUploadChunked(file, onProgress){
+  const name = file.name || 'checkin.webm';
+  const r = await fetch(`${API}/upload`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ filename: name, size: file.size })
+  });
+  if (r.status === 404) return null; // server without chunked uploads
+  const session = await r.json().catch(() => ({}));
+  if (!r.ok) throw new Error(session.error || `Status ${r.status}`);
+  let offset = session.offset || 0;
+  let failures = 0;
+  while (offset < file.size){
+    try{
+      const put = await fetch(`${API}${session.url}`, {
+        method: 'PUT',
+        headers: { 'Upload-Offset': String(offset) },
+        body: file.slice(offset, offset + UPLOAD_CHUNK)
+      });
+      const st = await put.json().catch(() => ({}));
+      if (put.ok){
+        offset = st.offset;
+        failures = 0;
+        if (onProgress) onProgress({ stage: 'upload', status: 'progress', sent: offset, size: file.size });
+        continue;
+      }
+      if (put.status !== 409 || st.offset === undefined) throw new Error(st.error || `Status ${put.status}`);
+      offset = st.offset;
+    }catch(e){
+      if (++failures > 5) throw e;
+      await new Promise(res => setTimeout(res, 1000 * failures));
+      const st = await fetch(`${API}${session.url}`).then(x => x.json()).catch(() => null);
+      if (st && st.offset !== undefined) offset = st.offset;
+    }
+  }
+  const done = await fetch(`${API}${session.url}/complete`, { method: 'POST', headers: { ...authHeaders() } });
+  const info = await done.json().catch(() => ({}));
+  if (!done.ok) throw new Error(info.error || `Status ${done.status}`);
+  return info.id;
+}
+
+async function apiAnalyze(file, onProgress){
   const fd = new FormData();
-  fd.append('file', file, file.name || 'checkin.webm');
+  const uploadId = await apiUploadChunked(file, onProgress);
+  if (uploadId) fd.append('upload', uploadId);
+  else fd.append('file', file, file.name || 'checkin.webm');
   const r = await fetch(`${API}/record`, {
     method: 'POST',
+    headers: { ...authHeaders() }, // lets the server file the session's emotions under the signed-in user
     body: fd
   });
   // Try to parse JSON, but if parsing fails capture raw text for debugging
   const text = await r.text().catch(() => '');
   let data = {};
   try { data = text ? JSON.parse(text) : {}; } catch (e) { data = {}; }
+  if (r.status === 429) throw new Error('Server is busy, please try again in a few seconds.');
   if (!r.ok) {
     const msg = data.error || data.detail || text || `Status ${r.status}`;
     throw new Error(msg);
   }
-  return data;
+  // The server queues the analysis and returns a job id; wait for its result
+  if (!data.job) return data;
+  return waitForJob(data, onProgress);
+}
+
+// Follow a queued analysis job: stream progress over SSE, falling back to polling
+function waitForJob(job, onProgress){
+  return new Promise((resolve, reject) => {
+    const finish = (ev) => {
+      if (ev.status === 'done') resolve(ev.result || {});
+      else reject(new Error(ev.error || 'analysis failed'));
+    };
+    const poll = async () => {
+      try{
+        const r = await fetch(`${API}${job.status_url}`);
+        const snap = await r.json();
+        if (!r.ok) return reject(new Error(snap.error || `Status ${r.status}`));
+        const last = snap.events && snap.events[snap.events.length - 1];
+        if (last && onProgress) onProgress(last);
+        if (snap.status === 'done') return resolve(snap.result || {});
+        if (snap.status === 'failed') return reject(new Error((snap.error && snap.error.detail) || 'analysis failed'));
+        setTimeout(poll, 1000);
+      }catch(e){ reject(e); }
+    };
+    if (!window.EventSource) return poll();
+    const es = new EventSource(`${API}${job.events_url}`);
+    es.addEventListener('progress', (msg) => {
+      let ev = {};
+      try { ev = JSON.parse(msg.data); } catch (e) { return; }
+      if (onProgress) onProgress(ev);
+      if (ev.stage === 'job' && (ev.status === 'done' || ev.status === 'failed')){
+        es.close();
+        finish(ev);
+      }
+    });
+    es.onerror = () => { es.close(); poll(); };
+  });
 }
 
 // Chat API: send text or optional file, maintain session id in localStorage
@@ -122,6 +207,77 @@ async function apiChatSend({session, text, file}){
   return data;
 }
 
+// Streaming chat: POST to /chat/stream and read server-sent events from the response body.
+// Calls onToken(piece, replySoFar) as tokens arrive; resolves with the final `done` payload.
+async function apiChatStream({session, text, file}, onToken){
+  const fd = new FormData();
+  if (session) fd.append('session', session);
+  if (text) fd.append('text', text);
+  if (file) fd.append('file', file, file.name || 'reply.mp4');
+  const r = await fetch(`${API}/chat/stream`, { method: 'POST', body: fd });
+  if (!r.ok || !r.body) {
+    const textResp = await r.text().catch(() => '');
+    let data = {};
+    try { data = textResp ? JSON.parse(textResp) : {}; } catch(e){ data = {}; }
+    throw new Error(data.error || data.detail || textResp || `Status ${r.status}`);
+  }
+  const reader = r.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = '';
+  let reply = '';
+  let final = null;
+  while (true){
+    const { value, done } = await reader.read();
+    if (done) break;
+    buf += decoder.decode(value, { stream: true });
+    let idx;
+    while ((idx = buf.indexOf('\n\n')) >= 0){
+      const frame = buf.slice(0, idx);
+      buf = buf.slice(idx + 2);
+      let event = 'message';
+      let data = '';
+      frame.split('\n').forEach(line => {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) data += line.slice(5).trim();
+      });
+      if (!data) continue;
+      let payload = {};
+      try { payload = JSON.parse(data); } catch (e) { continue; }
+      if (event === 'token'){
+        reply += payload.t;
+        if (onToken) onToken(payload.t, reply);
+      } else if (event === 'done'){
+        final = payload;
+      }
+    }
+  }
+  if (!final) throw new Error('Reply stream ended early');
+  return final;
+}
+
+// Send a chat turn and render the reply: streamed token by token when the browser
+// supports it, otherwise via the plain /chat endpoint with the typewriter effect.
+async function sendChatTurn({session, text, file}){
+  const therapistEl = document.getElementById('therapistResponse');
+  if (!window.ReadableStream || !window.TextDecoder){
+    const res = await apiChatSend({ session, text, file });
+    if (res.history) renderChatHistory(res.history);
+    if (res.reply) startTyping(therapistEl, res.reply || '(no response)');
+    return res;
+  }
+  if (therapistEl){
+    // cancel any typewriter still running on this element
+    therapistEl._typingToken = (therapistEl._typingToken || 0) + 1;
+    therapistEl.textContent = '';
+  }
+  const res = await apiChatStream({ session, text, file }, (_piece, soFar) => {
+    if (therapistEl) therapistEl.textContent = soFar;
+  });
+  if (res.history) renderChatHistory(res.history);
+  if (therapistEl) therapistEl.textContent = res.reply || '(no response)';
+  return res;
+}
+
 function renderChatHistory(history){
   const el = document.getElementById('chatHistory');
   if (!el) return;
@@ -198,14 +354,8 @@ document.getElementById('chatSend')?.addEventListener('click', async () => {
   const sendBtn = document.getElementById('chatSend');
   if (sendBtn) setButtonLoading(sendBtn, true, 'Thinking…');
   try{
-    const res = await apiChatSend({ session, text: txt });
-    // server-provided history will replace optimistic UI (keeps things canonical)
-    if (res.history) renderChatHistory(res.history);
-    // show assistant reply in therapist area with typewriter
-    if (res.reply){
-      const therapistEl = document.getElementById('therapistResponse');
-      startTyping(therapistEl, res.reply || '(no response)');
-    }
+    // reply streams into the therapist area; server-provided history then replaces the optimistic UI
+    await sendChatTurn({ session, text: txt });
   }catch(err){
     // On error, show alert and mark last optimistic message as failed
     alert('Chat failed: ' + (err.message || err));
@@ -523,12 +673,7 @@ async function startRecording(target){
             const file = new File([blob], `reply-${Date.now()}.mp4`, { type: mediaRecorder.mimeType || 'video/mp4' });
             const session = getChatSession();
             if (chatRecord) setButtonLoading(chatRecord, true, 'Sending…');
-            const res = await apiChatSend({ session, file });
-            if (res.history) renderChatHistory(res.history);
-            if (res.reply){
-              const therapistEl = document.getElementById('therapistResponse');
-              startTyping(therapistEl, res.reply || '(no response)');
-            }
+            await sendChatTurn({ session, file });
           }catch(err){
             alert('Video chat failed: ' + (err.message || err));
             const chatEl = document.getElementById('chatHistory');
@@ -626,7 +771,13 @@ uploadBtn?.addEventListener("click", async () => {
   if (uploadMsg) uploadMsg.textContent = "Analyzing…";
   if (uploadBtn) uploadBtn.disabled = true;
   try{
-    const res = await apiAnalyze(file);
+    const stageLabels = { transcribe: 'Transcribing', sentiment: 'Scoring sentiment', emotions: 'Reading facial emotions', chatbot: 'Writing a response' };
+    const res = await apiAnalyze(file, (ev) => {
+      if (!uploadMsg) return;
+      if (ev.stage === 'upload') uploadMsg.textContent = `Uploading… ${Math.round(100 * ev.sent / (ev.size || 1))}%`;
+      else if (ev.stage === 'job' && ev.status === 'queued') uploadMsg.textContent = `Queued (position ${ev.position || 1})…`;
+      else if (ev.status === 'started' && stageLabels[ev.stage]) uploadMsg.textContent = `${stageLabels[ev.stage]}…`;
+    });
     if (uploadMsg) uploadMsg.textContent = "Analysis complete ✓";
     console.log("Analysis result:", res);
     // Optionally display analysis in the UI
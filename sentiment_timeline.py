@@ -0,0 +1,417 @@
+"""Utterance-level sentiment aligned with the facial-emotion timeline.
+
+`determine_sentiment` reduces a whole check-in to one VADER label. To find
+the moments where what the user says and what their face shows disagree,
+this module works as follows:
+- split the transcript into utterances, using the word timestamps from the
+  transcription service (a pause or sentence-ending punctuation ends one)
+- score every utterance in one pass (`BatchVader`)
+- average the FER probabilities of the frames sampled while each utterance
+  was spoken, from the clip's timeline (see emotion_timeline)
+- report the utterances where the two point in opposite directions
+
+`BatchVader` applies the VADER rules to all tokens of all utterances at once,
+as numpy array operations. The lexicon and booster/negation lists are
+compiled once into sorted arrays and looked up with `searchsorted`, so no
+per-sentence Python loop is needed. The rules covered are:
+- lexicon valence and ALL-CAPS emphasis
+- boosters in the three preceding words
+- negation, including "never so/this" and "least"
+- idioms and "kind of"-style dampeners
+- the "but" shift
+- "!" and "?" emphasis
+
+The array pass costs about 0.3 ms however few utterances it scores, while
+`polarity_scores` costs about 0.1 ms per sentence. Below `BATCH_MIN`
+utterances `BatchVader` therefore calls `polarity_scores` per utterance.
+Measured speed-up of the array pass over per-sentence calls:
+
+    utterances   3     5     10    20    50    100   200
+    speed-up     0.7x  1.1x  2.0x  2.8x  4.1x  5.1x  5.8x
+
+`polarity_scores` looks up the context of a repeated word at that word's first
+occurrence. The array pass uses each word's own position instead, so its
+compound score can differ slightly for sentences that repeat a word.
+`python sentiment_timeline.py --check` compares the two on generated sentences
+and re-measures the table above.
+"""
+import argparse
+import random
+import string
+import sys
+import time
+
+import numpy as np
+
+from emotion_engine import EMOTIONS
+
+# a pause at least this long (ms) between words starts a new utterance
+PAUSE_MS = 700
+SENTENCE_END = ('.', '!', '?')
+# how much each FER label says about the valence of the face, in EMOTIONS order
+FACE_VALENCE = np.array([{'angry': -0.8, 'disgust': -0.7, 'fear': -0.7, 'happy': 0.9,
+                          'sad': -0.8, 'surprise': 0.2, 'neutral': 0.0}[e] for e in EMOTIONS])
+# an utterance is a mismatch when its compound score and the face's valence have
+# opposite signs and both are at least this strong
+TEXT_THRESHOLD = 0.3
+FACE_THRESHOLD = 0.2
+# frames up to this many seconds either side of an utterance still count for it
+FRAME_PAD = 0.25
+MAX_SEGMENTS = 5
+# fewer utterances than this are scored with per-sentence `polarity_scores`,
+# which is faster there (see the table above)
+BATCH_MIN = 5
+
+
+def _table(mapping):
+    keys = sorted(mapping)
+    return np.array(keys, dtype=str), np.array([mapping[k] for k in keys], dtype=np.float64)
+
+
+def _lookup(keys, values, tokens):
+    """(values, found) for each token, 0 where a token is not in `keys`."""
+    if not len(tokens) or not len(keys):
+        return np.zeros(len(tokens)), np.zeros(len(tokens), dtype=bool)
+    idx = np.minimum(np.searchsorted(keys, tokens), len(keys) - 1)
+    found = keys[idx] == tokens
+    return np.where(found, values[idx], 0.0), found
+
+
+class BatchVader:
+    def __init__(self, analyzer):
+        """Compile the lexicon and rule word lists of an NLTK
+        `SentimentIntensityAnalyzer` for vectorised scoring."""
+        self.analyzer = analyzer
+        c = analyzer.constants
+        self.vocab, self.valence = _table(analyzer.lexicon)
+        self.boosters, self.boost = _table(c.BOOSTER_DICT)
+        self.negations = np.array(sorted(w.lower() for w in c.NEGATE), dtype=str)
+        self.c_incr = c.C_INCR
+        self.n_scalar = c.N_SCALAR
+        self.b_decr = c.B_DECR
+        self.idioms = [(tuple(k.split()), v) for k, v in c.SPECIAL_CASE_IDIOMS.items()]
+        self.booster_bigrams = [tuple(k.split()) for k in c.BOOSTER_DICT if len(k.split()) == 2]
+        self.phrase_words = np.array(sorted({w for words, _ in self.idioms for w in words} |
+                                            {w for words in self.booster_bigrams for w in words}), dtype=str)
+        ids = {w: i for i, w in enumerate(self.phrase_words.tolist())}
+        self._idiom_ids = [(tuple(ids[w] for w in words), value) for words, value in self.idioms]
+        self._bigram_ids = [tuple(ids[w] for w in words) for words in self.booster_bigrams]
+        self.punc_list = list(c.PUNC_LIST)
+        self.punct = ''.join(sorted(set(''.join(c.PUNC_LIST))))
+        self._no_punct = str.maketrans('', '', string.punctuation)
+
+    def score(self, texts):
+        """Compound score of each text, as `polarity_scores(text)['compound']`."""
+        tokens, utt = [], []
+        for i, text in enumerate(texts):
+            words = (text or '').split()
+            tokens.extend(words)
+            utt.extend([i] * len(words))
+        return self.score_tokens(tokens, np.array(utt, dtype=np.intp), len(texts))
+
+    def score_tokens(self, tokens, utt, n):
+        """Compound scores of `n` utterances from their whitespace-split tokens;
+        `utt[i]` is the utterance of token i, non-decreasing."""
+        if n >= BATCH_MIN:
+            return self.vector_scores(tokens, utt, n)
+        words = [[] for _ in range(n)]
+        for token, i in zip(tokens, utt):
+            words[i].append(token)
+        return np.array([self.analyzer.polarity_scores(' '.join(w))['compound'] for w in words], dtype=np.float64)
+
+    def vector_scores(self, tokens, utt, n):
+        """`score_tokens` as one array pass, whatever the number of utterances."""
+        compound = np.zeros(n)
+        if not len(tokens):
+            return compound
+        raw = np.array(tokens, dtype=str)
+        utt = np.asarray(utt, dtype=np.intp)
+        # "!"/"?" emphasis counts the raw text, before punctuation is stripped from tokens
+        bangs = np.bincount(utt, weights=np.char.count(raw, '!'), minlength=n)
+        qmarks = np.bincount(utt, weights=np.char.count(raw, '?'), minlength=n)
+
+        tok = self._strip(raw)
+        keep = np.char.str_len(tok) > 1
+        tok, utt = tok[keep], utt[keep]
+        m = len(tok)
+        pos = np.arange(m)
+        lower = np.char.lower(tok)
+        upper = np.char.isupper(tok)
+        n_tok = np.bincount(utt, minlength=n)
+        n_upper = np.bincount(utt, weights=upper, minlength=n)
+        cap_diff = ((n_upper > 0) & (n_upper < n_tok))[utt]
+
+        lex, in_lex = _lookup(self.vocab, self.valence, lower)
+        boost, is_boost = _lookup(self.boosters, self.boost, lower)
+        negated = np.isin(lower, self.negations) | (np.char.find(lower, "n't") >= 0)
+        so_this = np.isin(tok, ('so', 'this'))
+        never = tok == 'never'
+
+        def prev(k):
+            # index of the k-th preceding token, and whether it is in the same utterance
+            j = np.maximum(pos - k, 0)
+            return j, (pos >= k) & (utt[j] == utt)
+
+        j1, has1 = prev(1)
+        j2, has2 = prev(2)
+        j3, has3 = prev(3)
+        nxt = np.minimum(pos + 1, m - 1)
+        kind_of = (lower == 'kind') & (pos + 1 < m) & (utt[nxt] == utt) & (lower[nxt] == 'of')
+        scored = in_lex & ~is_boost & ~kind_of
+
+        v = np.where(scored, lex, 0.0)
+        emph = scored & upper & cap_diff
+        v = np.where(emph, v + np.where(v > 0, self.c_incr, -self.c_incr), v)
+
+        for k, (j, has) in enumerate(((j1, has1), (j2, has2), (j3, has3))):
+            # only preceding words outside the lexicon modify the valence
+            ok = scored & has & ~in_lex[j]
+            s = np.where(v < 0, -boost[j], boost[j])
+            caps = is_boost[j] & upper[j] & cap_diff
+            s = np.where(caps, s + np.where(v > 0, self.c_incr, -self.c_incr), s) * (1.0, 0.95, 0.9)[k]
+            v = np.where(ok, v + s, v)
+            if k == 0:
+                v = np.where(ok & negated[j1], v * self.n_scalar, v)
+            elif k == 1:
+                never_so = never[j2] & so_this[j1]
+                v = np.where(ok & never_so, v * 1.5, np.where(ok & ~never_so & negated[j2], v * self.n_scalar, v))
+            else:
+                never_so = (never[j3] & so_this[j2]) | so_this[j1]
+                v = np.where(ok & never_so, v * 1.25, np.where(ok & ~never_so & negated[j3], v * self.n_scalar, v))
+                code, found = _lookup(self.phrase_words, np.arange(len(self.phrase_words), dtype=np.float64), tok)
+                if found.any():
+                    v = self._idioms(v, ok, np.where(found, code, -1).astype(np.intp), utt)
+
+        least = scored & has1 & (lower[j1] == 'least') & ~in_lex[j1] & \
+            (~has2 | ~np.isin(lower[j2], ('at', 'very')))
+        v = np.where(least, v * self.n_scalar, v)
+
+        # "but": the words before the first one count half, the words after it one and a half
+        first_but = np.full(n, m)
+        is_but = lower == 'but'
+        np.minimum.at(first_but, utt[is_but], pos[is_but])
+        b = first_but[utt]
+        v = v * np.where(b == m, 1.0, np.where(pos < b, 0.5, np.where(pos > b, 1.5, 1.0)))
+
+        total = np.bincount(utt, weights=v, minlength=n)
+        amp = np.minimum(bangs, 4) * 0.292 + np.where(qmarks > 1, np.where(qmarks <= 3, qmarks * 0.18, 0.96), 0.0)
+        total = total + np.sign(total) * amp
+        compound = total / np.sqrt(total * total + 15)
+        return np.round(compound, 4)
+
+    def _strip(self, raw):
+        # like SentiText: a single PUNC_LIST item is stripped from one end of a word,
+        # provided what remains is a word of 2+ characters without other punctuation
+        stripped = np.char.strip(raw, self.punct)
+        idx = np.flatnonzero(np.char.str_len(stripped) != np.char.str_len(raw))
+        if not len(idx):
+            return raw
+        sub, core = raw[idx], stripped[idx]
+        length = np.char.str_len(sub)
+        left = length - np.char.str_len(np.char.lstrip(sub, self.punct))
+        right = length - np.char.str_len(np.char.rstrip(sub, self.punct))
+        lead = np.zeros(len(sub), dtype=bool)
+        trail = np.zeros(len(sub), dtype=bool)
+        for p in self.punc_list:
+            lead |= np.char.startswith(sub, p) & (left == len(p))
+            trail |= np.char.endswith(sub, p) & (right == len(p))
+        clean = np.char.str_len(np.char.translate(core, self._no_punct)) == np.char.str_len(core)
+        strip = clean & (np.char.str_len(core) > 1) & ((lead & (right == 0)) | (trail & (left == 0)))
+        out = raw.copy()
+        out[idx[strip]] = core[strip]
+        return out
+
+    def _idioms(self, v, ok, code, utt):
+        # VADER's idiom check: an idiom ending at, around or just before the word replaces its
+        # valence (earlier patterns win, the forward-looking ones override), then a preceding
+        # "kind of"-style bigram dampens it. `code` numbers the tokens that occur in any
+        # phrase (-1 for the rest); phrases with a word missing from the text are skipped.
+        present = set(np.unique(code[code >= 0]).tolist())
+        idioms = [(ids, value) for ids, value in self._idiom_ids if present.issuperset(ids)]
+        bigrams = [ids for ids in self._bigram_ids if present.issuperset(ids)]
+        at = np.flatnonzero(ok)
+        if not len(at) or not (idioms or bigrams):
+            return v
+        # codes of the tokens from 3 before to 2 after each scored token, -1 outside its utterance
+        idx = at[:, None] + np.arange(-3, 3)
+        inside = (idx >= 0) & (idx < len(code))
+        idx = np.clip(idx, 0, len(code) - 1)
+        window = np.where(inside & (utt[idx] == utt[at][:, None]), code[idx], -1)
+
+        def seq(offsets, ids):
+            return (window[:, np.array(offsets) + 3] == ids).all(axis=1)
+
+        idiom = np.full(len(at), np.nan)
+        for offsets in ((-1, 0), (-2, -1, 0), (-2, -1), (-3, -2, -1), (-3, -2)):
+            for ids, value in idioms:
+                if len(ids) == len(offsets):
+                    idiom = np.where(np.isnan(idiom) & seq(offsets, ids), value, idiom)
+        for offsets in ((0, 1), (0, 1, 2)):
+            for ids, value in idioms:
+                if len(ids) == len(offsets):
+                    idiom = np.where(seq(offsets, ids), value, idiom)
+        new = np.where(np.isnan(idiom), v[at], idiom)
+        dampened = np.zeros(len(at), dtype=bool)
+        for ids in bigrams:
+            dampened |= seq((-3, -2), ids) | seq((-2, -1), ids)
+        v = v.copy()
+        v[at] = np.where(dampened, new + self.b_decr, new)
+        return v
+
+
+def utterances(words, pause_ms=PAUSE_MS):
+    """Split timestamped words ([start_ms, end_ms, text], ...) into utterances.
+    Returns the utterance index of each word, and the first word, start and end
+    (ms) of each utterance."""
+    starts = np.array([w[0] for w in words], dtype=np.float64)
+    ends = np.array([w[1] for w in words], dtype=np.float64)
+    texts = np.array([w[2] for w in words], dtype=str)
+    brk = starts[1:] - ends[:-1] >= pause_ms
+    for mark in SENTENCE_END:
+        brk |= np.char.endswith(texts[:-1], mark)
+    utt = np.concatenate(([0], np.cumsum(brk))).astype(np.intp)
+    first = np.flatnonzero(np.concatenate(([True], brk)))
+    last = np.append(first[1:] - 1, len(words) - 1)
+    return utt, first, starts[first], ends[last]
+
+
+def face_windows(timeline, starts, ends, pad=FRAME_PAD):
+    """Mean FER probabilities over the frames within each [start, end] (seconds,
+    widened by `pad`), and the number of frames found for each."""
+    t = np.asarray(timeline['t'], dtype=np.float64)
+    probs = np.asarray(timeline['p'], dtype=np.float64)
+    lo = np.searchsorted(t, starts - pad, side='left')
+    hi = np.searchsorted(t, ends + pad, side='right')
+    # prefix sums make every window an O(1) difference
+    csum = np.vstack((np.zeros(probs.shape[1]), np.cumsum(probs, axis=0)))
+    counts = hi - lo
+    means = (csum[hi] - csum[lo]) / np.maximum(counts, 1)[:, None]
+    return means, counts
+
+
+def mismatches(words, timeline, scorer, max_segments=MAX_SEGMENTS):
+    """Stretches of the check-in where the words and the face disagree.
+
+    Each segment has:
+    - `start`/`end` in seconds and the `text` spoken
+    - the words' mean `sentiment` (VADER compound)
+    - the facial emotion behind the clash (`face`) and the face's mean valence
+    - `kind`: 'positive words, negative face' or the reverse
+
+    Consecutive utterances with the same kind of mismatch are merged. The
+    strongest `max_segments` are returned, in time order."""
+    if not words or timeline is None or not len(timeline):
+        return []
+    utt, first, starts, ends = utterances(words)
+    compound = scorer.score_tokens([w[2] for w in words], utt, len(first))
+    starts, ends = starts / 1000.0, ends / 1000.0
+    means, counts = face_windows(timeline, starts, ends)
+    face = means @ FACE_VALENCE
+    direction = np.sign(compound) * (np.abs(compound) >= TEXT_THRESHOLD)
+    clash = (counts > 0) & (direction != 0) & (np.sign(face) == -direction) & (np.abs(face) >= FACE_THRESHOLD)
+    hits = np.flatnonzero(clash)
+    if not len(hits):
+        return []
+
+    # runs of adjacent mismatching utterances that point the same way
+    groups = np.split(hits, np.flatnonzero((np.diff(hits) != 1) | (np.diff(direction[hits]) != 0)) + 1)
+    segments = []
+    for g in groups:
+        weights = counts[g]
+        face_probs = (means[g] * weights[:, None]).sum(axis=0) / weights.sum()
+        stop = first[g[-1] + 1] if g[-1] + 1 < len(first) else len(words)
+        segments.append({
+            'start': round(float(starts[g[0]]), 2),
+            'end': round(float(ends[g[-1]]), 2),
+            'text': ' '.join(w[2] for w in words[first[g[0]]:stop])[:200],
+            'sentiment': round(float(compound[g].mean()), 4),
+            # the emotion pulling the face the other way, not e.g. a dominant neutral
+            'face': EMOTIONS[int((face_probs * (FACE_VALENCE * -direction[g[0]] > 0)).argmax())],
+            'face_valence': round(float(face_probs @ FACE_VALENCE), 3),
+            'kind': 'positive words, negative face' if direction[g[0]] > 0 else 'negative words, positive face',
+        })
+    segments.sort(key=lambda s: -(abs(s['sentiment']) + abs(s['face_valence'])))
+    return sorted(segments[:max_segments], key=lambda s: s['start'])
+
+
+def _sentences(analyzer, count, seed):
+    """Random sentences mixing lexicon words, boosters, negations and fillers,
+    with ALL-CAPS and punctuation sprinkled in. No sentence repeats a word, as
+    `polarity_scores` scores repeats differently (see the module docstring)."""
+    rng = random.Random(seed)
+    lexicon = sorted(w for w in analyzer.lexicon if w.isalpha())
+    boosters = sorted(analyzer.constants.BOOSTER_DICT)
+    negations = sorted(analyzer.constants.NEGATE)
+    fillers = 'i am the a it was today work and then really very so this not never but least at kind of feel'.split()
+    sentences = []
+    for _ in range(count):
+        words, seen = [], set()
+        for _ in range(rng.randint(3, 20)):
+            r = rng.random()
+            pool = lexicon if r < 0.25 else boosters if r < 0.35 else negations if r < 0.42 else fillers
+            word = rng.choice(pool)
+            # boosters such as "kind of" are several words
+            if seen & set(word.lower().split()):
+                continue
+            seen.update(word.lower().split())
+            if rng.random() < 0.05:
+                word = word.upper()
+            if rng.random() < 0.05:
+                word += rng.choice(('!', ',', '.', '?', '!!'))
+            words.append(word)
+        sentences.append(' '.join(words))
+    return sentences
+
+
+def check(analyzer, count=3000, seed=1, sizes=(1, 3, 5, 10, 20, 50, 100, 200)):
+    """Compare the array pass with `polarity_scores` on `count` generated
+    sentences and time both at each number of utterances in `sizes`.
+    Returns the number of sentences whose compound scores differ."""
+    scorer = BatchVader(analyzer)
+    sentences = _sentences(analyzer, count, seed)
+    expected = np.array([analyzer.polarity_scores(s)['compound'] for s in sentences])
+    tokens, utt = [], []
+    for i, s in enumerate(sentences):
+        words = s.split()
+        tokens.extend(words)
+        utt.extend([i] * len(words))
+    got = scorer.vector_scores(tokens, np.array(utt, dtype=np.intp), len(sentences))
+    bad = np.flatnonzero(np.abs(got - expected) > 1e-4)
+    print(f"{len(bad)} of {len(sentences)} compound scores differ from polarity_scores")
+    for i in bad[:10]:
+        print(f"  {sentences[i]!r}: {expected[i]} vs {got[i]}")
+
+    print("utterances  polarity_scores  array pass  speed-up")
+    for size in sizes:
+        batch = sentences[:size]
+        tokens, utt = [], []
+        for i, s in enumerate(batch):
+            words = s.split()
+            tokens.extend(words)
+            utt.extend([i] * len(words))
+        utt = np.array(utt, dtype=np.intp)
+        reps = max(20, 2000 // size)
+        t0 = time.perf_counter()
+        for _ in range(reps):
+            for s in batch:
+                analyzer.polarity_scores(s)
+        t1 = time.perf_counter()
+        for _ in range(reps):
+            scorer.vector_scores(tokens, utt, size)
+        t2 = time.perf_counter()
+        single, vector = (t1 - t0) / reps * 1000, (t2 - t1) / reps * 1000
+        print(f"{size:>10}  {single:>12.3f} ms  {vector:>7.3f} ms  {single / vector:>7.2f}x")
+    return len(bad)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the vectorised VADER scorer against polarity_scores.')
+    parser.add_argument('--check', action='store_true', help='compare scores and time both scorers')
+    parser.add_argument('--sentences', type=int, default=3000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if not args.check:
+        parser.print_help()
+        sys.exit(0)
+    from nltk.sentiment.vader import SentimentIntensityAnalyzer
+    sys.exit(1 if check(SentimentIntensityAnalyzer(), args.sentences, args.seed) else 0)
@@ -0,0 +1,100 @@
+// server/analysis.js
+// Client for analysis_daemon.py: one long-lived Python process shared by all requests,
+// spoken to with newline-delimited JSON over stdio and correlated by request id.
+import { spawn, spawnSync } from "child_process";
+import { createInterface } from "node:readline";
+import { join } from "node:path";
+
+const DAEMON = join(process.cwd(), "analysis_daemon.py");
+const WORKERS = process.env.ANALYSIS_WORKERS || "2";
+const TIMEOUT_S = Number(process.env.ANALYSIS_TIMEOUT || 600);
+
+// Find a python executable once at startup (try common names)
+function findPython() {
+  const candidates = process.env.PYTHON ? [process.env.PYTHON] : ["python", "python3", "py"];
+  for (const c of candidates) {
+    try {
+      const s = spawnSync(c, ["--version"], { encoding: "utf8" });
+      if (s.status === 0) return c;
+    } catch (e) {
+      // ignore
+    }
+  }
+  return null;
+}
+
+const pyExec = findPython();
+const pending = new Map();
+let proc = null;
+let nextId = 0;
+let restarts = 0;
+
+function failPending(reason) {
+  for (const [, p] of pending) {
+    clearTimeout(p.timer);
+    p.reject(new Error(reason));
+  }
+  pending.clear();
+}
+
+function onLine(line) {
+  let msg;
+  try {
+    msg = JSON.parse(line);
+  } catch (e) {
+    console.error("analysis daemon: unparseable line", line);
+    return;
+  }
+  const p = msg.id != null ? pending.get(msg.id) : null;
+  if (!p) return;
+  if (msg.event) {
+    if (p.onEvent) p.onEvent(msg.event);
+    return;
+  }
+  pending.delete(msg.id);
+  clearTimeout(p.timer);
+  if (msg.ok) p.resolve(msg.result);
+  else p.reject(new Error(msg.error || "analysis failed"));
+}
+
+function start() {
+  if (!pyExec) {
+    console.error("analysis daemon: no python executable found (tried python, python3, py)");
+    return;
+  }
+  // per-session emotion aggregates go into the server's own database, next to users/uploads
+  const env = { ...process.env, EMOTION_DB: process.env.EMOTION_DB || join(process.cwd(), "server", "therapeutic_ai.sqlite3") };
+  proc = spawn(pyExec, [DAEMON, "--workers", WORKERS], { cwd: process.cwd(), env });
+  proc.stderr.on("data", (d) => process.stderr.write(d));
+  createInterface({ input: proc.stdout }).on("line", onLine);
+  proc.on("exit", (code, signal) => {
+    console.error(`analysis daemon exited (code ${code}, signal ${signal}); restarting`);
+    proc = null;
+    failPending("analysis daemon exited");
+    restarts += 1;
+    // back off a little if it keeps dying during startup
+    setTimeout(start, Math.min(1000 * restarts, 10000));
+  });
+  proc.on("error", (e) => console.error("analysis daemon error:", e));
+}
+
+export function request(op, payload = {}, { onEvent, timeout = TIMEOUT_S } = {}) {
+  return new Promise((resolve, reject) => {
+    if (!proc) return reject(new Error("analysis daemon not running"));
+    const id = `r${++nextId}`;
+    const timer = setTimeout(() => {
+      pending.delete(id);
+      reject(new Error(`analysis timed out after ${timeout}s`));
+    }, (timeout + 5) * 1000);
+    pending.set(id, { resolve, reject, onEvent, timer });
+    // the daemon enforces the same timeout by replacing the stuck worker
+    proc.stdin.write(JSON.stringify({ id, op, timeout, ...payload }) + "\n");
+  });
+}
+
+// `session` ({ upload, user_id }) files the clip's emotion aggregates for /api/emotions/trend
+export const analyze = (path, session = {}, opts) => request("analyze", { path, ...session }, opts);
+export const health = () => request("health", {}, { timeout: 5 });
+export const pythonAvailable = () => pyExec !== null;
+
+start();
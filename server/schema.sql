@@ -19,12 +19,87 @@ CREATE TABLE IF NOT EXISTS profiles (
   FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
+-- user_id is NULL for anonymous uploads from the Flask recorder; deleted_at is set when the
+-- retention sweeper removes the file
 CREATE TABLE IF NOT EXISTS uploads (
   id        INTEGER PRIMARY KEY AUTOINCREMENT,
-  user_id   INTEGER NOT NULL,
+  user_id   INTEGER,
   filename  TEXT NOT NULL,
   stored_as TEXT NOT NULL,
   size_bytes INTEGER NOT NULL,
+  content_hash TEXT,
   created_at TEXT DEFAULT (datetime('now')),
+  deleted_at TEXT,
   FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 );
+
+CREATE INDEX IF NOT EXISTS idx_uploads_stored_as ON uploads(stored_as);
+
+-- resumable chunked uploads in progress (flask_api /upload); completed ones are also in `uploads`
+CREATE TABLE IF NOT EXISTS upload_sessions (
+  id         TEXT PRIMARY KEY,
+  filename   TEXT NOT NULL,
+  stored_as  TEXT NOT NULL,
+  size_bytes INTEGER,
+  received   INTEGER NOT NULL DEFAULT 0,
+  sha256     TEXT,
+  status     TEXT NOT NULL DEFAULT 'open',
+  created_at INTEGER NOT NULL,
+  updated_at INTEGER NOT NULL
+);
+
+-- per-recording emotion aggregates over the clip's per-face timeline (server/timelines/<content_hash>.npy);
+-- the means have their own columns so a user's trend is one indexed query
+CREATE TABLE IF NOT EXISTS emotion_sessions (
+  id           INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id      INTEGER,
+  upload       TEXT UNIQUE,
+  content_hash TEXT NOT NULL,
+  recorded_at  INTEGER NOT NULL,
+  duration     REAL NOT NULL,
+  faces        INTEGER NOT NULL,
+  dominant     TEXT,
+  mean_angry    REAL NOT NULL,
+  mean_disgust  REAL NOT NULL,
+  mean_fear     REAL NOT NULL,
+  mean_happy    REAL NOT NULL,
+  mean_sad      REAL NOT NULL,
+  mean_surprise REAL NOT NULL,
+  mean_neutral  REAL NOT NULL,
+  stats        TEXT NOT NULL,
+  FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_emotion_sessions_user ON emotion_sessions(user_id, recorded_at);
+
+CREATE TABLE IF NOT EXISTS conversations (
+  session_id TEXT PRIMARY KEY,
+  user_id    INTEGER,
+  created_at TEXT DEFAULT (datetime('now')),
+  FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL
+);
+
+-- append-only chat log; analysis rows (kind = 'analysis') carry structured emotions/sentiment
+CREATE TABLE IF NOT EXISTS messages (
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  session_id TEXT NOT NULL,
+  role       TEXT NOT NULL,
+  content    TEXT NOT NULL,
+  kind       TEXT NOT NULL DEFAULT 'message',
+  emotions   TEXT,
+  sentiment  TEXT,
+  cancelled  INTEGER NOT NULL DEFAULT 0,
+  ts         INTEGER NOT NULL,
+  FOREIGN KEY (session_id) REFERENCES conversations(session_id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id);
+
+-- rolling summary of the oldest `covered` messages of a session, maintained by the prompt builder
+CREATE TABLE IF NOT EXISTS conversation_summaries (
+  session_id TEXT PRIMARY KEY,
+  summary    TEXT NOT NULL,
+  covered    INTEGER NOT NULL,
+  updated_at TEXT DEFAULT (datetime('now')),
+  FOREIGN KEY (session_id) REFERENCES conversations(session_id) ON DELETE CASCADE
+);
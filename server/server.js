@@ -6,9 +6,9 @@ import { body, validationResult } from "express-validator";
 import bcrypt from "bcrypt";
 import jwt from "jsonwebtoken";
 import multer from "multer";
-import { spawn, spawnSync } from "child_process";
 import { join } from "node:path";
 import db from "./db.js";
+import * as analysis from "./analysis.js";
 
 // --- config ---
 dotenv.config({ path: join(process.cwd(), "server", ".env") });
@@ -23,6 +23,13 @@ app.use("/uploads", express.static(join(process.cwd(), "server", "uploads")));
 
 // --- health ---
 app.get("/api/health", (_req, res) => res.json({ ok: true }));
+app.get("/api/health/analysis", async (_req, res) => {
+  try {
+    res.json(await analysis.health());
+  } catch (e) {
+    res.status(503).json({ ready: false, error: e.message });
+  }
+});
 
 /* ===================== AUTH ===================== */
 app.post(
@@ -98,6 +105,17 @@ function auth(req, res, next) {
   }
 }
 
+// the signed-in user's id when a valid token is sent, else null (for routes open to guests)
+function optionalUserId(req) {
+  const hdr = req.headers.authorization || "";
+  if (!hdr.startsWith("Bearer ")) return null;
+  try {
+    return jwt.verify(hdr.slice(7), JWT_SECRET).id;
+  } catch {
+    return null;
+  }
+}
+
 app.get("/api/me", auth, async (req, res) => {
   const id = req.user.id;
   const user = await db.get(
@@ -164,48 +182,52 @@ app.post("/api/upload", auth, upload.single("file"), async (req, res) => {
   res.json({ ok: true, url: `/uploads/${req.file.filename}` });
 });
 
-// Receive a recorded video, run Python analysis, return JSON
+// Receive a recorded video, run it through the analysis daemon, return JSON
 app.post("/record", upload.single("file"), async (req, res) => {
   try {
     if (!req.file) return res.status(400).json({ error: 'No file' });
     console.log(`/record received file: ${req.file.originalname} -> ${req.file.filename} (${req.file.size} bytes)`);
+    if (!analysis.pythonAvailable()) return res.status(500).json({ error: 'No python executable found on server (tried python, python3, py)' });
     const filePath = join(process.cwd(), "server", "uploads", req.file.filename);
-    // Find a python executable (try common names)
-    const candidates = ['python', 'python3', 'py'];
-    let pyExec = null;
-    for (const c of candidates) {
-      try {
-        const s = spawnSync(c, ['--version'], { encoding: 'utf8' });
-        if (s.status === 0) { pyExec = c; break; }
-      } catch (e) {
-        // ignore
-      }
-    }
-    if (!pyExec) return res.status(500).json({ error: 'No python executable found on server (tried python, python3, py)' });
-
-    // Spawn the Python process (ffmpeg and Python dependencies must be available)
-    console.log('Spawning python analysis with:', pyExec, join(process.cwd(), 'therapyAI.py'));
-    const py = spawn(pyExec, [join(process.cwd(), 'therapyAI.py'), filePath], { cwd: process.cwd(), env: process.env });
-    let out = '';
-    let err = '';
-    py.stdout.on('data', (d) => { out += d.toString(); });
-    py.stderr.on('data', (d) => { err += d.toString(); });
-    py.on('close', (code) => {
-      if (err) console.error('Python stderr:', err);
-      try {
-        const j = JSON.parse(out);
-        res.json(j);
-      } catch (e) {
-        console.error('Failed parsing python output', e, out);
-        res.status(500).json({ error: 'Python analysis failed', detail: out || err });
-      }
-    });
+    const result = await analysis.analyze(filePath, { upload: req.file.filename, user_id: optionalUserId(req) });
+    res.json(result);
   } catch (e) {
-    console.error(e);
-    res.status(500).json({ error: 'Record processing failed', detail: e.message });
+    console.error('Python analysis failed:', e);
+    res.status(500).json({ error: 'Python analysis failed', detail: e.message });
   }
 });
 
+/* ===================== EMOTION TRENDS ===================== */
+const EMOTIONS = ["angry", "disgust", "fear", "happy", "sad", "surprise", "neutral"];
+
+// Emotion trend over the signed-in user's last N recordings, from the per-session
+// aggregates the analysis daemon stores (one indexed query, no video re-analysis)
+app.get("/api/emotions/trend", auth, async (req, res) => {
+  const n = Math.max(1, Math.min(Number.parseInt(req.query.sessions, 10) || 10, 500));
+  const rows = await db.all(
+    `SELECT id, upload, recorded_at, duration, faces, dominant, ${EMOTIONS.map((e) => `mean_${e}`).join(", ")}
+     FROM emotion_sessions WHERE user_id = ? ORDER BY recorded_at DESC, id DESC LIMIT ?`,
+    [req.user.id, n]
+  );
+  rows.reverse();
+  const sessions = rows.map((r) => ({
+    id: r.id, upload: r.upload, recorded_at: r.recorded_at, duration: r.duration, faces: r.faces,
+    dominant: r.dominant, means: Object.fromEntries(EMOTIONS.map((e) => [e, r[`mean_${e}`]])),
+  }));
+  // overall mean and least-squares slope per session of each emotion (same as flask_api's /emotions/trend)
+  const means = {};
+  const slope = {};
+  if (rows.length) {
+    const xs = rows.map((_, i) => i - (rows.length - 1) / 2);
+    const denom = xs.reduce((a, x) => a + x * x, 0);
+    for (const e of EMOTIONS) {
+      const ys = rows.map((r) => r[`mean_${e}`]);
+      means[e] = Math.round((ys.reduce((a, y) => a + y, 0) / ys.length) * 1e4) / 1e4;
+      slope[e] = denom ? Math.round((xs.reduce((a, x, i) => a + x * ys[i], 0) / denom) * 1e4) / 1e4 : 0;
+    }
+  }
+  res.json({ user_id: req.user.id, sessions, means, slope });
+});
 
 app.use(express.static(join(process.cwd())));
 app.get(/^(?!\/api\/).*/, (_req, res) => {
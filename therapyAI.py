@@ -1,153 +1,389 @@
+import os
 import time
 import sys
 
-import requests
-import time
+import metrics
+from transcription import TranscriptionClient
+
+# AssemblyAI settings. TRANSCRIBE_EXTRACT_AUDIO=0 uploads the whole video instead of an
+# ffmpeg-extracted mono audio track; TRANSCRIBE_WEBHOOK_URL (pointing at flask_api's
+# /webhooks/assemblyai) switches to completion callbacks with polling as a fallback.
+ASSEMBLYAI_API_KEY = os.environ.get('ASSEMBLYAI_API_KEY', "6a35340cac1c443e8e4bbc1d027a3ad5")
+ASSEMBLYAI_BASE_URL = os.environ.get('ASSEMBLYAI_BASE_URL', "https://api.assemblyai.com")
+
+transcriber = TranscriptionClient(
+  ASSEMBLYAI_API_KEY,
+  base_url=ASSEMBLYAI_BASE_URL,
+  extract_audio=os.environ.get('TRANSCRIBE_EXTRACT_AUDIO', '1') != '0',
+  timeout=float(os.environ.get('TRANSCRIBE_TIMEOUT', 300)),
+  webhook_url=os.environ.get('TRANSCRIBE_WEBHOOK_URL') or None,
+  webhook_secret=os.environ.get('TRANSCRIBE_WEBHOOK_SECRET') or None,
+)
+
+def transcribe_timed(filepath):
+  """Transcript text plus its words as compact [start_ms, end_ms, text] triples."""
+  result = transcriber.transcribe_detailed(filepath)
+  info = result.get('_client', {})
+  metrics.TRANSCRIBE_POLLS.observe(info.get('polls', 0))
+  metrics.UPLOAD_BYTES.observe(info.get('upload_bytes', 0))
+  metrics.annotate('stage.transcribe', **info)
+  words = [[w['start'], w['end'], w['text']] for w in result.get('words') or []]
+  return {'text': result['text'], 'words': words}
 
 def transcribe_audio(filepath):
-  base_url = "https://api.assemblyai.com"
-
-  headers = {
-      "authorization": "6a35340cac1c443e8e4bbc1d027a3ad5"
-  }
-  with open(filepath, "rb") as f:
-    response = requests.post(base_url + "/v2/upload",
-                            headers=headers,
-                            data=f)
-
-  audio_url = response.json()["upload_url"]
-
-
-  data = {
-      "audio_url": audio_url,
-      "speech_model": "universal"
-  }
-
-  url = base_url + "/v2/transcript"
-  response = requests.post(url, json=data, headers=headers)
-
-  transcript_id = response.json()['id']
-  polling_endpoint = base_url + "/v2/transcript/" + transcript_id
-
-  while True:
-    transcription_result = requests.get(polling_endpoint, headers=headers).json()
-    transcript_text = transcription_result['text']
+  return transcribe_timed(filepath)['text']
 
-    if transcription_result['status'] == 'completed':
-      print("Transcription completed.", file=sys.stderr)
-      return transcript_text
-      # with open("transcript.txt", "w") as file:
-      #   file.write(transcript_text) # we don't necessarily need to write it into a file
-      # file.close()
+from model_registry import registry, get_sentiment_analyzer, get_batch_sentiment_scorer
 
-    elif transcription_result['status'] == 'error':
-      raise RuntimeError(f"Transcription failed: {transcription_result['error']}")
-
-    else:
-      time.sleep(3)
-
-import nltk
-import pandas as pd
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
-from nltk.sentiment.util import *
-
-def determine_sentiment(text):
-    analyzer = SentimentIntensityAnalyzer()
-    score = analyzer.polarity_scores(text)
-    if score['compound'] >= 0.05:
+def _sentiment_label(compound):
+    if compound >= 0.05:
         return 'positive'
-    elif score['compound'] <= -0.05:
+    elif compound <= -0.05:
         return 'negative'
     else:
         return 'neutral'
-    
-from fer.fer import FER
-from fer.classes import Video
-import pandas as pd
 
-def analyze_video_emotions(video_path):
-  emotion_detector = FER(mtcnn=True)
-  video = Video(video_path)
+def determine_sentiment(text):
+    analyzer = get_sentiment_analyzer()
+    score = analyzer.polarity_scores(text)
+    return _sentiment_label(score['compound'])
+
+def determine_sentiments(texts):
+    # batch form for `python -m therapyAI batch`: every text scored in one vectorised pass
+    return [_sentiment_label(score) for score in get_batch_sentiment_scorer().score(texts)]
+
+def _transcript_sentiment(transcript):
+    return determine_sentiment(transcript['text'])
+    
+from emotion_engine import EmotionEngine
+from emotion_timeline import save_timeline, load_timeline
+import sentiment_timeline
+
+# FER sampling: analyse every FER_FREQUENCY-th frame; FER_ADAPTIVE=1 widens the stride
+# while emotions are stable and stops once the top-2 ranking has converged
+FER_FREQUENCY = int(os.environ.get('FER_FREQUENCY', 15))
+FER_ADAPTIVE = os.environ.get('FER_ADAPTIVE', '0') == '1'
+FER_BATCH = int(os.environ.get('FER_BATCH', 8))
+# Per-face emotion timelines, one .npy per clip content hash (see emotion_timeline.py); EMOTION_TIMELINE=0 disables
+EMOTION_TIMELINE = os.environ.get('EMOTION_TIMELINE', '1') != '0'
+EMOTION_TIMELINE_DIR = os.environ.get('EMOTION_TIMELINE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server', 'timelines'))
+
+def analyze_video_emotions_detailed(video_path, content_hash=None):
+  """Top-2 emotions plus frame/face counts; the counts travel back from the FER
+  worker process with the result so the parent can record them. With a
+  `content_hash` the per-face timeline is written to EMOTION_TIMELINE_DIR."""
+  keep_timeline = EMOTION_TIMELINE and bool(content_hash)
+  # shared detector from the model registry; FER is not thread-safe so hold its lock
+  engine = EmotionEngine(registry.get('fer'), frequency=FER_FREQUENCY, batch_size=FER_BATCH, adaptive=FER_ADAPTIVE)
   try:
-    frames_emotions = video.analyze(emotion_detector, display=False, frequency=15)
-    # frames_emotions may be empty if no faces/frames were detected
-    if not frames_emotions:
-      print("Video emotion analysis returned no frames/metadata.", file=sys.stderr)
-      return []
-    df = pd.DataFrame(frames_emotions)
-    print("Video emotion analysis complete.", file=sys.stderr)
-    stats = df.describe()
-    # pick top 2 dominant emotion labels if available
-    emotions = stats.loc['mean'].nlargest(2).index.tolist()
-    return emotions
+    with registry.lock('fer'):
+      summary = engine.analyze(video_path, timeline=keep_timeline)
   except Exception as e:
+    # the pipeline falls back to [] for us; raising keeps the failure out of the result cache
     print(f"video analysis failed: {e}", file=sys.stderr)
+    raise
+  stats = {'frames_read': summary.frames_read, 'frames_sampled': summary.frames_sampled, 'faces': summary.count}
+  if keep_timeline and summary.count:
+    try:
+      save_timeline(EMOTION_TIMELINE_DIR, content_hash, *summary.timeline())
+    except Exception as e:
+      # the emotions themselves are fine; only the trend data for this clip is lost
+      print(f"saving emotion timeline failed: {e}", file=sys.stderr)
+  # no faces found in any sampled frame
+  if not summary.count:
+    print("Video emotion analysis returned no frames/metadata.", file=sys.stderr)
+    return {'emotions': [], **stats}
+  print(f"Video emotion analysis complete ({summary.count} faces, {summary.frames_sampled}/{summary.frames_read} frames sampled).", file=sys.stderr)
+  # top 2 labels by mean probability
+  return {'emotions': summary.top(2), **stats}
+
+def analyze_video_emotions(video_path, content_hash=None):
+  return analyze_video_emotions_detailed(video_path, content_hash)['emotions']
+
+def align_transcript(transcript, emotions, content_hash):
+  """Segments where the words and the face disagree (see sentiment_timeline).
+  `emotions` is unused; taking it makes the stage wait until FER has written
+  the clip's timeline."""
+  if not content_hash or not transcript.get('words'):
     return []
+  timeline = load_timeline(EMOTION_TIMELINE_DIR, content_hash)
+  return sentiment_timeline.mismatches(transcript['words'], timeline, get_batch_sentiment_scorer())
+
+def _record_fer(result):
+  metrics.FER_FRAMES.inc(result['frames_read'], kind='read')
+  metrics.FER_FRAMES.inc(result['frames_sampled'], kind='sampled')
+  metrics.FER_FACES.inc(result['faces'])
+  metrics.annotate('stage.emotions', frames_read=result['frames_read'],
+                   frames_sampled=result['frames_sampled'], faces=result['faces'])
+  return result['emotions']
 
 from ollama import chat
 from ollama import ChatResponse
 
-def chatbot_response(emotions, sentiment, text, history=None):
-  # Safely handle missing or short emotions list
-  em1 = 'neutral'
-  em2 = 'neutral'
-  try:
-    if emotions and len(emotions) > 0:
-      em1 = emotions[0]
-    if emotions and len(emotions) > 1:
-      em2 = emotions[1]
-  except Exception:
-    em1 = em2 = 'neutral'
-
+from prompt_builder import PromptBuilder, SUMMARY_PROMPT
+
+CHAT_MODEL = os.environ.get('CHAT_MODEL', 'gemma3')
+# Keep the model loaded in Ollama between turns, and give it a context window that fits the prompt budget
+CHAT_KEEP_ALIVE = os.environ.get('CHAT_KEEP_ALIVE', '30m')
+CHAT_NUM_CTX = int(os.environ.get('CHAT_NUM_CTX', 8192))
+PROMPT_TOKEN_BUDGET = int(os.environ.get('PROMPT_TOKEN_BUDGET', 6000))
+
+def _chat(messages, **kwargs):
+  return chat(model=CHAT_MODEL, messages=messages, keep_alive=CHAT_KEEP_ALIVE,
+              options={'num_ctx': CHAT_NUM_CTX}, **kwargs)
+
+def summarize_turns(summary, messages):
+  # incremental rolling summary: previous summary + the turns being folded out of the prompt
+  turns = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+  with metrics.span('chat.summarize', turns=len(messages)):
+    response: ChatResponse = _chat([
+      {'role': 'system', 'content': SUMMARY_PROMPT},
+      {'role': 'user', 'content': f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{turns}"},
+    ])
+  _count_tokens(response, 'summary')
+  return response.message.content
+
+def _count_tokens(response, mode):
+  # Ollama reports prompt/completion token counts on the final (or only) response
+  prompt, completion = getattr(response, 'prompt_eval_count', None), getattr(response, 'eval_count', None)
+  if prompt:
+    metrics.CHAT_TOKENS.inc(prompt, kind='prompt', mode=mode)
+  if completion:
+    metrics.CHAT_TOKENS.inc(completion, kind='completion', mode=mode)
+  return prompt, completion
+
+# callers that persist history (flask_api) pass their store as `summary_store`, so
+# rolling summaries live next to the session; otherwise they stay in this process
+prompt_builder = PromptBuilder(budget=PROMPT_TOKEN_BUDGET, summarizer=summarize_turns)
+
+def _build_messages(emotions, sentiment, text, history=None, session_id=None, mismatches=None, summary_store=None):
+  with metrics.span('chat.prompt') as sp:
+    msgs = prompt_builder.build(history, text, emotions=emotions, sentiment=sentiment, session_id=session_id,
+                                mismatches=mismatches, store=summary_store)
+    sp.set(messages=len(msgs))
+  return msgs
+
+def chatbot_response(emotions, sentiment, text, history=None, session_id=None, mismatches=None, summary_store=None):
   try:
-    # Build messages with optional history; keep a helpful system prompt first
-    # build emotion description: omit the second emotion if it's neutral
-    if em2 and em2 != 'neutral':
-      emotions_desc = f"the user's primary emotions {em1} and {em2}"
-    else:
-      emotions_desc = f"the user's primary emotion {em1}"
-
-    system_msg = {
-      'role': 'system',
-      'content': (
-        f"Based on {emotions_desc} from the video analysis, and "
-        f"based on the sentiment of the text which is {sentiment}, be a therapeutic, empathetic assistant. "
-        f"Provide supportive advice and surface any inconsistencies between sentiment and facial emotion. "
-        f"If a follow-up question is necessary to clarify risk or safety, ask gently; otherwise prefer reflection and concrete coping suggestions."
-      )
-    }
-
-    msgs = [system_msg]
-    # Append any prior conversation messages (expects list of {role, content})
-    if history and isinstance(history, list):
-      for m in history:
-        # only allow role and content
-        if isinstance(m, dict) and 'role' in m and 'content' in m:
-          msgs.append({'role': m['role'], 'content': m['content']})
-
-    # append the current user utterance
-    msgs.append({'role': 'user', 'content': text})
-
-    response: ChatResponse = chat(model='gemma3', messages=msgs)
+    msgs = _build_messages(emotions, sentiment, text, history, session_id, mismatches, summary_store)
+    with metrics.span('chat.generate') as sp:
+      response: ChatResponse = _chat(msgs)
+      prompt, completion = _count_tokens(response, 'full')
+      sp.set(prompt_tokens=prompt, completion_tokens=completion)
     return response.message.content
   except Exception as e:
     print(f"chatbot error: {e}", file=sys.stderr)
     return f"(chatbot error: {e})"
 
-def main(filepath):
-   text = transcribe_audio(filepath)
-   sentiment = determine_sentiment(text)
-   emotions = analyze_video_emotions(filepath)
-   response = chatbot_response(emotions, sentiment, text)
-   return {
-       "text": text,
-       "sentiment": sentiment,
-       "emotions": emotions,
-       "response": response
+class ChatStream:
+  """Iterate to receive the reply as it is generated, one text piece at a time.
+  After iteration (or close()) `text` holds the reply so far, `done` tells a
+  finished reply from a cancelled one, and stats() gives time-to-first-token
+  and generation speed."""
+
+  def __init__(self, msgs):
+    self.msgs = msgs
+    self.parts = []
+    self.done = False
+    self.error = None
+    self.started = None
+    self.first_token = None
+    self.finished = None
+    self.eval_count = None
+    self.eval_duration = None
+    self.prompt_eval_count = None
+    self._chunks = None
+
+  @property
+  def text(self):
+    return ''.join(self.parts)
+
+  def __iter__(self):
+    self.started = time.perf_counter()
+    try:
+      self._chunks = _chat(self.msgs, stream=True)
+      for chunk in self._chunks:
+        piece = chunk.message.content or ''
+        if piece:
+          if self.first_token is None:
+            self.first_token = time.perf_counter()
+          self.parts.append(piece)
+          yield piece
+        if chunk.done:
+          # Ollama's own count/timing of generated tokens, reported on the last chunk
+          self.eval_count = getattr(chunk, 'eval_count', None)
+          self.eval_duration = getattr(chunk, 'eval_duration', None)
+          self.prompt_eval_count = _count_tokens(chunk, 'stream')[0]
+      self.done = True
+    except Exception as e:
+      print(f"chatbot error: {e}", file=sys.stderr)
+      self.error = str(e)
+    finally:
+      # after a close() the abandoned generator only finishes when collected; it was recorded then
+      if self.finished is None:
+        self.finished = time.perf_counter()
+        self._record()
+
+  def _record(self):
+    if self.first_token is not None:
+      metrics.CHAT_TTFT.observe(self.first_token - self.started)
+    metrics.record('chat.stream', self.finished - self.started, error=self.error is not None)
+
+  def close(self):
+    # stop pulling from Ollama; closing the response iterator drops the HTTP stream
+    if self._chunks is not None and hasattr(self._chunks, 'close'):
+      self._chunks.close()
+    if self.finished is None and self.started is not None:
+      self.finished = time.perf_counter()
+      self._record()
+
+  def stats(self):
+    tokens = self.eval_count or len(self.parts)
+    if self.eval_count and self.eval_duration:
+      gen_seconds = self.eval_duration / 1e9
+    elif self.first_token is not None and self.finished is not None:
+      gen_seconds = self.finished - self.first_token
+    else:
+      gen_seconds = 0
+    return {
+      'ttft_ms': round((self.first_token - self.started) * 1000, 1) if self.first_token is not None else None,
+      'tokens': tokens,
+      'tokens_per_sec': round(tokens / gen_seconds, 2) if gen_seconds > 0 else None,
+      'total_ms': round((self.finished - self.started) * 1000, 1) if self.finished is not None and self.started is not None else None,
+    }
+
+def chatbot_stream(emotions, sentiment, text, history=None, session_id=None, mismatches=None, summary_store=None):
+  """Streaming variant of chatbot_response: returns a ChatStream yielding tokens."""
+  return ChatStream(_build_messages(emotions, sentiment, text, history, session_id, mismatches, summary_store))
+
+import multiprocessing
+import concurrent.futures as cf
+from concurrent.futures.process import BrokenProcessPool
+from pipeline import Pipeline, Stage
+from result_cache import ResultCache, file_sha256
+
+# Stage limits in seconds; a timed-out optional stage falls back to its default
+TRANSCRIBE_TIMEOUT = transcriber.timeout
+FER_TIMEOUT = float(os.environ.get('FER_TIMEOUT', 120))
+CHAT_TIMEOUT = float(os.environ.get('CHAT_TIMEOUT', 180))
+# FER worker processes (keeps the CPU-bound pass off the GIL); 0 runs FER on a thread instead
+FER_PROCESSES = int(os.environ.get('FER_PROCESSES', 1))
+# Per-stage result cache keyed by upload content hash; RESULT_CACHE=0 disables it
+RESULT_CACHE = os.environ.get('RESULT_CACHE', '1') != '0'
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server', 'result_cache.sqlite3'))
+RESULT_CACHE_MB = float(os.environ.get('RESULT_CACHE_MB', 64))
+
+# Bump a stage's version whenever its output for the same clip would change
+# (model, service or config change); old entries then simply stop matching.
+TRANSCRIBE_VERSION = 'assemblyai-universal-2/words'
+SENTIMENT_VERSION = f"vader-1/{TRANSCRIBE_VERSION}"
+# the emotions stage also writes the clip's timeline, so entries from runs that didn't must miss
+EMOTIONS_VERSION = f"fer-engine-2/freq={FER_FREQUENCY}/adaptive={int(FER_ADAPTIVE)}/timeline={int(EMOTION_TIMELINE)}"
+
+cache = ResultCache(RESULT_CACHE_PATH, max_bytes=int(RESULT_CACHE_MB * 1024 * 1024)) if RESULT_CACHE else None
+
+def _init_fer_worker():
+  # runs once in each FER worker process so the first video doesn't pay for model loading
+  registry.get('fer')
+
+def _fer_worker_ready():
+  return os.getpid()
+
+def _start_fer_pool():
+  # spawn rather than fork: forking a process that already holds TF/threads is unsafe
+  pool = cf.ProcessPoolExecutor(max_workers=FER_PROCESSES,
+                                mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_init_fer_worker)
+  pool.submit(_fer_worker_ready).result()
+  return pool
+
+def _fer_executor():
+  return registry.get('fer_pool')
+
+def _on_fer_error(exc):
+  # a crashed worker breaks the whole pool; rebuild it in the background for the next request
+  if isinstance(exc, BrokenProcessPool):
+    import threading
+    threading.Thread(target=registry.reload, args=(['fer_pool'],), daemon=True).start()
+
+if FER_PROCESSES > 0:
+  # FER lives in the worker processes; this process only owns the pool
+  registry.set_eager('fer', False)
+  registry.register('fer_pool', _start_fer_pool, close=lambda pool: pool.shutdown(wait=False))
+
+# transcription (network wait) and FER (CPU) run side by side; sentiment follows the
+# transcript and the chatbot starts once both branches are in
+transcribe_stage = Stage('transcribe', transcribe_timed, ('filepath',), timeout=TRANSCRIBE_TIMEOUT,
+                         cache_version=TRANSCRIBE_VERSION)
+sentiment_stage = Stage('sentiment', _transcript_sentiment, ('transcribe',), required=False, default='neutral',
+                        cache_version=SENTIMENT_VERSION)
+
+def _chatbot_stage(emotions, sentiment, transcript, mismatches):
+  return chatbot_response(emotions, sentiment, transcript['text'], mismatches=mismatches)
+
+pipeline = Pipeline([
+  transcribe_stage,
+  sentiment_stage,
+  Stage('emotions', analyze_video_emotions_detailed, ('filepath', 'content_hash'), timeout=FER_TIMEOUT,
+        executor=_fer_executor if FER_PROCESSES > 0 else None, required=False, default=[], on_error=_on_fer_error,
+        cache_version=EMOTIONS_VERSION, on_result=_record_fer),
+  # word-level sentiment against the FER timeline; milliseconds, so not worth caching
+  Stage('alignment', align_transcript, ('transcribe', 'emotions', 'content_hash'), required=False, default=[]),
+  Stage('chatbot', _chatbot_stage, ('emotions', 'sentiment', 'transcribe', 'alignment'), timeout=CHAT_TIMEOUT,
+        required=False, default=None),
+])
+
+# chat replies are transcribed and scored but never run through FER
+reply_pipeline = Pipeline([transcribe_stage, sentiment_stage], executor=pipeline.executor)
+
+def _run(pipe, filepath, progress, content_hash):
+  # the hash keys both the result cache and the clip's emotion timeline
+  if (cache is not None or EMOTION_TIMELINE) and content_hash is None:
+    content_hash = file_sha256(filepath)
+  return pipe.run({'filepath': filepath, 'content_hash': content_hash}, progress=progress, cache=cache,
+                  cache_key=content_hash)
+
+def analyze_reply(filepath, progress=None, content_hash=None):
+  run = _run(reply_pipeline, filepath, progress, content_hash)
+  out = {"text": run.values['transcribe']['text'], "sentiment": run.values['sentiment'], "emotions": [],
+         "cache": run.cache}
+  if run.errors:
+    out["errors"] = run.errors
+  return out
+
+def main(filepath, progress=None, content_hash=None):
+   run = _run(pipeline, filepath, progress, content_hash)
+   out = {
+       "text": run.values['transcribe']['text'],
+       "sentiment": run.values['sentiment'],
+       "emotions": run.values['emotions'],
+       "mismatches": run.values['alignment'],
+       "response": run.values['chatbot'],
+       "cache": run.cache
    }
+   if run.errors:
+       # partial result: report which optional stages fell back to defaults
+       out["errors"] = run.errors
+   return out
 
   
 
+if __name__ == '__main__':
+  # `python -m therapyAI batch <dir|glob>` re-scores a set of recordings (see batch.py);
+  # `python -m therapyAI <video>` analyses one clip and prints the result as JSON
+  import json
+  sys.modules.setdefault('therapyAI', sys.modules[__name__])  # so batch.py reuses this module instead of re-importing it
+  if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+    import batch
+    sys.exit(batch.main(sys.argv[2:]))
+  if len(sys.argv) < 2:
+    print(json.dumps({"error": "No video file path provided"}))
+    sys.exit(1)
+  if not os.path.exists(sys.argv[1]):
+    print(json.dumps({"error": "Video file not found"}))
+    sys.exit(1)
+  print(json.dumps(main(sys.argv[1])))
+
 # import flask
 # from flask import Flask, render_template
 # import jsonify
@@ -0,0 +1,166 @@
+"""AssemblyAI transcription client.
+
+One `TranscriptionClient` is shared by the whole process. It keeps a pooled
+`requests.Session` so upload, create and poll calls reuse connections. It can
+strip the video track locally with ffmpeg so only compressed mono audio is
+uploaded, and it polls with exponential backoff plus jitter. When a webhook URL
+is configured, AssemblyAI's completion callback wakes the waiting request right
+away and polling becomes a slow fallback.
+"""
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+
+class TranscriptionError(RuntimeError):
+    pass
+
+
+def extract_audio(video_path, ffmpeg='ffmpeg'):
+    """Write the audio track of `video_path` to a temporary 16 kHz mono Opus
+    file and return its path (the caller deletes it). Opus at 24 kbit/s is a
+    fraction of the size of the recorded WebM/MP4 and plenty for speech."""
+    fd, out_path = tempfile.mkstemp(suffix='.ogg')
+    os.close(fd)
+    try:
+        subprocess.run([
+            ffmpeg, '-y', '-loglevel', 'error', '-i', str(video_path),
+            '-vn', '-ac', '1', '-ar', '16000', '-c:a', 'libopus', '-b:a', '24k', out_path
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except Exception:
+        os.unlink(out_path)
+        raise
+    return out_path
+
+
+class TranscriptionClient:
+    def __init__(self, api_key, base_url='https://api.assemblyai.com', speech_model='universal',
+                 extract_audio=True, ffmpeg=None, poll_initial=0.5, poll_max=5.0, poll_factor=1.6,
+                 timeout=300, webhook_url=None, webhook_secret=None, pool_size=10):
+        """`extract_audio` uploads an ffmpeg-extracted audio track instead of the
+        whole container when ffmpeg is available. Polling starts at
+        `poll_initial` seconds and grows by `poll_factor` up to `poll_max`, each
+        wait jittered; `timeout` bounds the whole transcription. With
+        `webhook_url`, AssemblyAI calls back on completion (see `notify`)."""
+        self.base_url = base_url.rstrip('/')
+        self.speech_model = speech_model
+        self.ffmpeg = ffmpeg or shutil.which('ffmpeg')
+        self.extract_audio = extract_audio and self.ffmpeg is not None
+        self.poll_initial = poll_initial
+        self.poll_max = poll_max
+        self.poll_factor = poll_factor
+        self.timeout = timeout
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.session = requests.Session()
+        self.session.headers['authorization'] = api_key
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._waiters = {}
+        self._waiters_lock = threading.Lock()
+
+    def transcribe(self, filepath):
+        return self.transcribe_detailed(filepath)['text']
+
+    def transcribe_detailed(self, filepath):
+        """Transcribe `filepath` and return the full AssemblyAI transcript
+        object (text, words with timestamps, ...) plus a `_client` dict with
+        upload size and poll count."""
+        deadline = time.monotonic() + self.timeout
+        with metrics.span('transcribe.upload') as sp:
+            audio_url, upload_bytes = self.upload(filepath)
+            sp.set(bytes=upload_bytes)
+        transcript_id = self.create(audio_url)
+        with metrics.span('transcribe.wait') as sp:
+            result, polls = self.wait(transcript_id, deadline)
+            sp.set(polls=polls)
+        result['_client'] = {'upload_bytes': upload_bytes, 'polls': polls}
+        return result
+
+    def upload(self, filepath):
+        path, tmp = filepath, None
+        if self.extract_audio:
+            try:
+                tmp = path = extract_audio(filepath, self.ffmpeg)
+            except Exception as e:
+                # fall back to the original container; the service extracts audio itself
+                print(f"audio extraction failed, uploading original file: {e}", file=sys.stderr)
+                path = filepath
+        try:
+            size = os.path.getsize(path)
+            with open(path, 'rb') as f:
+                r = self.session.post(self.base_url + '/v2/upload', data=f)
+            r.raise_for_status()
+            return r.json()['upload_url'], size
+        finally:
+            if tmp:
+                os.unlink(tmp)
+
+    def create(self, audio_url):
+        data = {'audio_url': audio_url, 'speech_model': self.speech_model}
+        if self.webhook_url:
+            data['webhook_url'] = self.webhook_url
+            if self.webhook_secret:
+                data['webhook_auth_header_name'] = 'X-Webhook-Secret'
+                data['webhook_auth_header_value'] = self.webhook_secret
+        r = self.session.post(self.base_url + '/v2/transcript', json=data)
+        r.raise_for_status()
+        return r.json()['id']
+
+    def wait(self, transcript_id, deadline):
+        """Poll until the transcript completes or errors. Waits are interrupted
+        by `notify()` so a webhook ends the wait immediately."""
+        event = threading.Event()
+        with self._waiters_lock:
+            self._waiters[transcript_id] = event
+        delay = self.poll_initial
+        polls = 0
+        endpoint = f"{self.base_url}/v2/transcript/{transcript_id}"
+        try:
+            while True:
+                polls += 1
+                r = self.session.get(endpoint)
+                r.raise_for_status()
+                result = r.json()
+                if result['status'] == 'completed':
+                    print(f"Transcription completed after {polls} polls.", file=sys.stderr)
+                    return result, polls
+                if result['status'] == 'error':
+                    raise TranscriptionError(f"Transcription failed: {result.get('error')}")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TranscriptionError(f"Transcription timed out after {self.timeout}s ({polls} polls)")
+                # with a webhook the poll is only a safety net, so wait as long as allowed
+                base = self.poll_max if self.webhook_url else delay
+                event.wait(min(remaining, base * random.uniform(0.5, 1.0)))
+                event.clear()
+                delay = min(delay * self.poll_factor, self.poll_max)
+        finally:
+            with self._waiters_lock:
+                self._waiters.pop(transcript_id, None)
+
+    def notify(self, transcript_id, secret=None):
+        """Webhook entry point: wake whoever is waiting on `transcript_id`.
+        Returns False for unknown ids or a wrong secret."""
+        if self.webhook_secret and secret != self.webhook_secret:
+            return False
+        with self._waiters_lock:
+            event = self._waiters.get(transcript_id)
+        if event is None:
+            return False
+        event.set()
+        return True
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,355 @@
+"""Resumable chunked uploads and disk retention for flask_api.
+
+A client creates an upload, sends the bytes in chunks (each `PUT` names the
+offset it starts at) and then completes it. Chunks go straight into a `.part`
+file in the upload directory, and a SHA-256 is updated as they arrive.
+Completing an upload is therefore just a rename with the digest already known,
+and /record and /chat analyse the file in place. An interrupted upload
+continues from the offset the server reports instead of starting over.
+
+`RetentionManager` keeps the upload and output directories within an age
+limit and a total-size quota. It deletes the oldest files first, marks them
+deleted in the `uploads` table and expires abandoned partial uploads.
+"""
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from werkzeug.utils import secure_filename
+
+CHUNK_SIZE = 1 << 20
+
+# current layout of `uploads` (see schema.sql); older databases are rebuilt to it
+_UPLOADS_DDL = '''CREATE TABLE uploads (
+  id        INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id   INTEGER,
+  filename  TEXT NOT NULL,
+  stored_as TEXT NOT NULL,
+  size_bytes INTEGER NOT NULL,
+  content_hash TEXT,
+  created_at TEXT DEFAULT (datetime('now')),
+  deleted_at TEXT,
+  FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+)'''
+
+
+class UploadError(Exception):
+    """Client-visible upload failure; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400, **info):
+        super().__init__(message)
+        self.status = status
+        self.info = info
+
+
+def _migrate_uploads(conn):
+    cols = {row[1]: row for row in conn.execute('PRAGMA table_info(uploads)')}
+    if cols and not cols['user_id'][3] and 'content_hash' in cols and 'deleted_at' in cols:
+        return
+    # SQLite can't relax NOT NULL in place, so copy into a table with the new layout
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(_UPLOADS_DDL.replace('CREATE TABLE uploads', 'CREATE TABLE uploads_new', 1))
+        if cols:
+            conn.execute('INSERT INTO uploads_new (id, user_id, filename, stored_as, size_bytes, created_at) '
+                         'SELECT id, user_id, filename, stored_as, size_bytes, created_at FROM uploads')
+            conn.execute('DROP TABLE uploads')
+        conn.execute('ALTER TABLE uploads_new RENAME TO uploads')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_uploads_stored_as ON uploads(stored_as)')
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+class UploadStore:
+    def __init__(self, db_path, upload_dir, max_bytes=None, chunk_size=CHUNK_SIZE):
+        """`max_bytes` caps a single upload. The `uploads`/`upload_sessions`
+        tables must exist (flask_api's ConversationStore runs schema.sql)."""
+        self.db_path = str(db_path)
+        self.upload_dir = Path(upload_dir)
+        self.upload_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._busy = set()     # upload ids with a chunk being written
+        self._hashers = {}     # upload id -> (offset, sha256 state)
+        _migrate_uploads(self._conn())
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _session(self, upload_id):
+        row = self._conn().execute(
+            'SELECT id, filename, stored_as, size_bytes, received, sha256, status FROM upload_sessions WHERE id = ?',
+            (upload_id,)).fetchone()
+        if row is None:
+            raise UploadError('unknown upload', 404)
+        keys = ('id', 'filename', 'stored_as', 'size', 'offset', 'sha256', 'status')
+        return dict(zip(keys, row))
+
+    def _part_path(self, sess):
+        return self.upload_dir / (sess['stored_as'] + '.part')
+
+    def create(self, filename, size=None):
+        """Start an upload of `filename` (`size` bytes, if known)."""
+        if size is not None and self.max_bytes and size > self.max_bytes:
+            raise UploadError(f"upload larger than {self.max_bytes} bytes", 413)
+        upload_id = uuid.uuid4().hex
+        stored_as = f"{int(time.time() * 1000)}-{secure_filename(filename) or 'upload'}"
+        now = int(time.time())
+        self._conn().execute(
+            'INSERT INTO upload_sessions (id, filename, stored_as, size_bytes, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)', (upload_id, filename, stored_as, size, now, now))
+        self._part_path({'stored_as': stored_as}).touch()
+        return self.status(upload_id)
+
+    def status(self, upload_id):
+        sess = self._session(upload_id)
+        return {'id': sess['id'], 'offset': sess['offset'], 'size': sess['size'], 'status': sess['status'],
+                'sha256': sess['sha256']}
+
+    def _hasher(self, upload_id, part, offset):
+        cached = self._hashers.get(upload_id)
+        if cached is not None and cached[0] == offset:
+            return cached[1]
+        # first chunk since a restart (or after a failed write): rebuild from what is on disk
+        digest = hashlib.sha256()
+        with open(part, 'rb') as f:
+            remaining = offset
+            while remaining:
+                chunk = f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    raise UploadError('partial upload is missing data; start a new upload', 410)
+                digest.update(chunk)
+                remaining -= len(chunk)
+        return digest
+
+    def write(self, upload_id, offset, stream):
+        """Append the bytes of `stream` at `offset`, which must equal the
+        current offset (a 409 reports the right one). Returns the new status."""
+        with self._lock:
+            if upload_id in self._busy:
+                raise UploadError('another chunk of this upload is in progress', 409)
+            self._busy.add(upload_id)
+        try:
+            sess = self._session(upload_id)
+            if sess['status'] != 'open':
+                raise UploadError(f"upload is {sess['status']}", 409, offset=sess['offset'])
+            if offset != sess['offset']:
+                raise UploadError('offset mismatch', 409, offset=sess['offset'])
+            limit = sess['size'] if sess['size'] is not None else self.max_bytes
+            part = self._part_path(sess)
+            digest = self._hasher(upload_id, part, offset)
+            received = offset
+            try:
+                with open(part, 'r+b') as f:
+                    # drop any tail from a write that failed before its offset was recorded
+                    f.truncate(offset)
+                    f.seek(offset)
+                    while True:
+                        chunk = stream.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        if limit and received + len(chunk) > limit:
+                            raise UploadError(f"upload exceeds {limit} bytes", 413, offset=received)
+                        f.write(chunk)
+                        digest.update(chunk)
+                        received += len(chunk)
+            finally:
+                # keep whatever arrived intact, even if the client dropped mid-chunk
+                self._hashers[upload_id] = (received, digest)
+                self._conn().execute('UPDATE upload_sessions SET received = ?, updated_at = ? WHERE id = ?',
+                                     (received, int(time.time()), upload_id))
+            return self.status(upload_id)
+        finally:
+            with self._lock:
+                self._busy.discard(upload_id)
+
+    def complete(self, upload_id, sha256=None, user_id=None):
+        """Finish an upload: check its size and (optional) client digest, move
+        it into place and register it in `uploads`. Returns
+        {'id', 'path', 'stored_as', 'sha256', 'size'}."""
+        with self._lock:
+            if upload_id in self._busy:
+                raise UploadError('a chunk or completion of this upload is still in progress', 409)
+            self._busy.add(upload_id)
+        try:
+            # read the session only once the upload is claimed, so a concurrent
+            # complete that already moved the file is seen as complete
+            sess = self._session(upload_id)
+            if sess['status'] == 'complete':
+                return self._completed(sess)
+            if sess['status'] != 'open':
+                raise UploadError(f"upload is {sess['status']}", 409)
+            if sess['size'] is not None and sess['offset'] != sess['size']:
+                raise UploadError('upload incomplete', 409, offset=sess['offset'], size=sess['size'])
+            part = self._part_path(sess)
+            digest = self._hasher(upload_id, part, sess['offset']).hexdigest()
+            if sha256 and sha256.lower() != digest:
+                raise UploadError('checksum mismatch', 422, sha256=digest)
+            os.replace(part, self.upload_dir / sess['stored_as'])
+            self._hashers.pop(upload_id, None)
+            self._conn().execute("UPDATE upload_sessions SET status = 'complete', sha256 = ?, updated_at = ? WHERE id = ?",
+                                 (digest, int(time.time()), upload_id))
+            self.register(sess['stored_as'], sess['filename'], sess['offset'], digest, user_id=user_id)
+        finally:
+            with self._lock:
+                self._busy.discard(upload_id)
+        return self._completed(self._session(upload_id))
+
+    def _completed(self, sess):
+        return {'id': sess['id'], 'path': str(self.upload_dir / sess['stored_as']), 'stored_as': sess['stored_as'],
+                'sha256': sess['sha256'], 'size': sess['offset']}
+
+    def completed(self, upload_id, user_id=None):
+        """(path, sha256) of a completed upload, for analysing it in place.
+        With `user_id`, an anonymous `uploads` row is filed under that user."""
+        sess = self._session(upload_id)
+        if sess['status'] != 'complete':
+            raise UploadError(f"upload is {sess['status']}, not complete", 409)
+        path = self.upload_dir / sess['stored_as']
+        if not path.exists():
+            raise UploadError('upload has been deleted', 410)
+        if user_id is not None:
+            self._conn().execute('UPDATE uploads SET user_id = ? WHERE stored_as = ? AND user_id IS NULL',
+                                 (user_id, sess['stored_as']))
+        return str(path), sess['sha256']
+
+    def register(self, stored_as, filename, size, content_hash=None, user_id=None):
+        """Record a finished file in `uploads` (also used for single-request uploads)."""
+        cur = self._conn().execute(
+            'INSERT INTO uploads (user_id, filename, stored_as, size_bytes, content_hash) VALUES (?, ?, ?, ?, ?)',
+            (user_id, filename, stored_as, size, content_hash))
+        return cur.lastrowid
+
+    def known(self):
+        """stored_as names of live (not deleted) rows in `uploads`."""
+        return {row[0] for row in self._conn().execute('SELECT stored_as FROM uploads WHERE deleted_at IS NULL')}
+
+    def mark_deleted(self, stored_as):
+        self._conn().execute("UPDATE uploads SET deleted_at = datetime('now') WHERE stored_as = ? AND deleted_at IS NULL",
+                             (stored_as,))
+
+    def expire_stale(self, max_idle):
+        """Delete partial uploads untouched for `max_idle` seconds; returns how many."""
+        cutoff = int(time.time() - max_idle)
+        conn = self._conn()
+        rows = conn.execute("SELECT id, stored_as FROM upload_sessions WHERE status = 'open' AND updated_at < ?",
+                            (cutoff,)).fetchall()
+        expired = 0
+        for upload_id, stored_as in rows:
+            with self._lock:
+                if upload_id in self._busy:
+                    continue
+            (self.upload_dir / (stored_as + '.part')).unlink(missing_ok=True)
+            self._hashers.pop(upload_id, None)
+            conn.execute("UPDATE upload_sessions SET status = 'expired', updated_at = ? WHERE id = ?",
+                         (int(time.time()), upload_id))
+            expired += 1
+        return expired
+
+
+class RetentionManager:
+    def __init__(self, store, dirs, max_age=30 * 86400, max_bytes=2 << 30, min_age=600, stale_upload=86400,
+                 interval=600, protect=None):
+        """Sweep `dirs` every `interval` seconds. Files older than `max_age`
+        seconds are deleted, then the oldest until the total is within
+        `max_bytes`. Files younger than `min_age`, partial uploads and paths
+        returned by `protect()` (e.g. queued jobs) are never touched. Partial
+        uploads idle for `stale_upload` seconds are expired."""
+        self.store = store
+        self.dirs = [Path(d) for d in dirs]
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.stale_upload = stale_upload
+        self.interval = interval
+        self.protect = protect
+        self.last = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='retention', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"retention sweep failed: {e}", file=sys.stderr)
+            self._stop.wait(self.interval)
+
+    def _scan(self):
+        files = []
+        for d in self.dirs:
+            if not d.is_dir():
+                continue
+            for root, _, names in os.walk(d):
+                for name in names:
+                    if name.endswith('.part'):
+                        continue  # in-progress uploads are expired by the store, not by size
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, path))
+        return sorted(files)
+
+    def sweep(self):
+        """One pass; returns what it found and removed."""
+        now = time.time()
+        expired = self.store.expire_stale(self.stale_upload) if self.store is not None else 0
+        protected = set(os.path.abspath(p) for p in (self.protect() if self.protect else ()))
+        files = self._scan()
+        total = sum(size for _, size, _ in files)
+        upload_dir = self.store.upload_dir.resolve() if self.store is not None else None
+        known = self.store.known() if self.store is not None else set()
+        deleted = freed = 0
+        for mtime, size, path in files:
+            too_old = now - mtime > self.max_age
+            if not too_old and total <= self.max_bytes:
+                # files are oldest first, so nothing later is due either
+                break
+            if now - mtime < self.min_age or os.path.abspath(path) in protected:
+                continue
+            try:
+                os.unlink(path)
+            except OSError as e:
+                print(f"retention: could not delete {path}: {e}", file=sys.stderr)
+                continue
+            total -= size
+            deleted += 1
+            freed += size
+            if upload_dir is not None and Path(path).resolve().parent == upload_dir:
+                self.store.mark_deleted(os.path.basename(path))
+        if upload_dir is not None:
+            # backfill files that arrived before uploads were recorded, so sizes are all in one place
+            for mtime, size, path in files:
+                name = os.path.basename(path)
+                if Path(path).parent.resolve() == upload_dir and name not in known and os.path.exists(path):
+                    self.store.register(name, name, size)
+        self.last = {'at': now, 'files': len(files) - deleted, 'bytes': total, 'deleted': deleted,
+                     'freed_bytes': freed, 'expired_uploads': expired}
+        if deleted or expired:
+            print(f"retention: deleted {deleted} files ({freed} bytes), expired {expired} partial uploads; "
+                  f"{total} bytes kept", file=sys.stderr)
+        return self.last